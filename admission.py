@@ -0,0 +1,131 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from fastapi import Depends, HTTPException, Request
+
+
+# Admission control: не пускаем к базе больше запросов, чем она переварит.
+# Лишние ждут в ограниченной очереди, при переполнении сразу отдаём 503.
+QUEUE_TIMEOUT = 5  # секунд ожидания места в очереди
+RETRY_AFTER = 2  # секунд, подсказка клиенту в Retry-After
+
+# имя → лимитер, для метрик
+limiters: dict[str, "AdmissionLimiter"] = {}
+
+
+def _busy() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Server is busy, try again later",
+        headers={"Retry-After": str(RETRY_AFTER)},
+    )
+
+
+class AdmissionLimiter:
+    def __init__(self, max_concurrent: int, max_queue: int, queue_timeout: float = QUEUE_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.active = 0
+        self.waiting = 0
+        self.stats = {"admitted": 0, "rejected": 0, "timed_out": 0}
+
+    async def acquire(self):
+        if not self._semaphore.locked():
+            # свободный слот есть — берём без ожидания
+            await self._semaphore.acquire()
+        else:
+            if self.waiting >= self.max_queue:
+                self.stats["rejected"] += 1
+                raise _busy()
+
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.stats["timed_out"] += 1
+                raise _busy()
+            finally:
+                self.waiting -= 1
+
+        self.active += 1
+        self.stats["admitted"] += 1
+
+    def release(self):
+        self.active -= 1
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def snapshot(self) -> dict:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "waiting": self.waiting,
+            **self.stats,
+        }
+
+
+class _Slot:
+    """Занятое место в лимитере; release можно звать сколько угодно раз"""
+
+    def __init__(self, limiter: AdmissionLimiter):
+        self.limiter = limiter
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.limiter.release()
+
+
+def get_limiter(name: str, max_concurrent: int, max_queue: int) -> AdmissionLimiter:
+    """Лимитер из реестра (создаётся при первом обращении) — для ограничений внутри эндпоинта"""
+    limiter = limiters.get(name)
+    if limiter is None:
+        limiter = limiters[name] = AdmissionLimiter(max_concurrent, max_queue)
+    return limiter
+
+
+def admit(name: str, max_concurrent: int, max_queue: int):
+    """
+    Зависимость для dependencies=[...] роута. Зависимости роута решаются
+    раньше параметров эндпоинта, поэтому слот берётся до сессии из get_db.
+    Держится, пока запрос не закончится — teardown зависимости идёт уже
+    после отправки тела, поэтому эндпоинты, которые долго отдают или читают
+    тело без базы, отпускают слот сами (release_admission).
+    """
+    limiter = get_limiter(name, max_concurrent, max_queue)
+
+    async def dependency(request: Request):
+        await limiter.acquire()
+        slot = request.state.admission_slot = _Slot(limiter)
+        try:
+            yield
+        finally:
+            slot.release()
+
+    return Depends(dependency)
+
+
+def release_admission(request: Request):
+    """Отпустить слот досрочно: работа с базой закончилась, дальше только передача данных"""
+    slot = getattr(request.state, "admission_slot", None)
+    if slot is not None:
+        slot.release()
+
+
+async def readmit(request: Request):
+    """Снова занять слот, отпущенный release_admission; вернёт его teardown зависимости"""
+    slot = request.state.admission_slot
+    if slot.released:
+        await slot.limiter.acquire()
+        slot.released = False
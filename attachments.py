@@ -0,0 +1,74 @@
+import hashlib
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import AsyncIterator
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+
+# Content-addressed хранилище: файл лежит по sha256 своего содержимого,
+# одинаковые загрузки пишутся на диск один раз
+ATTACHMENTS_DIR = Path(os.getenv("ATTACHMENTS_DIR", "media/attachments"))
+MAX_ATTACHMENT_SIZE = 50 * 1024 * 1024  # 50 MB
+
+
+def blob_path(sha256: str) -> Path:
+    # раскладываем по подпапкам, чтобы не держать всё в одной директории
+    return ATTACHMENTS_DIR / sha256[:2] / sha256
+
+
+async def store_stream(chunks: AsyncIterator[bytes]) -> tuple[str, int]:
+    """
+    Пишет поток чанков во временный файл, по ходу считая sha256 и размер.
+    Целиком в памяти файл не держим. Возвращает (sha256, size).
+    """
+    ATTACHMENTS_DIR.mkdir(parents=True, exist_ok=True)
+
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_name = tempfile.mkstemp(dir=ATTACHMENTS_DIR, prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if size > MAX_ATTACHMENT_SIZE:
+                    raise HTTPException(status_code=413, detail="Attachment is too large")
+                digest.update(chunk)
+                await run_in_threadpool(tmp.write, chunk)
+
+        if size == 0:
+            raise HTTPException(status_code=400, detail="Empty attachment")
+
+        sha256 = digest.hexdigest()
+        target = blob_path(sha256)
+        if target.exists():
+            # такой файл уже есть — дедуп. mtime обновляем, чтобы чистка
+            # неприкреплённых загрузок не удалила файл, на который сейчас сошлются
+            os.unlink(tmp_name)
+            os.utime(target)
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_name, target)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+
+    return sha256, size
+
+
+def remove_blob(sha256: str, older_than: float) -> bool:
+    """Удалить файл хранилища, если его не загружали заново последние older_than секунд"""
+    path = blob_path(sha256)
+    try:
+        if path.stat().st_mtime > time.time() - older_than:
+            return False
+        path.unlink()
+    except FileNotFoundError:
+        return False
+    return True
@@ -3,6 +3,7 @@ from sqlalchemy import select
 from datetime import datetime, timedelta, timezone
 from time import time
 from typing import Optional
+from uuid import uuid4
 from jose import jwt
 from jose.exceptions import ExpiredSignatureError, JWTError
 from passlib.context import CryptContext
@@ -17,10 +18,13 @@ from crud import get_user_by_username
 from db_models import User
 from config import settings
 from db_conf import get_db
+from presence import activity
+from revocation import RevocationList
 
 
 #redis
 redis_client = redis.from_url("redis://localhost:6379", decode_responses=True)
+revocation_list = RevocationList(redis_client)
 
 MAX_ATTEMPTS = 5
 BLOCK_TIME = 60  # секунд
@@ -62,7 +66,12 @@ def hash_password(password: str) -> str:
 def create_token(data: dict, expires_delta: timedelta, token_type: str = "access") -> str:
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + expires_delta
-    to_encode.update({"exp": expire, "iat": datetime.now(timezone.utc), "type": token_type})
+    to_encode.update({
+        "exp": expire,
+        "iat": datetime.now(timezone.utc),
+        "type": token_type,
+        "jti": uuid4().hex,  # по нему отзываем токен
+    })
     encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     return encoded_jwt
 
@@ -74,6 +83,14 @@ def create_refresh_token(data: dict) -> str:
     return create_token(data, timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS), token_type="refresh")
 
 
+async def revoke_access_token(token: str):
+    """Отзыв access токена до его истечения (например, при logout)"""
+    payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+    jti = payload.get("jti")
+    if jti:
+        await revocation_list.revoke(jti, payload["exp"])
+
+
 class TokenData(BaseModel):
     username: Optional[str] = None
     type: Optional[str] = None
@@ -111,6 +128,8 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession
         if not username or token_type != "access":
              raise credentials_exception
 
+        jti = payload.get("jti")
+
     except ExpiredSignatureError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -121,17 +140,27 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession
     except JWTError:
         raise credentials_exception    
 
+    if jti and await revocation_list.is_revoked(jti):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Access token has been revoked",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
     user = await get_user_by_username(db, token_data.username)
 
     if not user:
         raise credentials_exception
+    activity.touch(user.id)
     return user
     
 
 
 
-
-
-
-
-
+def admin_check(current_user: User = Depends(get_current_user)) -> User:
+    if not current_user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access denied"
+        )
+    return current_user
@@ -0,0 +1,90 @@
+"""
+Сколько памяти Python уходит на одно соединение в реестре вебсокетов.
+
+    python benchmarks/connection_memory.py [N ...]   (по умолчанию 10000 100000)
+
+Сокеты ненастоящие: буферы сервера (uvicorn/websockets) и объект
+starlette WebSocket сюда не входят — только то, что держит приложение:
+запись Connection и индексы реестра. idle — сокеты без исходящих сообщений,
+busy — у каждого в очереди одно сообщение и работает таск отправки.
+"""
+import asyncio
+import gc
+import sys
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import websocket_router  # noqa: E402
+from websocket_router import Connection, broadcast, disconnect, registry  # noqa: E402
+
+
+DEFAULT_SIZES = [10_000, 100_000]
+DEVICES_PER_USER = 2  # у части пользователей открыто несколько вкладок/устройств
+
+
+class FakeWebSocket:
+    __slots__ = ("blocked",)
+
+    def __init__(self, blocked: asyncio.Event):
+        self.blocked = blocked
+
+    async def send_text(self, text: str):
+        await self.blocked.wait()
+
+
+def _traced() -> int:
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+async def measure(n: int) -> dict:
+    websocket_router.SEND_TIMEOUT = None
+    blocked = asyncio.Event()
+    websocket = FakeWebSocket(blocked)
+
+    tracemalloc.start()
+    start = _traced()
+
+    # личные чаты: по два участника, у каждого участника DEVICES_PER_USER сокетов
+    for i in range(n):
+        user_id = i // DEVICES_PER_USER
+        chat_id = user_id // 2
+        registry.add(Connection(websocket, chat_id, user_id))
+    idle = _traced()
+
+    for chat_id in list(registry.by_chat):
+        await broadcast(chat_id, {"type": "ping"})
+    await asyncio.sleep(0)  # таски отправки стартуют и встают на send_text
+    busy = _traced()
+    tracemalloc.stop()
+
+    result = {
+        "connections": len(registry),
+        "chats": len(registry.by_chat),
+        "users": len(registry.by_user),
+        "idle": (idle - start) / n,
+        "busy": (busy - start) / n,
+        "record": sys.getsizeof(next(iter(registry))),
+    }
+
+    blocked.set()
+    for conn in list(registry):
+        disconnect(conn)
+    await asyncio.sleep(0)
+    return result
+
+
+async def main(sizes: list[int]):
+    print(f"{'connections':>12} {'chats':>8} {'users':>8} {'idle B/conn':>12} {'busy B/conn':>12} {'record B':>9}")
+    for n in sizes:
+        r = await measure(n)
+        print(
+            f"{r['connections']:>12} {r['chats']:>8} {r['users']:>8} "
+            f"{r['idle']:>12.0f} {r['busy']:>12.0f} {r['record']:>9}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES))
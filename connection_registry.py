@@ -0,0 +1,61 @@
+from typing import Iterator
+
+
+_EMPTY = frozenset()
+
+
+class ConnectionRegistry:
+    """
+    Открытые сокеты воркера с двумя индексами: chat_id → соединения и
+    user_id → соединения. Ключи — int (без str(chat_id) на каждый вызов),
+    добавление и удаление — O(1). Запись соединения должна иметь chat_id и user_id
+    """
+
+    __slots__ = ("by_chat", "by_user", "_count")
+
+    def __init__(self):
+        self.by_chat: dict[int, set] = {}
+        self.by_user: dict[int, set] = {}
+        self._count = 0
+
+    def add(self, conn):
+        self.by_chat.setdefault(conn.chat_id, set()).add(conn)
+        self.by_user.setdefault(conn.user_id, set()).add(conn)
+        self._count += 1
+
+    def remove(self, conn) -> bool:
+        """False, если соединения уже нет (повторный вызов безопасен)"""
+        chat_conns = self.by_chat.get(conn.chat_id)
+        if chat_conns is None or conn not in chat_conns:
+            return False
+
+        chat_conns.remove(conn)
+        if not chat_conns:
+            del self.by_chat[conn.chat_id]
+
+        user_conns = self.by_user[conn.user_id]
+        user_conns.remove(conn)
+        if not user_conns:
+            del self.by_user[conn.user_id]
+
+        self._count -= 1
+        return True
+
+    def for_chat(self, chat_id: int):
+        return self.by_chat.get(chat_id, _EMPTY)
+
+    def for_user(self, user_id: int):
+        return self.by_user.get(user_id, _EMPTY)
+
+    def is_user_connected(self, user_id: int) -> bool:
+        return user_id in self.by_user
+
+    def is_user_in_chat(self, user_id: int, chat_id: int) -> bool:
+        return any(conn.chat_id == chat_id for conn in self.for_user(user_id))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator:
+        for conns in self.by_chat.values():
+            yield from conns
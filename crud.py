@@ -1,11 +1,19 @@
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from db_models import User, Message, Chat, ChatMember
+from typing import AsyncIterator
+from db_models import User, Message, Chat, ChatMember, Attachment, RefreshToken, NotificationOutbox, generate_message_id
+from db_models import DailyStats, UserDailyStats, ChatStats, StatsWatermark
 from models import UserCreate, MessageCreate
 from fastapi import HTTPException
-from sqlalchemy import func, desc
+from sqlalchemy import func, desc, update, insert, delete, exists, or_, and_, case, bindparam, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
 from security import verify_user_access
+from singleflight import single_flight
+from user_search import username_index
+from sharding import shard_map, commit_shard
 from fastapi import Depends
+from datetime import date, datetime, timedelta, timezone
 
 # ---------------- Users ----------------
 
@@ -20,6 +28,18 @@ async def get_user_by_public_id(db: AsyncSession, public_id: str) -> User | None
     return result.scalar_one_or_none()
 
 
+# Горячий read для публичного профиля и статуса: одинаковые одновременные
+# запросы делят один SELECT, результат коротко кэшируется (и "не найдено" тоже)
+@single_flight(ttl=2.0, negative_ttl=5.0)
+async def get_public_user(db: AsyncSession, public_id: str) -> dict | None:
+    result = await db.execute(
+        select(User.public_id, User.username, User.description, User.is_online)
+        .where(User.public_id == public_id)
+    )
+    row = result.mappings().one_or_none()
+    return dict(row) if row else None
+
+
 async def get_user_by_username(db: AsyncSession, username: str):
     result = await db.execute(
         select(User).where(User.username == username)
@@ -28,6 +48,63 @@ async def get_user_by_username(db: AsyncSession, username: str):
 
 
 
+# Поиск по username: префикс + опечатки
+def _postgres_search_query(q: str, limit: int):
+    columns = (User.public_id, User.username, User.description)
+    escaped = q.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    # lower(username) LIKE 'q%' идёт по индексу text_pattern_ops
+    is_prefix = func.lower(User.username).like(escaped + "%")
+
+    if len(q) < 3:
+        # только префикс: строк под 'q%' могут быть десятки тысяч, поэтому без
+        # similarity — сортируем в порядке индекса (text_pattern_ops сравнивает
+        # через ~<~), и LIMIT останавливает сканирование. Точное совпадение
+        # в этом порядке и так первое
+        return (
+            select(*columns)
+            .where(is_prefix)
+            .order_by(text("lower(users.username) USING ~<~"))
+            .limit(limit)
+        )
+
+    # username % q — похожие по триграммам, по GIN индексу pg_trgm
+    return (
+        select(*columns)
+        .where(or_(is_prefix, User.username.op("%")(q)))
+        .order_by(
+            (func.lower(User.username) == q.lower()).desc(),
+            is_prefix.desc(),
+            func.similarity(User.username, q).desc(),
+            User.username,
+        )
+        .limit(limit)
+    )
+
+
+async def search_users(db: AsyncSession, q: str, limit: int) -> list[dict]:
+    columns = (User.public_id, User.username, User.description)
+
+    if db.get_bind().dialect.name == "postgresql":
+        result = await db.execute(_postgres_search_query(q, limit))
+        return [dict(row) for row in result.mappings()]
+
+    # fallback для SQLite — индекс в памяти, строим один раз
+    if not username_index.loaded:
+        result = await db.stream(select(User.public_id, User.username))
+        async for public_id, username in result:
+            username_index.add(public_id, username)
+        username_index.loaded = True
+
+    public_ids = username_index.search(q, limit)
+    if not public_ids:
+        return []
+
+    result = await db.execute(select(*columns).where(User.public_id.in_(public_ids)))
+    rows = {row["public_id"]: dict(row) for row in result.mappings()}
+    return [rows[public_id] for public_id in public_ids if public_id in rows]
+
+
+
 # ONLY FOR ADMIN 
 async def get_all_users(db: AsyncSession) -> list[User]:
     result = await db.execute(select(User))
@@ -35,13 +112,56 @@ async def get_all_users(db: AsyncSession) -> list[User]:
 
 # При регистрации тока 
 async def create_user(db: AsyncSession, user: UserCreate) -> User:
-    db_user = User(**user.model_dump())
-    db.add(db_user)
+    # INSERT ... RETURNING — сразу получаем строку с id и дефолтами, без refresh
+    db_user = await db.scalar(insert(User).values(**user.model_dump()).returning(User))
     await db.commit()
-    await db.refresh(db_user)
+    get_public_user.invalidate(db_user.public_id)
+    if username_index.loaded:
+        username_index.add(db_user.public_id, db_user.username)
     return db_user    
 
 
+async def update_user(db: AsyncSession, user: User, data: dict) -> User:
+    if not data:
+        return user
+
+    # UPDATE ... RETURNING обновляет объект в сессии, отдельный SELECT не нужен
+    user = await db.scalar(update(User).where(User.id == user.id).values(**data).returning(User))
+    await db.commit()
+    get_public_user.invalidate(user.public_id)
+    return user
+
+
+async def login_user(db: AsyncSession, user: User, refresh_token_hash: str, refresh_expires_at: datetime) -> User:
+    """Онлайн-статус и новый refresh токен — одной транзакцией"""
+    user = await db.scalar(
+        update(User)
+        .where(User.id == user.id)
+        .values(is_online=True, last_active=datetime.utcnow())
+        .returning(User)
+    )
+    await db.execute(insert(RefreshToken).values(
+        user_id=user.id, token_hash=refresh_token_hash, expires_at=refresh_expires_at
+    ))
+    await db.commit()
+    get_public_user.invalidate(user.public_id)
+    return user
+
+
+async def logout_user(db: AsyncSession, user: User) -> User:
+    """Оффлайн-статус и удаление всех refresh токенов — одной транзакцией"""
+    user = await db.scalar(
+        update(User)
+        .where(User.id == user.id)
+        .values(is_online=False, last_active=datetime.utcnow())
+        .returning(User)
+    )
+    await db.execute(delete(RefreshToken).where(RefreshToken.user_id == user.id))
+    await db.commit()
+    get_public_user.invalidate(user.public_id)
+    return user
+
+
 async def get_user_by_username(db: AsyncSession, username: str) -> User | None:
     result = await db.execute(select(User).where(User.username == username))
     return result.scalar_one_or_none()
@@ -56,6 +176,8 @@ async def delete_user(db: AsyncSession, user_id: int):
 
     await db.delete(user)
     await db.commit()
+    username_index.remove(user.public_id)
+    get_public_user.invalidate(user.public_id)
     return {"detail": f"User {user_id} deleted"}
     
 
@@ -70,67 +192,110 @@ async def delete_user(db: AsyncSession, user_id: int):
 
 
 async def get_messages_between(db: AsyncSession, user1_id: int, user2_id: int) -> list[Message]:
-    result = await db.execute(
-        select(Message)
-        .where(
-            ((Message.sender_id == user1_id) & (Message.recipient_id == user2_id)) |
-            ((Message.sender_id == user2_id) & (Message.recipient_id == user1_id))
-        )
-        .order_by(Message.created_at)
-    )
-    return result.scalars().all()
+    chat = await get_private_chat(db, user1_id, user2_id)
+    if not chat:
+        return []
+    return await get_chat_messages(db, chat)
 
 
 
-async def create_message(db: AsyncSession, sender_public: str, recipient_public: str, content: str) -> Message:
-    # Находим пользователей
-    result = await db.execute(select(User).where(User.public_id == sender_public))
-    sender = result.scalar_one_or_none()
-    if not sender:
-        raise HTTPException(status_code=404, detail="Sender not found")
-
-    result = await db.execute(select(User).where(User.public_id == recipient_public))
-    recipient = result.scalar_one_or_none()
-    if not recipient:
-        raise HTTPException(status_code=404, detail="Recipient not found")
-
+async def create_message(db: AsyncSession, sender: User, recipient: User, content: str,
+                         attachment_ids: list[str] | None = None) -> Message:
+    """
+    Пользователи передаются уже загруженными (current_user и собеседник),
+    поэтому повторно их не ищем. Если шард чата — глобальная база,
+    всё пишется одной транзакцией. Иначе глобальная база (чат, ссылки на
+    вложения) коммитится раньше шарда: в шарде не окажется строк чата,
+    которого нет в справочнике, а ссылки при ошибке шарда снимаются.
+    """
     # Получаем или создаём чат 1 на 1
-    chat = await get_or_create_private_chat(db, sender.id, recipient.id)
+    chat = await get_or_create_private_chat(db, sender.id, recipient.id, commit=False)
+    separate_shard = not shard_map.is_global(chat.shard)
+
+    # id генерируем заранее, чтобы привязать вложения до записи в шард
+    message_id = generate_message_id()
+    if attachment_ids:
+        await attach_to_message(db, message_id, chat.id, sender.id, attachment_ids)
+    if separate_shard:
+        await db.commit()
+
+    # Сообщение и уведомление получателю — в шарде чата, одной транзакцией
+    try:
+        async with shard_map.session(db, chat.shard) as shard_db:
+            db_message = await shard_db.scalar(
+                insert(Message)
+                .values(id=message_id, chat_id=chat.id, sender_id=sender.id, recipient_id=recipient.id, content=content)
+                .returning(Message)
+            )
+            await shard_db.execute(insert(NotificationOutbox).values(
+                recipient_id=recipient.id, sender_id=sender.id, message_id=message_id, chat_id=chat.id
+            ))
+            await commit_shard(db, shard_db)
+    except Exception:
+        if separate_shard and attachment_ids:
+            await db.rollback()
+            await detach_from_message(db, message_id)
+            await db.commit()
+        raise
 
-    # Создаём сообщение
-    db_message = Message(chat_id=chat.id, sender_id=sender.id, recipient_id=recipient.id, content=content)
-    db.add(db_message)
     await db.commit()
-    await db.refresh(db_message)
     return db_message
 
 
 
 
-async def get_or_create_private_chat(db, user1_id, user2_id):
-
-    # ищем существующий чат с этими двумя пользователями
+async def get_private_chat(db: AsyncSession, user1_id: int, user2_id: int) -> Chat | None:
+    # справочник чатов: один запрос по уникальному индексу пары
+    low, high = sorted((user1_id, user2_id))
     result = await db.execute(
-        select(Chat)
-        .join(ChatMember)
-        .group_by(Chat.id)
-        .having(func.count(ChatMember.id) == 2)
-        .where(ChatMember.user_id.in_([user1_id, user2_id]))
+        select(Chat).where(Chat.user_low_id == low).where(Chat.user_high_id == high)
     )
+    return result.scalar_one_or_none()
+
+
 
-    chat = result.scalar_one_or_none()
+async def get_or_create_private_chat(db, user1_id, user2_id, commit: bool = True):
+
+    # ищем существующий чат с этими двумя пользователями
+    chat = await get_private_chat(db, user1_id, user2_id)
     if chat:
         return chat
 
-    # если нет, создаём новый чат
-    chat = Chat()
-    db.add(chat)
-    await db.commit()
-    await db.refresh(chat)
-    
-    db.add_all([ChatMember(chat_id=chat.id, user_id=user1_id),
-                ChatMember(chat_id=chat.id, user_id=user2_id)])
-    await db.commit()
+    # если нет, создаём чат в справочнике; savepoint — на случай,
+    # если такой же чат параллельно создал другой запрос
+    low, high = sorted((user1_id, user2_id))
+    shard = shard_map.shard_for_new_chat(low, high)
+    try:
+        async with db.begin_nested():
+            chat = await db.scalar(
+                insert(Chat).values(shard=shard, user_low_id=low, user_high_id=high).returning(Chat)
+            )
+    except IntegrityError:
+        return await get_private_chat(db, user1_id, user2_id)
+
+    members = [{"chat_id": chat.id, "user_id": user1_id}, {"chat_id": chat.id, "user_id": user2_id}]
+    if not shard_map.is_global(shard):
+        # отдельная база: справочник коммитим первым, иначе участники в шарде
+        # переживут откат чата (а SQLite ещё и отдаст этот id следующему чату).
+        # Не записались участники — убираем и чат
+        await db.commit()
+        try:
+            async with shard_map.session(db, shard) as shard_db:
+                await shard_db.execute(insert(ChatMember), members)
+                await shard_db.commit()
+        except Exception:
+            await db.rollback()
+            await db.execute(delete(Chat).where(Chat.id == chat.id))
+            await db.commit()
+            raise
+        return chat
+
+    # участники — в той же базе и транзакции
+    await db.execute(insert(ChatMember), members)
+
+    # commit=False — вызывающий сам закроет транзакцию (например, вместе с сообщением)
+    if commit:
+        await db.commit()
     return chat
     
 
@@ -139,9 +304,10 @@ async def get_or_create_private_chat(db, user1_id, user2_id):
 async def get_current_user_chats_by_public_id(db: AsyncSession, user: User = Depends(verify_user_access)) -> list[dict]:
     """
     Получить список чатов текущего пользователя с собеседниками.
-    user — уже проверенный через verify_user_access
+    user — уже проверенный через verify_user_access.
+    Берём из справочника чатов в глобальной базе, в шарды не ходим
     """
-    # Получаем чаты, исключая самого пользователя
+    peer_id = case((Chat.user_low_id == user.id, Chat.user_high_id), else_=Chat.user_low_id)
     result = await db.execute(
         select(
             Chat.id,
@@ -150,12 +316,8 @@ async def get_current_user_chats_by_public_id(db: AsyncSession, user: User = Dep
             User.username.label("peer_username"),
             User.public_id.label("peer_public_id")  # добавляем public_id
         )
-        .join(ChatMember, Chat.id == ChatMember.chat_id)
-        .join(User, User.id == ChatMember.user_id)
-        .where(ChatMember.user_id != user.id)
-        .where(Chat.id.in_(
-            select(ChatMember.chat_id).where(ChatMember.user_id == user.id)
-        ))
+        .join(User, User.id == peer_id)
+        .where(or_(Chat.user_low_id == user.id, Chat.user_high_id == user.id))
     )
 
     return [
@@ -171,26 +333,238 @@ async def get_current_user_chats_by_public_id(db: AsyncSession, user: User = Dep
 
 
 
+async def get_user_chat_shards(db: AsyncSession, user_id: int) -> dict[int, int]:
+    """chat_id → шард, для всех чатов пользователя"""
+    result = await db.execute(
+        select(Chat.id, Chat.shard)
+        .where(or_(Chat.user_low_id == user_id, Chat.user_high_id == user_id))
+        .order_by(Chat.id)
+    )
+    return dict(result.all())
+
+
 
 
-# Получить сообщения чата
-async def get_chat_messages(db: AsyncSession, chat_id: int) -> list[Message]:
+
+async def is_chat_member(db: AsyncSession, chat_id: int, user_id: int) -> bool:
     result = await db.execute(
-        select(Message).where(Message.chat_id == chat_id).order_by(Message.created_at)
+        select(Chat.id)
+        .where(Chat.id == chat_id)
+        .where(or_(Chat.user_low_id == user_id, Chat.user_high_id == user_id))
     )
-    return result.scalars().all()
+    return result.first() is not None
+
+
+
+
+async def get_chat_shards(db: AsyncSession, chat_ids) -> dict[int, int]:
+    """chat_id → шард для заданных чатов"""
+    if not chat_ids:
+        return {}
+    result = await db.execute(select(Chat.id, Chat.shard).where(Chat.id.in_(chat_ids)))
+    return dict(result.all())
+
+
+
+
+# Сообщения одного чата для экспорта, db — сессия шарда чата.
+# db.stream + yield_per — серверный курсор, в памяти только одна пачка строк
+async def stream_chat_messages(db: AsyncSession, chat_id: int, after_id: int = 0,
+                               batch_size: int = 1000) -> AsyncIterator:
+    result = await db.stream(
+        select(
+            Message.id,
+            Message.chat_id,
+            Message.sender_id,
+            Message.recipient_id,
+            Message.content,
+            Message.created_at,
+        )
+        .where(Message.chat_id == chat_id)
+        .where(Message.id > after_id)
+        .order_by(Message.id)
+        .execution_options(yield_per=batch_size)
+    )
+    async for row in result:
+        yield row
 
 
 
 
+# Получить сообщения чата (из его шарда)
+async def get_chat_messages(db: AsyncSession, chat: Chat) -> list[Message]:
+    async with shard_map.session(db, chat.shard) as shard_db:
+        result = await shard_db.execute(
+            select(Message).where(Message.chat_id == chat.id).order_by(Message.created_at)
+        )
+        return result.scalars().all()
+
+
+
+
+
+
+# ---------------- Read cursors ----------------
+
+async def get_last_message_ids(db: AsyncSession, chat_ids: list[int]) -> dict[int, int]:
+    """db — сессия шарда. chat_id → id последнего сообщения (чатов без сообщений нет)"""
+    if not chat_ids:
+        return {}
+    result = await db.execute(
+        select(Message.chat_id, func.max(Message.id))
+        .where(Message.chat_id.in_(chat_ids))
+        .group_by(Message.chat_id)
+    )
+    return dict(result.all())
+
+
+async def update_read_cursors(db: AsyncSession, cursors: dict[tuple[int, int], int]):
+    """
+    db — сессия шарда. cursors: (chat_id, user_id) → id последнего прочитанного.
+    Одним executemany; курсор только растёт
+    """
+    if not cursors:
+        return
+    members = ChatMember.__table__
+    await db.execute(
+        update(members)
+        .where(members.c.chat_id == bindparam("b_chat_id"))
+        .where(members.c.user_id == bindparam("b_user_id"))
+        .where(or_(
+            members.c.last_read_message_id.is_(None),
+            members.c.last_read_message_id < bindparam("b_message_id"),
+        ))
+        .values(last_read_message_id=bindparam("b_message_id")),
+        [
+            {"b_chat_id": chat_id, "b_user_id": user_id, "b_message_id": message_id}
+            for (chat_id, user_id), message_id in cursors.items()
+        ],
+    )
+
+
+async def get_read_cursors(db: AsyncSession, chat_shards: dict[int, int]) -> dict[tuple[int, int], int | None]:
+    """(chat_id, user_id) → курсор, по шардам заданных чатов"""
+    by_shard: dict[int, list[int]] = {}
+    for chat_id, shard in chat_shards.items():
+        by_shard.setdefault(shard, []).append(chat_id)
+
+    cursors = {}
+    for shard, chat_ids in by_shard.items():
+        async with shard_map.session(db, shard) as shard_db:
+            result = await shard_db.execute(
+                select(ChatMember.chat_id, ChatMember.user_id, ChatMember.last_read_message_id)
+                .where(ChatMember.chat_id.in_(chat_ids))
+            )
+            for chat_id, user_id, message_id in result:
+                cursors[(chat_id, user_id)] = message_id
+    return cursors
+
+
+async def add_read_cursors(db: AsyncSession, user_id: int, chats: list[dict]) -> list[dict]:
+    """Дописывает в список чатов курсоры прочтения: свой и собеседника"""
+    cursors = await get_read_cursors(db, await get_user_chat_shards(db, user_id))
+    for chat in chats:
+        chat["last_read_message_id"] = cursors.get((chat["chat_id"], user_id))
+        chat["peer_last_read_message_id"] = cursors.get((chat["chat_id"], chat["peer_id"]))
+    return chats
+
+
+
+
+#---------------- Attachments ----------------
+
+async def create_attachment(db: AsyncSession, uploader_id: int, sha256: str, size: int,
+                            content_type: str, filename: str | None) -> Attachment:
+    attachment = Attachment(
+        uploader_id=uploader_id,
+        sha256=sha256,
+        size=size,
+        content_type=content_type,
+        filename=filename,
+    )
+    db.add(attachment)
+    await db.commit()
+    await db.refresh(attachment)
+    return attachment
+
+
+async def get_attachment_by_public_id(db: AsyncSession, public_id: str) -> Attachment | None:
+    result = await db.execute(select(Attachment).where(Attachment.public_id == public_id))
+    return result.scalar_one_or_none()
+
+
+async def attach_to_message(db: AsyncSession, message_id: int, chat_id: int, sender_id: int,
+                            attachment_ids: list[str]):
+    # прикрепить можно только свои ещё не использованные вложения
+    result = await db.execute(
+        update(Attachment)
+        .where(Attachment.public_id.in_(attachment_ids))
+        .where(Attachment.uploader_id == sender_id)
+        .where(Attachment.message_id.is_(None))
+        .values(message_id=message_id, chat_id=chat_id)
+    )
+    if result.rowcount != len(set(attachment_ids)):
+        raise HTTPException(status_code=400, detail="Invalid attachments")
+
+
+async def detach_from_message(db: AsyncSession, message_id: int):
+    """Снять ссылки, если сообщение так и не записалось в шард; коммитит вызывающий"""
+    await db.execute(
+        update(Attachment).where(Attachment.message_id == message_id).values(message_id=None, chat_id=None)
+    )
+
+
+async def delete_unattached_attachments(db: AsyncSession, older_than: timedelta, limit: int) -> list[str]:
+    """Загрузки, которые так и не прикрепили к сообщению. Возвращает sha256 удалённых строк"""
+    ids = select(Attachment.id).where(Attachment.message_id.is_(None)).where(
+        Attachment.created_at < datetime.now(timezone.utc) - older_than
+    ).limit(limit)
+
+    result = await db.execute(
+        delete(Attachment).where(Attachment.id.in_(ids)).returning(Attachment.sha256)
+        .execution_options(synchronize_session=False)
+    )
+    return list(result.scalars())
+
+
+async def get_referenced_hashes(db: AsyncSession, hashes) -> set[str]:
+    """Какие из файлов ещё нужны другим вложениям (хранилище с дедупом)"""
+    if not hashes:
+        return set()
+    result = await db.execute(select(Attachment.sha256).where(Attachment.sha256.in_(set(hashes))).distinct())
+    return set(result.scalars())
+
+
+async def get_attachments_for_messages(db: AsyncSession, message_ids: list[int]) -> dict[int, list[Attachment]]:
+    """Вложения для пачки сообщений одним запросом: message_id → [Attachment]"""
+    if not message_ids:
+        return {}
+
+    result = await db.execute(
+        select(Attachment).where(Attachment.message_id.in_(message_ids)).order_by(Attachment.id)
+    )
+    by_message: dict[int, list[Attachment]] = {}
+    for attachment in result.scalars():
+        by_message.setdefault(attachment.message_id, []).append(attachment)
+    return by_message
+
+
+async def can_access_attachment(db: AsyncSession, attachment: Attachment, user_id: int) -> bool:
+    if attachment.uploader_id == user_id:
+        return True
+    if attachment.chat_id is None:
+        return False
+    return await is_chat_member(db, attachment.chat_id, user_id)
+
+
 
 
 #---------------- Tokens ----------------
 
 from db_models import RefreshToken
 
-async def save_refresh_token_hash(db: AsyncSession, user_id: int, token_hash: str):
-    token = RefreshToken(user_id=user_id, token_hash=token_hash)
+async def save_refresh_token_hash(db: AsyncSession, user_id: int, token_hash: str, expires_at: datetime | None = None):
+    token = RefreshToken(user_id=user_id, token_hash=token_hash, expires_at=expires_at)
     db.add(token)
     await db.commit()
     return token
@@ -218,3 +592,276 @@ async def revoke_user_refresh_tokens(db: AsyncSession, user_id: int):
     )
     await db.commit()
 
+
+
+#---------------- Notification outbox ----------------
+
+async def fetch_due_notifications(db: AsyncSession, limit: int) -> list:
+    # db — сессия шарда. SKIP LOCKED — несколько диспетчеров разбирают outbox, не мешая друг другу
+    result = await db.execute(
+        select(
+            NotificationOutbox.id,
+            NotificationOutbox.recipient_id,
+            NotificationOutbox.sender_id,
+            NotificationOutbox.chat_id,
+            NotificationOutbox.message_id,
+            NotificationOutbox.attempts,
+        )
+        .where(NotificationOutbox.next_attempt_at <= datetime.now(timezone.utc))
+        .order_by(NotificationOutbox.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    return result.all()
+
+
+async def delete_notifications(db: AsyncSession, ids: list[int]):
+    if ids:
+        await db.execute(
+            delete(NotificationOutbox).where(NotificationOutbox.id.in_(ids))
+            .execution_options(synchronize_session=False)
+        )
+
+
+async def reschedule_notifications(db: AsyncSession, ids: list[int], next_attempt_at: datetime):
+    if ids:
+        await db.execute(
+            update(NotificationOutbox)
+            .where(NotificationOutbox.id.in_(ids))
+            .values(attempts=NotificationOutbox.attempts + 1, next_attempt_at=next_attempt_at)
+            .execution_options(synchronize_session=False)
+        )
+
+
+
+
+#---------------- Stats rollups ----------------
+# Счётчики пополняются сложением (upsert ... SET messages = messages + excluded),
+# поэтому агрегатор может писать их пачками сколько угодно раз
+
+def _upsert(db: AsyncSession, model):
+    # ON CONFLICT есть только в диалектных insert
+    if db.bind.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+async def fetch_messages_for_rollup(db: AsyncSession, after_id: int, before_id: int, limit: int) -> list:
+    # db — сессия шарда
+    result = await db.execute(
+        select(Message.id, Message.chat_id, Message.sender_id, Message.created_at)
+        .where(Message.id > after_id)
+        .where(Message.id < before_id)
+        .order_by(Message.id)
+        .limit(limit)
+    )
+    return result.all()
+
+
+async def lock_stats_watermark(db: AsyncSession, shard: int) -> int:
+    # строка водяного знака — заодно лок, чтобы один шард не агрегировали дважды параллельно
+    await db.execute(_upsert(db, StatsWatermark).values(shard=shard, last_message_id=0).on_conflict_do_nothing())
+    result = await db.execute(
+        select(StatsWatermark.last_message_id).where(StatsWatermark.shard == shard).with_for_update()
+    )
+    return result.scalar_one()
+
+
+async def set_stats_watermark(db: AsyncSession, shard: int, last_message_id: int):
+    await db.execute(
+        update(StatsWatermark).where(StatsWatermark.shard == shard)
+        .values(last_message_id=last_message_id)
+    )
+
+
+async def add_stats_counters(db: AsyncSession, daily: dict, user_daily: dict, chats: dict):
+    """
+    daily: day → сообщений, user_daily: (day, user_id) → сообщений,
+    chats: chat_id → (сообщений, время последнего)
+    """
+    if daily:
+        stmt = _upsert(db, DailyStats)
+        await db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[DailyStats.day],
+                set_={"messages": DailyStats.messages + stmt.excluded.messages},
+            ),
+            [{"day": day, "messages": count} for day, count in daily.items()],
+        )
+    if user_daily:
+        stmt = _upsert(db, UserDailyStats)
+        await db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[UserDailyStats.day, UserDailyStats.user_id],
+                set_={"messages": UserDailyStats.messages + stmt.excluded.messages},
+            ),
+            [{"day": day, "user_id": user_id, "messages": count} for (day, user_id), count in user_daily.items()],
+        )
+    if chats:
+        stmt = _upsert(db, ChatStats)
+        await db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[ChatStats.chat_id],
+                set_={
+                    "messages": ChatStats.messages + stmt.excluded.messages,
+                    "last_message_at": case(
+                        (or_(ChatStats.last_message_at.is_(None),
+                             stmt.excluded.last_message_at > ChatStats.last_message_at),
+                         stmt.excluded.last_message_at),
+                        else_=ChatStats.last_message_at,
+                    ),
+                },
+            ),
+            [
+                {"chat_id": chat_id, "messages": count, "last_message_at": last_at}
+                for chat_id, (count, last_at) in chats.items()
+            ],
+        )
+
+
+async def reset_stats(db: AsyncSession):
+    for model in (DailyStats, UserDailyStats, ChatStats, StatsWatermark):
+        await db.execute(delete(model))
+
+
+async def get_daily_stats(db: AsyncSession, since: date) -> list[dict]:
+    active = (
+        select(UserDailyStats.day, func.count().label("active_users"))
+        .where(UserDailyStats.day >= since)
+        .group_by(UserDailyStats.day)
+        .subquery()
+    )
+    result = await db.execute(
+        select(DailyStats.day, DailyStats.messages, func.coalesce(active.c.active_users, 0))
+        .outerjoin(active, active.c.day == DailyStats.day)
+        .where(DailyStats.day >= since)
+        .order_by(DailyStats.day)
+    )
+    return [
+        {"day": day, "messages": messages, "active_users": active_users}
+        for day, messages, active_users in result
+    ]
+
+
+async def get_top_chats(db: AsyncSession, limit: int) -> list[dict]:
+    result = await db.execute(
+        select(ChatStats.chat_id, ChatStats.messages, ChatStats.last_message_at)
+        .order_by(ChatStats.messages.desc())
+        .limit(limit)
+    )
+    return [dict(row._mapping) for row in result]
+
+
+async def get_top_users(db: AsyncSession, since: date, limit: int) -> list[dict]:
+    total = func.sum(UserDailyStats.messages).label("messages")
+    result = await db.execute(
+        select(User.public_id, User.username, total)
+        .join(User, User.id == UserDailyStats.user_id)
+        .where(UserDailyStats.day >= since)
+        .group_by(User.id, User.public_id, User.username)
+        .order_by(total.desc())
+        .limit(limit)
+    )
+    return [dict(row._mapping) for row in result]
+
+
+async def get_stats_watermarks(db: AsyncSession) -> list[dict]:
+    result = await db.execute(
+        select(StatsWatermark.shard, StatsWatermark.last_message_id, StatsWatermark.updated_at)
+        .order_by(StatsWatermark.shard)
+    )
+    return [dict(row._mapping) for row in result]
+
+
+
+
+#---------------- Maintenance ----------------
+# Чистка пачками: каждый вызов трогает не больше limit строк,
+# чтобы не держать долгие локи. Возвращают количество затронутых строк.
+
+async def delete_expired_refresh_tokens(db: AsyncSession, legacy_max_age: timedelta, limit: int) -> int:
+    now = datetime.now(timezone.utc)
+    ids = select(RefreshToken.id).where(or_(
+        RefreshToken.expires_at < now,
+        # старые записи без expires_at
+        and_(RefreshToken.expires_at.is_(None), RefreshToken.created_at < now - legacy_max_age),
+    )).limit(limit)
+
+    result = await db.execute(
+        delete(RefreshToken).where(RefreshToken.id.in_(ids))
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+async def touch_users(db: AsyncSession, user_ids) -> int:
+    """Отметить активность: last_active = сейчас, пользователь снова онлайн; коммитит вызывающий"""
+    result = await db.execute(
+        update(User).where(User.id.in_(list(user_ids)))
+        .values(is_online=True, last_active=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+async def reset_stale_online_flags(db: AsyncSession, inactive_for: timedelta, limit: int) -> int:
+    before = datetime.utcnow() - inactive_for
+    ids = select(User.id).where(User.is_online.is_(True)).where(
+        or_(User.last_active < before, User.last_active.is_(None))
+    ).limit(limit)
+
+    result = await db.execute(
+        update(User).where(User.id.in_(ids)).values(is_online=False)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+async def delete_orphan_chats(db: AsyncSession, older_than: timedelta, limit: int) -> int:
+    """
+    Чаты без единого сообщения (например, созданные просмотром пустой истории).
+    Сообщения лежат в шардах, поэтому кандидатов ищем в каждом шарде,
+    а возраст и принадлежность шарду проверяем по справочнику
+    """
+    no_messages = ~exists().where(Message.chat_id == ChatMember.chat_id)
+    deleted = 0
+    for shard in range(len(shard_map)):
+        async with shard_map.session(db, shard) as shard_db:
+            result = await shard_db.execute(
+                select(ChatMember.chat_id)
+                .where(no_messages)
+                .group_by(ChatMember.chat_id)
+                .order_by(ChatMember.chat_id)
+                .limit(limit)
+            )
+            candidates = result.scalars().all()
+            if not candidates:
+                continue
+
+            result = await db.execute(
+                select(Chat.id)
+                .where(Chat.id.in_(candidates))
+                .where(Chat.shard == shard)
+                .where(Chat.created_at < datetime.now(timezone.utc) - older_than)
+            )
+            chat_ids = result.scalars().all()
+            if not chat_ids:
+                continue
+
+            # повторная проверка в самом DELETE — вдруг сообщение успели написать
+            result = await shard_db.execute(
+                delete(ChatMember)
+                .where(ChatMember.chat_id.in_(chat_ids))
+                .where(no_messages)
+                .returning(ChatMember.chat_id)
+            )
+            emptied = set(result.scalars().all())
+            await commit_shard(db, shard_db)
+
+        if emptied:
+            result = await db.execute(
+                delete(Chat).where(Chat.id.in_(emptied))
+                .execution_options(synchronize_session=False)
+            )
+            deleted += result.rowcount
+    return deleted
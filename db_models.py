@@ -1,7 +1,10 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Text, func
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, ForeignKey, Date, DateTime, Text, Index, UniqueConstraint, func
 from sqlalchemy.orm import relationship
 from db_conf import Base
+import os
 import secrets
+import threading
+import time
 from datetime import datetime
 
 #-------------------
@@ -27,6 +30,21 @@ class User(Base):
     sent_messages = relationship("Message", back_populates="sender", foreign_keys='Message.sender_id')
     received_messages = relationship("Message", back_populates="recipient", foreign_keys='Message.recipient_id')
 
+    # индексы для /user/search, только для PostgreSQL (нужно расширение pg_trgm)
+    __table_args__ = (
+        Index(
+            "ix_users_username_lower_pattern",
+            func.lower(username).label("username_lower"),
+            postgresql_ops={"username_lower": "text_pattern_ops"},
+        ).ddl_if(dialect="postgresql"),
+        Index(
+            "ix_users_username_trgm",
+            username,
+            postgresql_using="gin",
+            postgresql_ops={"username": "gin_trgm_ops"},
+        ).ddl_if(dialect="postgresql"),
+    )
+
 
 
 class RefreshToken(Base):
@@ -36,6 +54,7 @@ class RefreshToken(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     token_hash = Column(String, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    expires_at = Column(DateTime(timezone=True), nullable=True, index=True)
 
     user = relationship("User", backref="refresh_tokens")
 
@@ -44,10 +63,50 @@ class RefreshToken(Base):
 #-------------------
 # chats & messages
 #-------------------
+
+# id сообщений генерируем в приложении, а не автоинкрементом шарда:
+# они уникальны между шардами и не меняются при переносе чата.
+# Раскладка как у snowflake, но в 53 бита, чтобы id точно передавался
+# числом в JSON (Number в браузере): 32 бита секунд | 10 бит узла | 11 бит счётчика.
+# Больше 2048 id в секунду на процесс — берём секунды вперёд.
+# MESSAGE_ID_NODE — номер процесса 0..1023; не задан — случайный.
+_MESSAGE_ID_EPOCH = 1_704_067_200  # 2024-01-01 UTC
+_MESSAGE_ID_NODE_BITS = 10
+_MESSAGE_ID_SEQ_BITS = 11
+_message_id_node = int(os.getenv("MESSAGE_ID_NODE", secrets.randbits(_MESSAGE_ID_NODE_BITS))) \
+    & ((1 << _MESSAGE_ID_NODE_BITS) - 1)
+_message_id_lock = threading.Lock()
+_message_id_last = 0
+_message_id_seq = 0
+
+def generate_message_id():
+    global _message_id_last, _message_id_seq
+    with _message_id_lock:
+        now = int(time.time()) - _MESSAGE_ID_EPOCH
+        if now <= _message_id_last:
+            now = _message_id_last
+            _message_id_seq = (_message_id_seq + 1) & ((1 << _MESSAGE_ID_SEQ_BITS) - 1)
+            if _message_id_seq == 0:
+                # счётчик за эту секунду кончился — берём следующую
+                now += 1
+        else:
+            _message_id_seq = 0
+        _message_id_last = now
+        return (
+            (now << (_MESSAGE_ID_NODE_BITS + _MESSAGE_ID_SEQ_BITS))
+            | (_message_id_node << _MESSAGE_ID_SEQ_BITS)
+            | _message_id_seq
+        )
+
+def first_message_id_at(timestamp: float) -> int:
+    """Наименьший id, который мог быть выдан в момент timestamp (секунды)"""
+    return max(int(timestamp) - _MESSAGE_ID_EPOCH, 0) << (_MESSAGE_ID_NODE_BITS + _MESSAGE_ID_SEQ_BITS)
+
+
 class Message(Base):
     __tablename__ = "messages"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(BigInteger, primary_key=True, index=True, autoincrement=False, default=generate_message_id)
     sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     recipient_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     content = Column(Text, nullable=False)
@@ -60,13 +119,32 @@ class Message(Base):
     chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False)
     chat = relationship("Chat", back_populates="messages")
 
+    # (chat_id, id): история и выгрузка чата по id, последнее сообщение чата
+    # (max(id) ... group by chat_id для receipts) и перенос между шардами —
+    # всё читается по индексу, без сортировки всей истории
+    __table_args__ = (
+        Index("ix_messages_chat_id_id", chat_id, id),
+    )
+
 
 
 class Chat(Base):
+    """
+    Строка чата — это справочник в глобальной базе: где лежит чат (shard)
+    и кто в нём (пара user_low_id < user_high_id для личных чатов).
+    Участники и сообщения лежат в базе шарда.
+    """
     __tablename__ = "chats"
 
     id = Column(Integer, primary_key=True, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    shard = Column(Integer, nullable=False, default=0, server_default="0")
+    user_low_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    user_high_id = Column(Integer, ForeignKey("users.id"), nullable=True, index=True)
+
+    __table_args__ = (
+        UniqueConstraint("user_low_id", "user_high_id", name="uq_chats_user_pair"),
+    )
 
     members = relationship("ChatMember", back_populates="chat")
     messages = relationship("Message", back_populates="chat")
@@ -78,8 +156,102 @@ class ChatMember(Base):
     __tablename__ = "chat_members"
 
     id = Column(Integer, primary_key=True)
-    chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False)
+    chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    # до какого сообщения участник прочитал чат; пишется пачками (receipts.py)
+    last_read_message_id = Column(BigInteger, nullable=True)
     
     chat = relationship("Chat", back_populates="members")
     user = relationship("User", backref="chats")
+
+
+
+#-------------------
+# attachments
+#-------------------
+
+def generate_attachment_id():
+    return secrets.token_hex(8)
+
+class Attachment(Base):
+    __tablename__ = "attachments"
+
+    id = Column(Integer, primary_key=True, index=True)
+    public_id = Column(String, unique=True, index=True, default=generate_attachment_id)
+    sha256 = Column(String(64), index=True, nullable=False)  # ключ в content-addressed хранилище
+    size = Column(BigInteger, nullable=False)
+    content_type = Column(String, nullable=False, default="application/octet-stream")
+    filename = Column(String, nullable=True)
+    uploader_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    # пока файл не прикреплён к сообщению — оба поля NULL.
+    # message_id без FK: сообщения лежат в базе шарда
+    message_id = Column(BigInteger, nullable=True, index=True)
+    chat_id = Column(Integer, ForeignKey("chats.id"), nullable=True)
+
+    uploader = relationship("User")
+
+
+
+#-------------------
+# notifications
+#-------------------
+
+class NotificationOutbox(Base):
+    """
+    Transactional outbox: строка пишется в той же транзакции, что и сообщение,
+    доставкой уведомлений занимается отдельный диспетчер.
+    Лежит в базе шарда рядом с сообщениями
+    """
+    __tablename__ = "notification_outbox"
+
+    id = Column(Integer, primary_key=True)
+    recipient_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    message_id = Column(BigInteger, nullable=False)
+    chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+
+
+#-------------------
+# stats rollups
+#-------------------
+# Счётчики для админских дашбордов, лежат в глобальной базе.
+# Заполняет их агрегатор (stats.py), по самим messages дашборды не ходят
+
+class DailyStats(Base):
+    __tablename__ = "stats_daily"
+
+    day = Column(Date, primary_key=True)
+    messages = Column(BigInteger, nullable=False, default=0)
+
+
+class UserDailyStats(Base):
+    # строка на каждого писавшего в этот день — отсюда же число активных пользователей
+    __tablename__ = "stats_user_daily"
+
+    day = Column(Date, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    messages = Column(BigInteger, nullable=False, default=0)
+
+
+class ChatStats(Base):
+    __tablename__ = "stats_chats"
+
+    chat_id = Column(Integer, primary_key=True)
+    messages = Column(BigInteger, nullable=False, default=0, index=True)
+    last_message_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class StatsWatermark(Base):
+    """До какого id сообщения шард уже учтён в счётчиках"""
+    __tablename__ = "stats_watermarks"
+
+    shard = Column(Integer, primary_key=True)
+    last_message_id = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
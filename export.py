@@ -0,0 +1,192 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import zipfile
+from datetime import datetime
+from pathlib import Path
+from typing import AsyncIterator
+from uuid import uuid4
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from auth import redis_client
+from crud import get_current_user_chats_by_public_id, get_user_by_id, get_user_chat_shards, stream_chat_messages
+from db_conf import AsyncSessionLocal
+from db_models import User
+from sharding import shard_map
+
+
+logger = logging.getLogger(__name__)
+
+# Экспорт всех чатов пользователя в NDJSON: сначала строки type=chat, потом
+# type=message по чатам. Прерванную выгрузку можно продолжить с after_chat_id/after_id.
+#
+# Фоновые выгрузки: состояние задачи лежит в Redis, архивы — в EXPORT_DIR,
+# который должен быть общим для всех воркеров (статус и скачивание могут
+# прийти не в тот воркер, что делает выгрузку).
+EXPORT_DIR = Path(os.getenv("EXPORT_DIR", "media/exports"))
+EXPORT_BATCH = 1000  # строк из курсора за раз
+CHUNK_SIZE = 64 * 1024  # байт в одном куске ответа
+EXPORT_TTL = 24 * 60 * 60  # секунд храним готовые архивы и их задачи
+EXPORT_LOCK_TTL = 60 * 60  # секунд, страховка на случай падения воркера посреди выгрузки
+MAX_RUNNING_EXPORTS = 2  # одновременных выгрузок на воркер, каждая держит соединение с базой
+
+JOB_KEY_PREFIX = "export:job:"
+ACTIVE_KEY_PREFIX = "export:active:"
+
+# остальные задачи ждут в статусе pending
+_running = asyncio.Semaphore(MAX_RUNNING_EXPORTS)
+
+
+def _line(record: dict) -> str:
+    return json.dumps(
+        record,
+        ensure_ascii=False,
+        default=lambda value: value.isoformat() if isinstance(value, datetime) else str(value),
+    ) + "\n"
+
+
+async def export_lines(db: AsyncSession, user: User, after_chat_id: int = 0,
+                       after_id: int = 0) -> AsyncIterator[str]:
+    chats = await get_current_user_chats_by_public_id(db=db, user=user)
+    chats.sort(key=lambda chat: chat["chat_id"])
+
+    if after_chat_id == 0 and after_id == 0:
+        for chat in chats:
+            yield _line({
+                "type": "chat",
+                "chat_id": chat["chat_id"],
+                "created_at": chat["created_at"],
+                "peer_public_id": chat["peer_public_id"],
+                "peer_username": chat["peer_username"],
+            })
+
+    # сообщения лежат в шардах — выгружаем чат за чатом по возрастанию chat_id,
+    # внутри чата по возрастанию id
+    shards = await get_user_chat_shards(db, user.id)
+    for chat in chats:
+        chat_id = chat["chat_id"]
+        if chat_id < after_chat_id or chat_id not in shards:
+            continue
+        peer = chat["peer_public_id"]
+        start_id = after_id if chat_id == after_chat_id else 0
+
+        async with shard_map.session(db, shards[chat_id]) as shard_db:
+            async for row in stream_chat_messages(shard_db, chat_id, start_id, EXPORT_BATCH):
+                yield _line({
+                    "type": "message",
+                    "id": row.id,
+                    "chat_id": row.chat_id,
+                    "sender_public_id": user.public_id if row.sender_id == user.id else peer,
+                    "recipient_public_id": user.public_id if row.recipient_id == user.id else peer,
+                    "content": row.content,
+                    "created_at": row.created_at,
+                })
+
+
+async def export_chunks(db: AsyncSession, user: User, after_chat_id: int = 0,
+                        after_id: int = 0) -> AsyncIterator[bytes]:
+    # склеиваем строки в куски, чтобы не делать send на каждое сообщение
+    buffer: list[str] = []
+    size = 0
+    async for line in export_lines(db, user, after_chat_id, after_id):
+        buffer.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield "".join(buffer).encode()
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+
+def export_path(job_id: str) -> Path:
+    return EXPORT_DIR / f"{job_id}.zip"
+
+
+class ExportJobStore:
+    """
+    Задачи выгрузки в Redis: хэш со статусом живёт EXPORT_TTL, плюс лок
+    "у пользователя уже идёт выгрузка" — не больше одной задачи на пользователя
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    async def create(self, user_id: int) -> str | None:
+        """None, если у пользователя уже есть незавершённая выгрузка"""
+        job_id = uuid4().hex
+        if not await self.redis.set(ACTIVE_KEY_PREFIX + str(user_id), job_id, nx=True, ex=EXPORT_LOCK_TTL):
+            return None
+        key = JOB_KEY_PREFIX + job_id
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={"user_id": user_id, "status": "pending", "created_at": time.time()})
+            pipe.expire(key, EXPORT_TTL)
+            await pipe.execute()
+        return job_id
+
+    async def get(self, job_id: str) -> dict | None:
+        job = await self.redis.hgetall(JOB_KEY_PREFIX + job_id)
+        if not job:
+            return None
+        return {"user_id": int(job["user_id"]), "status": job["status"], "created_at": float(job["created_at"])}
+
+    async def set_status(self, job_id: str, status: str):
+        await self.redis.hset(JOB_KEY_PREFIX + job_id, "status", status)
+
+    async def finish(self, job_id: str, user_id: int, status: str):
+        await self.set_status(job_id, status)
+        await self.redis.delete(ACTIVE_KEY_PREFIX + str(user_id))
+
+
+export_jobs = ExportJobStore(redis_client)
+
+
+async def run_export_job(job_id: str, user_id: int):
+    """Фоновая выгрузка в zip на диск — для больших аккаунтов"""
+    status = "failed"
+    try:
+        async with _running:
+            await export_jobs.set_status(job_id, "running")
+            await run_in_threadpool(EXPORT_DIR.mkdir, parents=True, exist_ok=True)
+            tmp_path = export_path(job_id).with_suffix(".part")
+            try:
+                async with AsyncSessionLocal() as db:
+                    user = await get_user_by_id(db, user_id)
+
+                    archive = await run_in_threadpool(zipfile.ZipFile, tmp_path, "w", zipfile.ZIP_DEFLATED)
+                    try:
+                        entry = await run_in_threadpool(archive.open, "messages.ndjson", "w", force_zip64=True)
+                        async for chunk in export_chunks(db, user):
+                            await run_in_threadpool(entry.write, chunk)
+                        await run_in_threadpool(entry.close)
+                    finally:
+                        await run_in_threadpool(archive.close)
+
+                os.replace(tmp_path, export_path(job_id))
+                status = "done"
+            except Exception:
+                logger.exception("Export job %s failed", job_id)
+                tmp_path.unlink(missing_ok=True)
+    finally:
+        try:
+            await export_jobs.finish(job_id, user_id, status)
+        except Exception:
+            logger.exception("Cannot store status of export job %s", job_id)
+
+
+async def sweep_export_files() -> int:
+    """
+    Удаляем архивы старше EXPORT_TTL и брошенные .part. Задачи в Redis
+    истекают сами; каталог общий, поэтому ориентируемся на mtime файла
+    """
+    expired_before = time.time() - EXPORT_TTL
+    removed = 0
+    for path in EXPORT_DIR.glob("*"):
+        if path.suffix in (".zip", ".part") and path.stat().st_mtime < expired_before:
+            path.unlink(missing_ok=True)
+            removed += 1
+    return removed
@@ -1,8 +1,17 @@
+from sqlalchemy import text
 from db_conf import engine, Base
 from db_models import User, Message  # импортируем все модели
+from schema import upgrade_schema
 
 async def init_db():
     async with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            # для триграммного индекса поиска по username
+            await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
         # создаёт все таблицы, которых ещё нет
         await conn.run_sync(Base.metadata.create_all)
+        # и доводит существующие до моделей: колонки, BIGINT id, индексы
+        changes = await conn.run_sync(upgrade_schema, Base.metadata)
+    for change in changes:
+        print(f"Schema upgrade: {change}")
     print("Tables checked/created successfully!")
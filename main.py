@@ -1,9 +1,10 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Query
+from fastapi import FastAPI, Depends, HTTPException, status, Query, Request, BackgroundTasks
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
-#from websocket_router import router as ws_router
+from websocket_router import router as ws_router
 
 from sqlalchemy.ext.asyncio import AsyncSession
 from jose import jwt, JWTError
@@ -17,24 +18,59 @@ from crud import create_message, get_or_create_private_chat, get_chat_messages
 from init_db import init_db
 from db_conf import get_db
 from crud import get_current_user_chats_by_public_id
-from crud import get_all_users, get_user_by_id, get_user_by_public_id, create_user, delete_user, get_messages_between
+from crud import get_all_users, get_user_by_id, get_user_by_public_id, get_public_user, search_users, create_user, delete_user, get_messages_between
 from crud import get_refresh_tokens_by_user
-from crud import save_refresh_token_hash
-from crud import revoke_user_refresh_tokens
+from crud import login_user, logout_user, update_user
+from crud import create_attachment, get_attachment_by_public_id, get_attachments_for_messages, can_access_attachment
+from crud import get_daily_stats, get_top_chats, get_top_users, get_stats_watermarks
+from crud import get_private_chat, get_read_cursors, add_read_cursors
+from maintenance import scheduler
+from singleflight import groups as single_flight_groups
+from admission import admit, get_limiter, readmit, release_admission, limiters as admission_limiters
+from profiling import profile_request, profiles
+from notifications import dispatcher as notification_dispatcher
+from sharding import shard_map
+from websocket_router import reaper as ws_reaper, chat_events, connection_stats, broadcast
+from receipts import read_receipts
+from presence import activity
+from export import export_chunks, export_jobs, export_path, run_export_job
+from attachments import store_stream, blob_path, MAX_ATTACHMENT_SIZE
 from models import UserCreate, MessageCreate, UserRead, MessageRead, NewMessageRead, UserIsAdminRead, UserUpdate
+from models import AttachmentRead, MessageSend, ReadCursorUpdate
 from auth import (
     auth_user,
     get_current_user,
     create_access_token,
     create_refresh_token,
     hash_password,
-    check_rate_limit
+    check_rate_limit,
+    admin_check,
+    oauth2_scheme,
+    revocation_list,
+    revoke_access_token
 )
 from db_models import User, Message
 
 
 
-app = FastAPI(title="Welcome to the chat buddy...")
+# profile_request — профилирование запроса по флагу, только для админа
+app = FastAPI(title="Welcome to the chat buddy...", dependencies=[Depends(profile_request)])
+
+SEARCH_MAX_RESULTS = 20
+STATS_MAX_DAYS = 366
+STATS_MAX_RESULTS = 100
+
+# Admission control по группам роутов: (одновременно в работе, размер очереди).
+# В сумме держим около размера пула SQLAlchemy (5 + 10 overflow по умолчанию)
+ADMIT_ADMIN = admit("admin", 2, 5)
+ADMIT_AUTH = admit("auth", 4, 50)
+ADMIT_USER = admit("user", 4, 100)
+ADMIT_SEARCH = admit("search", 2, 20)
+ADMIT_CHAT = admit("chat", 4, 100)
+ADMIT_ATTACHMENTS = admit("attachments", 2, 20)
+ADMIT_EXPORT = admit("export", 2, 10)
+# тела загрузок пишутся на диск без базы — у них свой лимит
+UPLOAD_LIMITER = get_limiter("uploads", 8, 50)
 
 
 app.add_middleware(
@@ -47,13 +83,33 @@ app.add_middleware(
 
 
 
-#app.include_router(ws_router)
+app.include_router(ws_router)
 
 
 
 @app.on_event("startup")
 async def on_startup():
     await init_db()
+    await shard_map.create_tables()
+    await revocation_list.start()
+    scheduler.start()
+    notification_dispatcher.start()
+    ws_reaper.start()
+    chat_events.start()
+    read_receipts.start()
+    activity.start()
+
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await chat_events.stop()
+    await read_receipts.stop()
+    await activity.stop()
+    await ws_reaper.stop()
+    await notification_dispatcher.stop()
+    await scheduler.stop()
+    await revocation_list.stop()
 
 
 
@@ -66,19 +122,9 @@ def main_page():
 
 # ----------- -- For Admin -----------
 
-def admin_check(current_user: User = Depends(get_current_user)) -> User:
-    if not current_user.is_admin:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Access denied"
-        )
-    return current_user
-
-
-
 
 
-@app.get("/admin/users", tags=["Admin"], response_model=list[UserIsAdminRead])
+@app.get("/admin/users", tags=["Admin"], dependencies=[ADMIT_ADMIN], response_model=list[UserIsAdminRead])
 async def read_all_users(db: AsyncSession = Depends(get_db), current_user: User = Depends(admin_check)):
     """Список всех пользователей (только для администратора)"""
     return await get_all_users(db)
@@ -86,11 +132,132 @@ async def read_all_users(db: AsyncSession = Depends(get_db), current_user: User
 
 
 
+@app.get("/admin/maintenance", tags=["Admin"], dependencies=[ADMIT_ADMIN])
+async def read_maintenance_stats(current_user: User = Depends(admin_check)):
+    """Статистика фоновых задач по всем воркерам: число запусков, длительность и количество строк"""
+    return await scheduler.read_stats()
+
+
+
+
+@app.get("/admin/coalescing", tags=["Admin"], dependencies=[ADMIT_ADMIN])
+async def read_coalescing_stats(current_user: User = Depends(admin_check)):
+    """Сколько вызовов read-хелперов было склеено или отдано из кэша"""
+    return {name: group.stats for name, group in single_flight_groups.items()}
+
+
+
+
+# ---------------- admin stats ----------------
+# Только из таблиц-счётчиков (stats.py), по messages не ходим.
+# Отстают от реального времени на интервал задачи stats_rollup
+
+
+
+@app.get("/admin/stats/daily", tags=["Admin"], dependencies=[ADMIT_ADMIN])
+async def read_daily_stats(
+    days: int = Query(30, ge=1, le=STATS_MAX_DAYS),
+    current_user: User = Depends(admin_check),
+    db: AsyncSession = Depends(get_db)
+):
+    """Сообщений и активных пользователей по дням"""
+    since = datetime.now(timezone.utc).date() - timedelta(days=days - 1)
+    return await get_daily_stats(db, since)
+
+
+
+@app.get("/admin/stats/chats", tags=["Admin"], dependencies=[ADMIT_ADMIN])
+async def read_top_chats(
+    limit: int = Query(10, ge=1, le=STATS_MAX_RESULTS),
+    current_user: User = Depends(admin_check),
+    db: AsyncSession = Depends(get_db)
+):
+    """Самые активные чаты за всё время"""
+    return await get_top_chats(db, limit)
+
+
+
+@app.get("/admin/stats/users", tags=["Admin"], dependencies=[ADMIT_ADMIN])
+async def read_top_users(
+    days: int = Query(7, ge=1, le=STATS_MAX_DAYS),
+    limit: int = Query(10, ge=1, le=STATS_MAX_RESULTS),
+    current_user: User = Depends(admin_check),
+    db: AsyncSession = Depends(get_db)
+):
+    """Самые активные пользователи за последние days дней"""
+    since = datetime.now(timezone.utc).date() - timedelta(days=days - 1)
+    return await get_top_users(db, since, limit)
+
+
+
+@app.get("/admin/stats/watermarks", tags=["Admin"], dependencies=[ADMIT_ADMIN])
+async def read_stats_watermarks(
+    current_user: User = Depends(admin_check),
+    db: AsyncSession = Depends(get_db)
+):
+    """До какого сообщения учтён каждый шард"""
+    return await get_stats_watermarks(db)
+
+
+
+
+@app.get("/admin/admission", tags=["Admin"])
+async def read_admission_stats(current_user: User = Depends(admin_check)):
+    """Загрузка лимитеров: сколько запросов в работе, в очереди и сколько отбито"""
+    return {name: limiter.snapshot() for name, limiter in admission_limiters.items()}
+
+
+
+
+@app.get("/admin/connections", tags=["Admin"])
+async def read_connection_stats(
+    limit: int = Query(50, ge=0, le=1000),
+    current_user: User = Depends(admin_check)
+):
+    """Вебсокеты этого воркера: сколько открыто, очереди на отправку и оценка памяти"""
+    return connection_stats(limit)
+
+
+
+
+@app.get("/admin/profiles", tags=["Admin"])
+async def read_profiles(current_user: User = Depends(admin_check)):
+    """Последние снятые профили запросов (без стеков)"""
+    return [
+        {key: value for key, value in profile.items() if key != "stacks"}
+        for profile in await profiles.recent()
+    ]
+
+
+
+@app.get("/admin/profiles/{profile_id}", tags=["Admin"])
+async def read_profile(profile_id: str, current_user: User = Depends(admin_check)):
+    profile = await profiles.get(profile_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile
+
+
+
+@app.get("/admin/profiles/{profile_id}/stacks", tags=["Admin"])
+async def download_profile_stacks(profile_id: str, current_user: User = Depends(admin_check)):
+    """Стеки в формате collapsed файлом — для flamegraph.pl / speedscope"""
+    profile = await profiles.get(profile_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(
+        "\n".join(profile["stacks"]) + "\n",
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.folded"'},
+    )
+
+
+
+
 
 
 # ---------------- AUTH ----------------
 
-@app.post("/auth/register", tags=["Auth"])
+@app.post("/auth/register", tags=["Auth"], dependencies=[ADMIT_AUTH])
 async def register(user: UserCreate, db: AsyncSession = Depends(get_db)):
     """Регистрация нового пользователя"""
     user.password = hash_password(user.password)
@@ -98,7 +265,7 @@ async def register(user: UserCreate, db: AsyncSession = Depends(get_db)):
     return db_user
 
 
-@app.post("/auth/login", tags=["Auth"])
+@app.post("/auth/login", tags=["Auth"], dependencies=[ADMIT_AUTH])
 async def login(
     form_data: OAuth2PasswordRequestForm = Depends(),
     db: AsyncSession = Depends(get_db)
@@ -114,18 +281,13 @@ async def login(
             detail="Incorrect username or password"
         )
         
-    user.is_online = True
-    user.last_active = datetime.utcnow()
-    db.add(user)
-    await db.commit()
-    await db.refresh(user)
-
     access_token = create_access_token(data={"sub": user.username})
     refresh_token = create_refresh_token(data={"sub": user.username})
     
-    # Сохраняем хэш в БД
+    # Онлайн-статус и хэш refresh токена сохраняем одной транзакцией
     refresh_token_hash = hash_password(refresh_token)
-    await save_refresh_token_hash(db, user.id, refresh_token_hash)
+    refresh_expires_at = datetime.now(timezone.utc) + timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)
+    await login_user(db, user, refresh_token_hash, refresh_expires_at)
     
     return {
         "access_token": access_token,
@@ -134,23 +296,22 @@ async def login(
     }
 
 
-@app.post("/auth/logout", tags=["Auth"])
-async def logout(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
-    """Выход — удаляем все refresh токены пользователя"""
-    #from crud import revoke_user_refresh_tokens
-    current_user.is_online = False
-    current_user.last_active = datetime.utcnow()
-    db.add(current_user)
-    await db.commit()
-    await db.refresh(current_user)
-    
-    await revoke_user_refresh_tokens(db, current_user.id)
+@app.post("/auth/logout", tags=["Auth"], dependencies=[ADMIT_AUTH])
+async def logout(
+    current_user: User = Depends(get_current_user),
+    token: str = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_db)
+):
+    """Выход — удаляем все refresh токены пользователя и отзываем текущий access токен"""
+    activity.forget(current_user.id)
+    await logout_user(db, current_user)
+    await revoke_access_token(token)
     return {"detail": "Logged out successfully"}
 
 
 
 
-@app.post("/refresh")
+@app.post("/refresh", dependencies=[ADMIT_AUTH])
 async def refresh_token_endpoint(
     refresh_token: str,
     db: AsyncSession = Depends(get_db)
@@ -213,7 +374,7 @@ async def refresh_token_endpoint(
 
 
 #Профиль пользователя
-@app.get("/user/profile/me", tags=["User"])
+@app.get("/user/profile/me", tags=["User"], dependencies=[ADMIT_USER])
 async def get_me(
     current_user: User = Depends(get_current_user), 
     ):
@@ -225,7 +386,7 @@ async def get_me(
 
 
 
-@app.patch("/user/profile/me", tags=["User"])
+@app.patch("/user/profile/me", tags=["User"], dependencies=[ADMIT_USER])
 async def update_me(
     user_update: UserUpdate,
     current_user: User = Depends(get_current_user),
@@ -235,35 +396,42 @@ async def update_me(
     update_data = user_update.model_dump(exclude_unset=True)
 
     # Обновляем
-    for key, value in update_data.items():
-        setattr(current_user, key, value)
+    updated_user = await update_user(db, current_user, update_data)
 
-    db.add(current_user)
-    await db.commit()
-    await db.refresh(current_user)
-
-    user = UserRead.model_validate(current_user)
+    user = UserRead.model_validate(updated_user)
     return user.model_dump(exclude_none=True)
 
 
 
 
+#Поиск пользователей по username (автодополнение)
+@app.get("/user/search", tags=["User"], dependencies=[ADMIT_SEARCH], response_model=list[UserRead])
+async def find_users(
+    q: str = Query(..., min_length=1, max_length=64),
+    limit: int = Query(10, ge=1, le=SEARCH_MAX_RESULTS),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    return await search_users(db, q, limit)
+
+
+
 #Найти пользователя по публичному айди
-@app.get("/user/public/{public_id}", tags=["User"], response_model=UserRead)
+@app.get("/user/public/{public_id}", tags=["User"], dependencies=[ADMIT_USER], response_model=UserRead)
 async def find_user_by_public_id(public_id: str, db: AsyncSession = Depends(get_db)):
-    user = await get_user_by_public_id(db, public_id)
+    user = await get_public_user(db, public_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
 
 
-@app.get("/user/{public_id}/status", tags=["User"])
+@app.get("/user/{public_id}/status", tags=["User"], dependencies=[ADMIT_USER])
 async def get_user_status(public_id: str, db: AsyncSession = Depends(get_db)):
-    user = await get_user_by_public_id(db, public_id)
+    user = await get_public_user(db, public_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return {"public_id": user.public_id, "is_online": user.is_online}
+    return {"public_id": user["public_id"], "is_online": user["is_online"]}
 
 
 
@@ -273,18 +441,65 @@ async def get_user_status(public_id: str, db: AsyncSession = Depends(get_db)):
 
 
 
-@app.get("/chat/list", tags=["Chat"])
+@app.get("/chat/list", tags=["Chat"], dependencies=[ADMIT_CHAT])
 async def get_chats_list(
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     chats = await get_current_user_chats_by_public_id(db=db, user=current_user)
-    return chats
+    # курсоры прочтения — свой и собеседника
+    return await add_read_cursors(db, current_user.id, chats)
+
+
+
+async def get_peer_chat(public_id: str, current_user: User, db: AsyncSession):
+    recipient = await get_user_by_public_id(db, public_id)
+    if not recipient:
+        raise HTTPException(status_code=404, detail="User not found")
+    chat = await get_private_chat(db, current_user.id, recipient.id)
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    return chat, recipient
+
+
+
+@app.get("/chat/{public_id}/read", tags=["Chat"], dependencies=[ADMIT_CHAT])
+async def get_read_cursors_for_chat(
+    public_id: str,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """До какого сообщения прочитали чат вы и собеседник"""
+    chat, recipient = await get_peer_chat(public_id, current_user, db)
+    cursors = await get_read_cursors(db, {chat.id: chat.shard})
+    return {
+        "chat_id": chat.id,
+        "last_read_message_id": cursors.get((chat.id, current_user.id)),
+        "peer_last_read_message_id": cursors.get((chat.id, recipient.id)),
+    }
+
+
+
+@app.post("/chat/{public_id}/read", tags=["Chat"], dependencies=[ADMIT_CHAT], status_code=202)
+async def mark_chat_read(
+    public_id: str,
+    body: ReadCursorUpdate,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Отметить прочитанным до message_id. Как и событие read по вебсокету:
+    в базу курсор попадёт со следующей пачкой, собеседник получит receipts.
+    message_id больше последнего сообщения чата обрезается до него
+    """
+    chat, _ = await get_peer_chat(public_id, current_user, db)
+    chat_events.receipt("read", chat.id, current_user.id, body.message_id)
+    return {"detail": "Accepted"}
 
 
 
 #Получить историю чата с другим пользователем
-@app.get("/chat/{public_id}/history", tags=["Chat"], response_model=List[NewMessageRead])
+@app.get("/chat/{public_id}/history", tags=["Chat"], dependencies=[ADMIT_CHAT], response_model=List[NewMessageRead])
 async def get_chat_history(
     public_id: str,
     current_user: User = Depends(get_current_user),
@@ -298,21 +513,18 @@ async def get_chat_history(
 
     chat = await get_or_create_private_chat(db=db, user1_id=current_user.id, user2_id=recipient.id)
 
-    stmt = (
-        select(Message, User.username, User.public_id)
-        .join(User, Message.sender_id == User.id)
-        .where(Message.chat_id == chat.id)
-        .order_by(Message.created_at)
-    )
-    result = await db.execute(stmt)
-    rows = result.all()
+    # сообщения лежат в шарде чата; участников всего двое — отправителя берём из них
+    rows = await get_chat_messages(db, chat)
+
+    # вложения отдаём ссылками, одним запросом на всю историю
+    attachments = await get_attachments_for_messages(db, [msg.id for msg in rows])
 
     messages = []    
-    for msg, sender_username, sender_public_id in rows:
+    for msg in rows:
         if msg.sender_id == current_user.id:
-            recipient_user = recipient
+            sender_user, recipient_user = current_user, recipient
         else:
-            recipient_user = current_user
+            sender_user, recipient_user = recipient, current_user
 
         messages.append({
             "id": msg.id,
@@ -320,10 +532,11 @@ async def get_chat_history(
             "sender_id": msg.sender_id,
             "content": msg.content,
             "created_at": msg.created_at,
-            "sender_username": sender_username,
-            "sender_public_id": sender_public_id,
+            "sender_username": sender_user.username,
+            "sender_public_id": sender_user.public_id,
             "recipient_username": recipient_user.username,
             "recipient_public_id": recipient_user.public_id,
+            "attachments": attachments.get(msg.id, []),
         })
 
     return messages
@@ -331,10 +544,104 @@ async def get_chat_history(
 
 
 
-# IN WORK..........
+# ---------------- attachments ----------------
+
+
+
+@app.post("/attachments", tags=["Attachments"], dependencies=[ADMIT_ATTACHMENTS], response_model=AttachmentRead, status_code=201)
+async def upload_attachment(
+    request: Request,
+    filename: Optional[str] = Query(None),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Загрузка файла сырым телом запроса, читаем его потоком по чанкам"""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_ATTACHMENT_SIZE:
+        raise HTTPException(status_code=413, detail="Attachment is too large")
+
+    # пока читаем тело, не держим ни соединение с базой, ни слот лимитера базы:
+    # медленный клиент иначе занимает место на всё время загрузки.
+    # Одновременных загрузок не больше, чем пускает UPLOAD_LIMITER
+    await db.close()
+    release_admission(request)
+    async with UPLOAD_LIMITER.slot():
+        sha256, size = await store_stream(request.stream())
+    content_type = request.headers.get("content-type") or "application/octet-stream"
+
+    # вставка снова через лимитер базы. Если места нет (503), файл уже в
+    # хранилище — повторная загрузка того же содержимого его переиспользует
+    await readmit(request)
+    return await create_attachment(db, current_user.id, sha256, size, content_type, filename)
+
+
+
+@app.get("/attachments/{public_id}", tags=["Attachments"], dependencies=[ADMIT_ATTACHMENTS])
+async def download_attachment(
+    public_id: str,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Скачивание вложения. FileResponse сам обрабатывает Range и отдаёт файл через sendfile, если сервер умеет"""
+    attachment = await get_attachment_by_public_id(db, public_id)
+    if not attachment or not await can_access_attachment(db, attachment, current_user.id):
+        raise HTTPException(status_code=404, detail="Attachment not found")
+
+    # файл может отдаваться долго — соединение с базой и слот лимитера
+    # отпускаем сразу, teardown зависимостей наступил бы только после отправки
+    await db.close()
+    release_admission(request)
+    return FileResponse(
+        blob_path(attachment.sha256),
+        media_type=attachment.content_type,
+        filename=attachment.filename or attachment.public_id,
+        # содержимое по хэшу не меняется
+        headers={"Cache-Control": "private, max-age=31536000, immutable"},
+    )
+
+
+
+
 #Написать пользователю
-#Через вебсокет
-#@app.post("/chat/{public_id}/send", response_model=MessageRead)
+@app.post("/chat/{public_id}/messages", tags=["Chat"], dependencies=[ADMIT_CHAT], response_model=NewMessageRead, status_code=201)
+async def send_message(
+    public_id: str,
+    message: MessageSend,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Отправить сообщение. attachment_ids — файлы, заранее загруженные через
+    POST /attachments; прикрепляются в той же транзакции. Открытым сокетам
+    чата уходит событие type=message
+    """
+    if not message.content and not message.attachment_ids:
+        raise HTTPException(status_code=400, detail="Empty message")
+
+    recipient = await get_user_by_public_id(db, public_id)
+    if not recipient:
+        raise HTTPException(status_code=404, detail="User not found")
+    if recipient.id == current_user.id:
+        raise HTTPException(status_code=400, detail="Cannot chat with yourself")
+
+    msg = await create_message(db, current_user, recipient, message.content, message.attachment_ids)
+    attachments = await get_attachments_for_messages(db, [msg.id]) if message.attachment_ids else {}
+
+    result = NewMessageRead.model_validate({
+        "id": msg.id,
+        "content": msg.content,
+        "created_at": msg.created_at,
+        "sender_username": current_user.username,
+        "sender_public_id": current_user.public_id,
+        "recipient_username": recipient.username,
+        "recipient_public_id": recipient.public_id,
+        "attachments": [AttachmentRead.model_validate(a) for a in attachments.get(msg.id, [])],
+    })
+    await broadcast(msg.chat_id, {"type": "message", "chat_id": msg.chat_id, "message": result.model_dump(mode="json")})
+    return result
+
+
 #пОЛУЧИТЬ СООБЩЕНИЯ от пользователя
 #Через вебсокет
 
@@ -344,5 +651,69 @@ async def get_chat_history(
 
 
 
+# ---------------- export ----------------
+
+
+
+@app.get("/export/chats", tags=["Export"], dependencies=[ADMIT_EXPORT])
+async def export_chats(
+    after_chat_id: int = Query(0, ge=0),
+    after_id: int = Query(0, ge=0),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Все чаты пользователя потоком в NDJSON. Если выгрузка оборвалась —
+    повторить с after_chat_id/after_id = chat_id/id последнего полученного сообщения
+    """
+    return StreamingResponse(
+        export_chunks(db, current_user, after_chat_id, after_id),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="chats.ndjson"'},
+    )
+
+
+
+@app.post("/export/jobs", tags=["Export"], dependencies=[ADMIT_EXPORT], status_code=202)
+async def create_export_job(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Фоновая выгрузка в zip для больших аккаунтов. Одна незавершённая задача на пользователя"""
+    job_id = await export_jobs.create(current_user.id)
+    if job_id is None:
+        raise HTTPException(status_code=429, detail="Export is already in progress")
+    # BackgroundTasks выполняются внутри запроса, до teardown зависимостей:
+    # без этого вся выгрузка держала бы слот лимитера и соединение get_current_user.
+    # У задачи своя сессия, а одновременных выгрузок не больше MAX_RUNNING_EXPORTS
+    await db.close()
+    release_admission(request)
+    background_tasks.add_task(run_export_job, job_id, current_user.id)
+    return {"job_id": job_id, "status": "pending"}
+
+
+
+async def _get_export_job(job_id: str, current_user: User) -> dict:
+    job = await export_jobs.get(job_id)
+    if not job or job["user_id"] != current_user.id:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    return job
+
+
+
+@app.get("/export/jobs/{job_id}", tags=["Export"])
+async def read_export_job(job_id: str, current_user: User = Depends(get_current_user)):
+    job = await _get_export_job(job_id, current_user)
+    return {"job_id": job_id, "status": job["status"]}
+
+
 
+@app.get("/export/jobs/{job_id}/download", tags=["Export"])
+async def download_export(job_id: str, current_user: User = Depends(get_current_user)):
+    job = await _get_export_job(job_id, current_user)
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail="Export is not ready")
+    return FileResponse(export_path(job_id), media_type="application/zip", filename="chats.zip")
 
@@ -0,0 +1,87 @@
+import asyncio
+from datetime import timedelta
+from typing import Awaitable, Callable
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from attachments import remove_blob
+from auth import redis_client
+from config import settings
+from crud import delete_expired_refresh_tokens, reset_stale_online_flags, delete_orphan_chats
+from crud import delete_unattached_attachments, get_referenced_hashes
+from db_conf import AsyncSessionLocal
+from export import sweep_export_files
+from scheduler import Scheduler
+from sharding import shard_map
+from stats import rollup_batch
+
+
+BATCH_SIZE = 500
+BATCH_PAUSE = 0.2  # секунд между пачками, чтобы не нагружать базу
+MAX_BATCHES = 200  # за один запуск, остальное доделает следующий
+
+PRESENCE_TIMEOUT = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
+ORPHAN_CHAT_TTL = timedelta(days=1)
+UNATTACHED_TTL = timedelta(days=1)  # сколько ждём, пока загруженный файл прикрепят к сообщению
+
+
+async def run_in_batches(step: Callable[[AsyncSession], Awaitable[int]]) -> int:
+    """Каждая пачка — отдельная короткая транзакция"""
+    total = 0
+    for _ in range(MAX_BATCHES):
+        async with AsyncSessionLocal() as db:
+            count = await step(db)
+            await db.commit()
+
+        total += count
+        if count < BATCH_SIZE:
+            break
+        await asyncio.sleep(BATCH_PAUSE)
+    return total
+
+
+async def sweep_refresh_tokens() -> int:
+    max_age = timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)
+    return await run_in_batches(lambda db: delete_expired_refresh_tokens(db, max_age, BATCH_SIZE))
+
+
+async def sweep_presence() -> int:
+    return await run_in_batches(lambda db: reset_stale_online_flags(db, PRESENCE_TIMEOUT, BATCH_SIZE))
+
+
+async def sweep_orphan_chats() -> int:
+    return await run_in_batches(lambda db: delete_orphan_chats(db, ORPHAN_CHAT_TTL, BATCH_SIZE))
+
+
+
+async def sweep_unattached_attachments() -> int:
+    """Строки удаляем пачками, файлы — после коммита и только те, на которые больше никто не ссылается"""
+    orphaned: set[str] = set()
+
+    async def step(db: AsyncSession) -> int:
+        hashes = await delete_unattached_attachments(db, UNATTACHED_TTL, BATCH_SIZE)
+        orphaned.update(set(hashes) - await get_referenced_hashes(db, hashes))
+        return len(hashes)
+
+    removed = await run_in_batches(step)
+    for sha256 in orphaned:
+        await run_in_threadpool(remove_blob, sha256, UNATTACHED_TTL.total_seconds())
+    return removed
+
+
+
+async def rollup_stats() -> int:
+    total = 0
+    for shard in range(len(shard_map)):
+        total += await run_in_batches(lambda db, shard=shard: rollup_batch(db, shard, BATCH_SIZE))
+    return total
+
+
+scheduler = Scheduler(redis_client)
+scheduler.add_job("refresh_tokens", sweep_refresh_tokens, interval=60 * 60)
+scheduler.add_job("presence", sweep_presence, interval=5 * 60)
+scheduler.add_job("orphan_chats", sweep_orphan_chats, interval=6 * 60 * 60)
+scheduler.add_job("unattached_attachments", sweep_unattached_attachments, interval=6 * 60 * 60)
+scheduler.add_job("stats_rollup", rollup_stats, interval=60)
+scheduler.add_job("export_files", sweep_export_files, interval=60 * 60)
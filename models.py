@@ -46,6 +46,17 @@ class UserIsAdminRead(UserBase):
     class Config:
         orm_mode = True
     
+# ------------------- ATTACHMENTS -------------------
+class AttachmentRead(BaseModel):
+    public_id: str
+    filename: Optional[str] = None
+    content_type: str
+    size: int
+    sha256: str
+
+    model_config = {"from_attributes": True}
+
+
 # ------------------- MESSAGES -------------------
 class MessageBase(BaseModel):
     id: int
@@ -74,6 +85,16 @@ class NewMessageRead(MessageBase):
     recipient_username: str
     recipient_public_id: str
     created_at: datetime             
+    attachments: list[AttachmentRead] = []
 
     class Config:
         orm_mode = True
+
+
+class MessageSend(BaseModel):
+    content: str = ""
+    attachment_ids: list[str] = Field(default=[], max_length=10)  # public_id из POST /attachments
+
+
+class ReadCursorUpdate(BaseModel):
+    message_id: int = Field(gt=0)
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Callable
+
+from starlette.concurrency import run_in_threadpool
+
+from crud import fetch_due_notifications, delete_notifications, reschedule_notifications
+from sharding import shard_map
+from websocket_router import is_user_in_chat
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 200
+POLL_INTERVAL = 2  # секунд, когда outbox пуст
+MAX_ATTEMPTS = 8
+RETRY_BASE_DELAY = 5  # секунд, дальше удваивается с каждой попыткой
+RETRY_MAX_DELAY = 60 * 60
+
+NOTIFICATIONS_FILE = Path(os.getenv("NOTIFICATIONS_FILE", "media/notifications.ndjson"))
+
+
+# ---------------- sinks ----------------
+# Sink получает одно уведомление на получателя со всеми его новыми сообщениями.
+# Ошибка в send — сигнал повторить позже.
+
+class NotificationSink(ABC):
+    @abstractmethod
+    async def send(self, recipient_id: int, notification: dict):
+        ...
+
+
+class InMemorySink(NotificationSink):
+    def __init__(self):
+        self.sent: list[tuple[int, dict]] = []
+
+    async def send(self, recipient_id: int, notification: dict):
+        self.sent.append((recipient_id, notification))
+
+
+class FileSink(NotificationSink):
+    """Пишет уведомления строками NDJSON в локальный файл"""
+
+    def __init__(self, path: Path = NOTIFICATIONS_FILE):
+        self.path = path
+
+    def _write(self, line: str):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+    async def send(self, recipient_id: int, notification: dict):
+        line = json.dumps({"recipient_id": recipient_id, **notification}, ensure_ascii=False) + "\n"
+        await run_in_threadpool(self._write, line)
+
+
+# ---------------- dispatcher ----------------
+
+def _coalesce(rows) -> dict:
+    """Строки outbox одного получателя → одно уведомление"""
+    chats: dict[int, dict] = {}
+    for row in rows:
+        chat = chats.setdefault(row.chat_id, {"chat_id": row.chat_id, "messages": 0, "sender_ids": []})
+        chat["messages"] += 1
+        chat["last_message_id"] = max(chat.get("last_message_id", 0), row.message_id)
+        if row.sender_id not in chat["sender_ids"]:
+            chat["sender_ids"].append(row.sender_id)
+    return {"messages": len(rows), "chats": list(chats.values())}
+
+
+class OutboxDispatcher:
+    def __init__(
+        self,
+        sink: NotificationSink,
+        is_connected: Callable[[int, int], bool] = lambda user_id, chat_id: False,
+    ):
+        self.sink = sink
+        # (user_id, chat_id): у получателя открыт сокет этого чата — сообщение
+        # уже пришло, не уведомляем. Сокет другого чата не в счёт
+        self.is_connected = is_connected
+        self.stats = {"notifications": 0, "skipped_online": 0, "failed": 0, "dropped": 0}
+        self._task: asyncio.Task | None = None
+
+    async def dispatch_batch(self, shard: int = 0) -> int:
+        # outbox лежит в шардах чатов, каждый разбираем отдельно
+        async with shard_map.sessionmakers[shard]() as db:
+            rows = await fetch_due_notifications(db, BATCH_SIZE)
+            if not rows:
+                return 0
+
+            by_recipient: dict[int, list] = {}
+            for row in rows:
+                by_recipient.setdefault(row.recipient_id, []).append(row)
+
+            done, retry, dropped = [], {}, []
+            for recipient_id, recipient_rows in by_recipient.items():
+                offline = []
+                for row in recipient_rows:
+                    if self.is_connected(recipient_id, row.chat_id):
+                        self.stats["skipped_online"] += 1
+                        done.append(row.id)
+                    else:
+                        offline.append(row)
+                if not offline:
+                    continue
+                recipient_rows = offline
+
+                ids = [row.id for row in recipient_rows]
+
+                try:
+                    await self.sink.send(recipient_id, _coalesce(recipient_rows))
+                except Exception:
+                    logger.exception("Notification for user %s failed", recipient_id)
+                    self.stats["failed"] += 1
+                    attempts = max(row.attempts for row in recipient_rows) + 1
+                    if attempts >= MAX_ATTEMPTS:
+                        dropped.extend(ids)
+                    else:
+                        retry.setdefault(attempts, []).extend(ids)
+                    continue
+
+                self.stats["notifications"] += 1
+                done.extend(ids)
+
+            if dropped:
+                logger.error("Dropping %d notifications after %d attempts", len(dropped), MAX_ATTEMPTS)
+                self.stats["dropped"] += len(dropped)
+
+            await delete_notifications(db, done + dropped)
+            now = datetime.now(timezone.utc)
+            for attempts, ids in retry.items():
+                delay = min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY)
+                await reschedule_notifications(db, ids, now + timedelta(seconds=delay))
+            await db.commit()
+
+        return len(rows)
+
+    async def _run(self):
+        while True:
+            full_batch = False
+            for shard in range(len(shard_map)):
+                try:
+                    processed = await self.dispatch_batch(shard)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("Outbox dispatcher failed on shard %d", shard)
+                    processed = 0
+                full_batch = full_batch or processed >= BATCH_SIZE
+
+            # хоть одна полная пачка — сразу за следующей, иначе ждём
+            if not full_batch:
+                await asyncio.sleep(POLL_INTERVAL)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+dispatcher = OutboxDispatcher(FileSink(), is_connected=is_user_in_chat)
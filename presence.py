@@ -0,0 +1,75 @@
+import asyncio
+import logging
+
+from crud import touch_users
+from db_conf import AsyncSessionLocal
+
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 30  # секунд между записями last_active
+
+
+class ActivityTracker:
+    """
+    last_active для фоновой чистки онлайн-статусов. Активность (запрос с
+    access токеном, живой сокет) только отмечается в памяти, а в базу уходит
+    одним UPDATE раз в FLUSH_INTERVAL — без лишней записи на каждый запрос
+    """
+
+    def __init__(self):
+        self._pending: set[int] = set()
+        self.stats = {"flushed": 0, "failed": 0}
+        self._task: asyncio.Task | None = None
+
+    def touch(self, user_id: int):
+        self._pending.add(user_id)
+
+    def forget(self, user_id: int):
+        """После выхода старая отметка не должна вернуть пользователя в онлайн"""
+        self._pending.discard(user_id)
+
+    async def flush(self) -> int:
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, set()
+
+        try:
+            async with AsyncSessionLocal() as db:
+                await touch_users(db, pending)
+                await db.commit()
+        except Exception:
+            self._pending |= pending
+            self.stats["failed"] += 1
+            raise
+
+        self.stats["flushed"] += len(pending)
+        return len(pending)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Activity flush failed")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Activity flush failed on shutdown")
+
+
+activity = ActivityTracker()
@@ -0,0 +1,232 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from uuid import uuid4
+
+from fastapi import Depends, HTTPException, Response
+from fastapi.security.utils import get_authorization_scheme_param
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.requests import HTTPConnection
+
+from auth import get_current_user, redis_client
+from db_conf import get_db
+from sharding import shard_map
+
+
+logger = logging.getLogger(__name__)
+
+# Профилирование одного запроса по требованию админа:
+# заголовок "X-Profile: 1" или ?profile=1
+PROFILE_HEADER = "X-Profile"
+PROFILE_QUERY_PARAM = "profile"
+
+SAMPLE_INTERVAL = 0.001  # секунд между снимками стека
+MAX_STACK_DEPTH = 64
+MAX_STORED_PROFILES = 50
+PROFILE_TTL = 24 * 60 * 60  # секунд храним отчёт
+N_PLUS_ONE_THRESHOLD = 2  # одинаковый SQL столько раз за запрос — кандидат в N+1
+
+PROFILE_KEY_PREFIX = "profile:"
+RECENT_PROFILES_KEY = "profiles:recent"
+
+_current_trace: ContextVar["SqlTrace | None"] = ContextVar("sql_trace", default=None)
+
+
+class SqlTrace:
+    def __init__(self):
+        self.statements: list[tuple[str, float]] = []
+
+    def summary(self) -> dict:
+        counts = Counter(statement for statement, _ in self.statements)
+        times = Counter()
+        for statement, duration in self.statements:
+            times[statement] += duration
+
+        duplicates = [
+            {"statement": statement, "count": count, "time": round(times[statement], 6)}
+            for statement, count in counts.most_common()
+            if count >= N_PLUS_ONE_THRESHOLD
+        ]
+        return {
+            "count": len(self.statements),
+            "time": round(sum(times.values()), 6),
+            "duplicates": duplicates,
+        }
+
+
+# Хуки движка: пишут SQL только если в текущем контексте включена трассировка
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_trace.get() is not None:
+        conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = _current_trace.get()
+    if trace is not None and conn.info.get("profile_query_start"):
+        started = conn.info["profile_query_start"].pop()
+        trace.statements.append((statement, time.perf_counter() - started))
+
+
+def trace_engine(async_engine):
+    """Подключить хуки к движку; повторный вызов ничего не меняет"""
+    sync_engine = async_engine.sync_engine
+    if not event.contains(sync_engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+# глобальная база и все шарды: история и список чатов читаются из шардов
+for _engine in shard_map.engines:
+    trace_engine(_engine)
+
+
+class ProfileStore:
+    """
+    Отчёты в Redis с TTL: X-Profile-Id приходит от одного воркера, а
+    /admin/profiles/{id} может попасть в другой. Список последних — sorted set
+    по времени, в нём держим не больше MAX_STORED_PROFILES id
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    async def save(self, profile: dict):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(PROFILE_KEY_PREFIX + profile["id"], json.dumps(profile, default=str), ex=PROFILE_TTL)
+            pipe.zadd(RECENT_PROFILES_KEY, {profile["id"]: time.time()})
+            pipe.zremrangebyrank(RECENT_PROFILES_KEY, 0, -MAX_STORED_PROFILES - 1)
+            pipe.expire(RECENT_PROFILES_KEY, PROFILE_TTL)
+            await pipe.execute()
+
+    async def get(self, profile_id: str) -> dict | None:
+        data = await self.redis.get(PROFILE_KEY_PREFIX + profile_id)
+        return json.loads(data) if data else None
+
+    async def recent(self) -> list[dict]:
+        """Новые первыми; истёкшие отчёты пропускаем"""
+        ids = await self.redis.zrevrange(RECENT_PROFILES_KEY, 0, -1)
+        if not ids:
+            return []
+        values = await self.redis.mget([PROFILE_KEY_PREFIX + profile_id for profile_id in ids])
+        return [json.loads(value) for value in values if value]
+
+
+profiles = ProfileStore(redis_client)
+
+
+class SamplingProfiler:
+    """
+    Отдельный поток раз в SAMPLE_INTERVAL снимает стек потока event loop.
+    В снимки могут попасть и другие запросы, которые идут параллельно в этом же воркере.
+    """
+
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def collapsed(self) -> list[str]:
+        # формат collapsed stacks — понимают flamegraph.pl и speedscope
+        return [f"{stack} {count}" for stack, count in self.samples.most_common()]
+
+
+def is_profiling_requested(connection: HTTPConnection) -> bool:
+    return (
+        connection.headers.get(PROFILE_HEADER) == "1"
+        or connection.query_params.get(PROFILE_QUERY_PARAM) == "1"
+    )
+
+
+async def _is_admin(connection: HTTPConnection, db: AsyncSession) -> bool:
+    scheme, token = get_authorization_scheme_param(connection.headers.get("Authorization"))
+    if scheme.lower() != "bearer" or not token:
+        return False
+    try:
+        user = await get_current_user(token, db)
+    except HTTPException:
+        return False
+    return bool(user.is_admin)
+
+
+async def profile_request(connection: HTTPConnection, response: Response, db: AsyncSession = Depends(get_db)):
+    """
+    Глобальная зависимость приложения. Без флага ничего не делает.
+    С флагом от админа — снимает профиль и SQL трассу запроса,
+    отчёт кладёт в profiles, id отдаёт в заголовке X-Profile-Id.
+    Флаг от остальных игнорируется: запрос обрабатывается как обычный.
+    """
+    if connection.scope["type"] != "http" or not is_profiling_requested(connection):
+        yield
+        return
+
+    if not await _is_admin(connection, db):
+        yield
+        return
+
+    profile_id = uuid4().hex
+    response.headers["X-Profile-Id"] = profile_id
+
+    trace = SqlTrace()
+    trace_token = _current_trace.set(trace)
+    profiler = SamplingProfiler(threading.get_ident())
+    started_at = datetime.now(timezone.utc)
+    started = time.perf_counter()
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        _current_trace.reset(trace_token)
+        try:
+            await _store(profile_id, connection, started_at, time.perf_counter() - started, trace, profiler)
+        except Exception:
+            logger.exception("Cannot store profile %s", profile_id)
+
+
+async def _store(profile_id: str, connection: HTTPConnection, started_at: datetime, duration: float,
+                 trace: SqlTrace, profiler: SamplingProfiler):
+    sql = trace.summary()
+    path = connection.url.path
+    for duplicate in sql["duplicates"]:
+        logger.warning(
+            "Possible N+1 in %s %s: %d x %s",
+            connection.scope.get("method"), path, duplicate["count"], duplicate["statement"],
+        )
+
+    await profiles.save({
+        "id": profile_id,
+        "method": connection.scope.get("method"),
+        "path": path,
+        "started_at": started_at.isoformat(),
+        "duration": round(duration, 6),
+        "sql": sql,
+        "samples": sum(profiler.samples.values()),
+        "stacks": profiler.collapsed(),
+    })
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+
+from crud import get_chat_shards, update_read_cursors
+from db_conf import AsyncSessionLocal
+from sharding import shard_map, commit_shard
+
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 2  # секунд между записями курсоров в базу
+
+
+class ReadCursorBuffer:
+    """
+    Курсоры "прочитано до" копятся в памяти (на участника — только максимум)
+    и пишутся в chat_members одной пачкой на шард раз в FLUSH_INTERVAL.
+    Сотня отметок о прочтении в секунду превращается в одно UPDATE-executemany
+    """
+
+    def __init__(self):
+        self._pending: dict[tuple[int, int], int] = {}
+        self.stats = {"marked": 0, "flushed": 0, "failed": 0}
+        self._task: asyncio.Task | None = None
+
+    def mark(self, chat_id: int, user_id: int, message_id: int):
+        key = (chat_id, user_id)
+        if message_id > self._pending.get(key, 0):
+            self._pending[key] = message_id
+        self.stats["marked"] += 1
+
+    async def flush(self) -> int:
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+
+        try:
+            async with AsyncSessionLocal() as db:
+                shards = await get_chat_shards(db, {chat_id for chat_id, _ in pending})
+                by_shard: dict[int, dict] = {}
+                for (chat_id, user_id), message_id in pending.items():
+                    if chat_id in shards:
+                        by_shard.setdefault(shards[chat_id], {})[(chat_id, user_id)] = message_id
+
+                for shard, cursors in by_shard.items():
+                    async with shard_map.session(db, shard) as shard_db:
+                        await update_read_cursors(shard_db, cursors)
+                        await commit_shard(db, shard_db)
+                await db.commit()
+        except Exception:
+            # вернём в буфер: курсор только растёт, повторная запись безвредна
+            for (chat_id, user_id), message_id in pending.items():
+                key = (chat_id, user_id)
+                self._pending[key] = max(self._pending.get(key, 0), message_id)
+            self.stats["failed"] += 1
+            raise
+
+        self.stats["flushed"] += len(pending)
+        return len(pending)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Read cursors flush failed")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # не теряем то, что накопилось с последней записи
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Read cursors flush failed on shutdown")
+
+
+read_receipts = ReadCursorBuffer()
@@ -0,0 +1,113 @@
+import asyncio
+import hashlib
+import logging
+import math
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Отозванные access токены (по jti) лежат в Redis с TTL до истечения токена.
+# Каждый воркер держит локальный bloom-фильтр, поэтому обычная проверка
+# "не отозван" обходится без похода в Redis. В Redis идём только при попадании в фильтр.
+REVOKED_KEY_PREFIX = "revoked_jti:"
+REVOKED_CHANNEL = "revoked_jti"
+
+BLOOM_CAPACITY = 100_000
+BLOOM_ERROR_RATE = 0.001
+REBUILD_INTERVAL = 5 * 60  # секунд, пересборка выкидывает из фильтра истёкшие jti
+RECONNECT_DELAY = 5  # секунд
+
+
+class BloomFilter:
+    def __init__(self, capacity: int = BLOOM_CAPACITY, error_rate: float = BLOOM_ERROR_RATE):
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        # двойное хэширование: k позиций из двух 64-битных половин одного blake2b
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class RevocationList:
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.bloom = BloomFilter()
+        self._listener: asyncio.Task | None = None
+
+    async def revoke(self, jti: str, expires_at: int):
+        ttl = expires_at - int(time.time())
+        if ttl <= 0:
+            return  # токен и так уже не примут
+
+        await self.redis.set(REVOKED_KEY_PREFIX + jti, 1, ex=ttl)
+        await self.redis.publish(REVOKED_CHANNEL, jti)
+        self.bloom.add(jti)
+
+    async def is_revoked(self, jti: str) -> bool:
+        if jti not in self.bloom:
+            return False
+
+        # попадание в фильтр может быть ложным — подтверждаем в Redis
+        try:
+            return await self.redis.exists(REVOKED_KEY_PREFIX + jti) == 1
+        except Exception:
+            logger.exception("Revocation check failed, rejecting token %s", jti)
+            return True
+
+    async def start(self):
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+
+    async def _rebuild(self):
+        bloom = BloomFilter()
+        async for key in self.redis.scan_iter(match=REVOKED_KEY_PREFIX + "*", count=1000):
+            bloom.add(key[len(REVOKED_KEY_PREFIX):])
+        self.bloom = bloom
+
+    async def _listen(self):
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                # сначала подписываемся, потом пересобираем — так ничего не теряется:
+                # сообщения, пришедшие во время пересборки, разберём сразу после неё
+                await pubsub.subscribe(REVOKED_CHANNEL)
+                await self._rebuild()
+                next_rebuild = time.monotonic() + REBUILD_INTERVAL
+
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message and message["type"] == "message":
+                        self.bloom.add(message["data"])
+
+                    if time.monotonic() >= next_rebuild:
+                        await self._rebuild()
+                        next_rebuild = time.monotonic() + REBUILD_INTERVAL
+
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Revocation listener failed, reconnecting")
+                await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                await pubsub.aclose()
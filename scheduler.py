@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable
+from uuid import uuid4
+
+from redis.exceptions import WatchError
+
+
+logger = logging.getLogger(__name__)
+
+LOCK_PREFIX = "scheduler:lock:"
+STATS_PREFIX = "scheduler:stats:"
+LOCK_RENEW_FRACTION = 3  # продлеваем лок каждые interval / 3, пока задача идёт
+
+
+class Job:
+    def __init__(self, name: str, func: Callable[[], Awaitable[int]], interval: float, leader: bool = True):
+        self.name = name
+        self.func = func  # возвращает количество обработанных строк
+        self.interval = interval
+        self.leader = leader  # False — job крутится в каждом воркере
+
+
+class Scheduler:
+    """
+    Фоновые задачи внутри процесса. Для leader-задач берём лок в Redis
+    на интервал и продлеваем его, пока задача выполняется: задачу в один
+    момент выполняет только один воркер, даже если она дольше интервала.
+    После завершения лок доживает до конца интервала (чаще раза за интервал
+    задача не запускается), а если интервал уже прошёл — снимается сразу.
+    Статистика запусков тоже в Redis — /admin/maintenance видит её из любого воркера.
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.jobs: list[Job] = []
+        self._tasks: list[asyncio.Task] = []
+        self._worker_id = uuid4().hex
+
+    def add_job(self, name: str, func: Callable[[], Awaitable[int]], interval: float, leader: bool = True):
+        self.jobs.append(Job(name, func, interval, leader))
+
+    def start(self):
+        if self._tasks:
+            return
+        for job in self.jobs:
+            self._tasks.append(asyncio.create_task(self._loop(job)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _acquire(self, job: Job) -> bool:
+        if not job.leader:
+            return True
+        return bool(await self.redis.set(
+            LOCK_PREFIX + job.name, self._worker_id, nx=True, px=int(job.interval * 1000)
+        ))
+
+    async def _if_owner(self, job: Job, action: Callable) -> bool:
+        """Выполнить action(pipe) над локом, только если он всё ещё наш"""
+        key = LOCK_PREFIX + job.name
+        async with self.redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key)
+                if await pipe.get(key) != self._worker_id:
+                    return False
+                pipe.multi()
+                action(pipe, key)
+                await pipe.execute()
+                return True
+            except WatchError:
+                return False
+
+    async def _renew(self, job: Job):
+        while True:
+            await asyncio.sleep(job.interval / LOCK_RENEW_FRACTION)
+            try:
+                renewed = await self._if_owner(job, lambda pipe, key: pipe.pexpire(key, int(job.interval * 1000)))
+            except Exception:
+                logger.exception("Scheduler: cannot renew lock for %s", job.name)
+                continue
+            if not renewed:
+                logger.warning("Scheduler: lost lock for %s while running", job.name)
+                return
+
+    async def _release(self, job: Job, started: float):
+        remaining = job.interval - (time.monotonic() - started)
+        if remaining > 0:
+            await self._if_owner(job, lambda pipe, key: pipe.pexpire(key, max(int(remaining * 1000), 1)))
+        else:
+            await self._if_owner(job, lambda pipe, key: pipe.delete(key))
+
+    async def _loop(self, job: Job):
+        while True:
+            await asyncio.sleep(job.interval)
+            try:
+                if await self._acquire(job):
+                    await self.run_job(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Scheduler: cannot acquire lock for %s", job.name)
+
+    async def run_job(self, job: Job):
+        """Выполнить задачу; для leader-задачи лок должен быть уже взят (_acquire)"""
+        started_at = time.monotonic()
+        renew = asyncio.create_task(self._renew(job)) if job.leader else None
+        started = time.perf_counter()
+        try:
+            rows = await job.func()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await self.redis.hincrby(STATS_PREFIX + job.name, "errors", 1)
+            logger.exception("Scheduler: job %s failed", job.name)
+            return
+        finally:
+            if renew is not None:
+                renew.cancel()
+                await asyncio.gather(renew, return_exceptions=True)
+                try:
+                    await self._release(job, started_at)
+                except Exception:
+                    logger.exception("Scheduler: cannot release lock for %s", job.name)
+
+        duration = time.perf_counter() - started
+        async with self.redis.pipeline(transaction=True) as pipe:
+            key = STATS_PREFIX + job.name
+            pipe.hincrby(key, "runs", 1)
+            pipe.hset(key, mapping={
+                "last_run": datetime.now(timezone.utc).isoformat(),
+                "last_duration": round(duration, 4),
+                "last_rows": rows,
+                "last_worker": self._worker_id,
+            })
+            await pipe.execute()
+        logger.info("Scheduler: job %s processed %d rows in %.3fs", job.name, rows, duration)
+
+    async def read_stats(self) -> dict[str, dict]:
+        stats = {}
+        for job in self.jobs:
+            data = await self.redis.hgetall(STATS_PREFIX + job.name)
+            stats[job.name] = {
+                "runs": int(data.get("runs", 0)),
+                "errors": int(data.get("errors", 0)),
+                "last_run": data.get("last_run"),
+                "last_duration": float(data["last_duration"]) if "last_duration" in data else None,
+                "last_rows": int(data["last_rows"]) if "last_rows" in data else None,
+                "last_worker": data.get("last_worker"),
+            }
+        return stats
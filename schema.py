@@ -0,0 +1,93 @@
+import logging
+
+from sqlalchemy import BigInteger, Connection, MetaData, UniqueConstraint, inspect, text
+
+
+logger = logging.getLogger(__name__)
+
+# create_all создаёт только недостающие таблицы и существующие не трогает.
+# upgrade_schema доводит уже существующие таблицы до моделей:
+#   - добавляет недостающие колонки (nullable или с server_default);
+#   - расширяет INTEGER → BIGINT (messages.id под id из generate_message_id)
+#     и убирает SERIAL-default у колонок, которые приложение заполняет само;
+#   - создаёт недостающие индексы и уникальные ограничения.
+# Повторный запуск ничего не меняет. Вызывается из init_db (глобальная база,
+# на старте приложения) и из `python sharding.py init` (базы шардов).
+# Колонки не удаляет и типы не сужает — это только ручной миграцией.
+
+# любой постоянный ключ: несколько воркеров на старте не мигрируют одновременно
+_ADVISORY_LOCK_KEY = 0x57434853
+
+
+def _add_column_sql(conn: Connection, table, column) -> str:
+    dialect = conn.dialect
+    spec = f"{dialect.identifier_preparer.quote(column.name)} {column.type.compile(dialect=dialect)}"
+    if column.server_default is not None:
+        spec += f" DEFAULT {column.server_default.arg}"
+    if not column.nullable:
+        if column.server_default is None:
+            raise RuntimeError(f"Cannot add NOT NULL column {table.name}.{column.name} without server_default")
+        spec += " NOT NULL"
+    for fk in column.foreign_keys:
+        spec += f" REFERENCES {fk.column.table.name} ({fk.column.name})"
+    return f"ALTER TABLE {table.name} ADD COLUMN {spec}"
+
+
+def _add_unique_sql(conn: Connection, constraint: UniqueConstraint) -> str:
+    columns = ", ".join(column.name for column in constraint.columns)
+    if conn.dialect.name == "sqlite":
+        # SQLite не умеет ADD CONSTRAINT, уникальный индекс работает так же
+        return f"CREATE UNIQUE INDEX {constraint.name} ON {constraint.table.name} ({columns})"
+    return f"ALTER TABLE {constraint.table.name} ADD CONSTRAINT {constraint.name} UNIQUE ({columns})"
+
+
+def upgrade_schema(conn: Connection, metadata: MetaData) -> list[str]:
+    """Для run_sync внутри engine.begin(). Возвращает выполненные изменения"""
+    postgres = conn.dialect.name == "postgresql"
+    if postgres:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _ADVISORY_LOCK_KEY})
+
+    inspector = inspect(conn)
+    existing_tables = set(inspector.get_table_names())
+    changes: list[str] = []
+
+    def execute(sql: str):
+        logger.info("Schema upgrade: %s", sql)
+        conn.execute(text(sql))
+        changes.append(sql)
+
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue  # новую таблицу целиком создаёт create_all
+
+        columns = {column["name"]: column for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            current = columns.get(column.name)
+            if current is None:
+                execute(_add_column_sql(conn, table, column))
+                continue
+            if not postgres:
+                continue  # в SQLite INTEGER и так 64-битный, а SERIAL нет
+            if isinstance(column.type, BigInteger) and current["type"].compile(dialect=conn.dialect) == "INTEGER":
+                execute(f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE BIGINT")
+            if column.autoincrement is False and str(current.get("default") or "").startswith("nextval("):
+                execute(f"ALTER TABLE {table.name} ALTER COLUMN {column.name} DROP DEFAULT")
+
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        uniques = {constraint["name"] for constraint in inspector.get_unique_constraints(table.name)}
+        for constraint in table.constraints:
+            if isinstance(constraint, UniqueConstraint) and constraint.name \
+                    and constraint.name not in uniques and constraint.name not in indexes:
+                execute(_add_unique_sql(conn, constraint))
+                indexes.add(constraint.name)
+        missing = [index for index in table.indexes if index.name not in indexes]
+        for index in missing:
+            # индексы с ddl_if(dialect=...) create сам пропустит на чужой базе
+            index.create(conn, checkfirst=True)
+        if missing:
+            created = {index["name"] for index in inspect(conn).get_indexes(table.name)} - indexes
+            for name in sorted(created):
+                logger.info("Schema upgrade: create index %s", name)
+                changes.append(f"CREATE INDEX {name}")
+
+    return changes
@@ -0,0 +1,328 @@
+import argparse
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from sqlalchemy import MetaData, select, insert, update, delete, func
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from config import settings
+from db_conf import engine, AsyncSessionLocal
+from db_models import Chat, ChatMember, Message, NotificationOutbox
+from init_db import init_db
+from schema import upgrade_schema
+
+
+# Шардирование чатов: участники, сообщения и outbox лежат в одной из N баз,
+# номер шарда хранится в строке чата (справочник в глобальной базе).
+# Пользователи и всё остальное — в глобальной базе (settings.DATABASE_URL).
+#
+# CHAT_SHARD_URLS — url баз шардов через запятую. Не задано — шард один,
+# и это сама глобальная база: всё работает как раньше, одной транзакцией.
+SHARD_URLS = [url.strip() for url in os.getenv("CHAT_SHARD_URLS", "").split(",") if url.strip()]
+
+SHARD_TABLES = [ChatMember.__table__, Message.__table__, NotificationOutbox.__table__]
+
+MOVE_BATCH = 1000
+MOVE_GRACE_PERIOD = 2  # секунд после переключения, чтобы дописались запоздавшие вставки
+
+
+def _shard_metadata() -> MetaData:
+    """Копии таблиц шарда без внешних ключей: все они ведут в глобальную базу"""
+    metadata = MetaData()
+    for table in SHARD_TABLES:
+        copy = table.to_metadata(metadata)
+        for fk in list(copy.foreign_key_constraints):
+            copy.constraints.discard(fk)
+        copy.foreign_keys.clear()
+        for column in copy.columns:
+            column.foreign_keys.clear()
+    return metadata
+
+
+class ShardMap:
+    def __init__(self, urls: list[str]):
+        self.engines = []
+        for url in urls or [settings.DATABASE_URL]:
+            self.engines.append(engine if url == settings.DATABASE_URL else create_async_engine(url))
+
+        self.sessionmakers = [
+            AsyncSessionLocal if shard_engine is engine
+            else sessionmaker(bind=shard_engine, class_=AsyncSession, expire_on_commit=False)
+            for shard_engine in self.engines
+        ]
+
+    def __len__(self):
+        return len(self.engines)
+
+    def shard_for_new_chat(self, user1_id: int, user2_id: int) -> int:
+        low, high = sorted((user1_id, user2_id))
+        return (low * 31 + high) % len(self.engines)
+
+    def is_global(self, shard: int) -> bool:
+        return self.engines[shard] is engine
+
+    @asynccontextmanager
+    async def session(self, db: AsyncSession, shard: int) -> AsyncIterator[AsyncSession]:
+        """
+        Сессия шарда. Если шард — та же база, что и db, отдаём db,
+        чтобы всё осталось одной транзакцией. Иначе — отдельная сессия,
+        коммитить её вызывающий должен сам (см. commit_shard).
+        """
+        if self.engines[shard] is db.bind:
+            yield db
+            return
+        async with self.sessionmakers[shard]() as session:
+            yield session
+
+    async def create_tables(self) -> list[str]:
+        """Создаёт таблицы шардов и доводит существующие до моделей (schema.upgrade_schema)"""
+        metadata = _shard_metadata()
+        changes = []
+        for shard, shard_engine in enumerate(self.engines):
+            if shard_engine is engine:
+                continue  # глобальную базу создаёт и обновляет init_db
+            async with shard_engine.begin() as conn:
+                await conn.run_sync(metadata.create_all)
+                for change in await conn.run_sync(upgrade_schema, metadata):
+                    changes.append(f"shard {shard}: {change}")
+        return changes
+
+
+async def commit_shard(db: AsyncSession, shard_db: AsyncSession):
+    """Коммит отдельной сессии шарда; если это та же сессия — коммитит вызывающий"""
+    if shard_db is not db:
+        await shard_db.commit()
+
+
+shard_map = ShardMap(SHARD_URLS)
+
+
+# ---------------- rebalancing ----------------
+# Перенос чата между шардами без остановки:
+# 1. копируем участников и сообщения пачками;
+# 2. переключаем chats.shard — новые сообщения пишутся уже в новый шард;
+# 3. ждём MOVE_GRACE_PERIOD и докопируем то, чего нет в новом шарде,
+#    затем удаляем из старого только то, что в новом точно есть; повторяем,
+#    пока старый шард не опустеет (не больше MOVE_TAIL_ROUNDS раз).
+# Докопируем по разности множеств, а не "id > последнего скопированного":
+# id выдаются до коммита на разных узлах, и сообщение с меньшим id может
+# закоммититься позже. id глобальные, поэтому при переносе не меняются.
+MOVE_TAIL_ROUNDS = 5
+
+
+async def _source_batches(source: AsyncSession, chat_id: int) -> AsyncIterator[list[dict]]:
+    after_id = 0
+    while True:
+        result = await source.execute(
+            select(Message.__table__)
+            .where(Message.chat_id == chat_id)
+            .where(Message.id > after_id)
+            .order_by(Message.id)
+            .limit(MOVE_BATCH)
+        )
+        rows = [dict(row) for row in result.mappings()]
+        if not rows:
+            return
+        yield rows
+        if len(rows) < MOVE_BATCH:
+            return
+        after_id = rows[-1]["id"]
+
+
+async def _present_on(target: AsyncSession, ids: list[int]) -> set[int]:
+    result = await target.execute(select(Message.id).where(Message.id.in_(ids)))
+    return set(result.scalars())
+
+
+async def _copy_missing_messages(source: AsyncSession, target: AsyncSession, chat_id: int) -> int:
+    copied = 0
+    async for rows in _source_batches(source, chat_id):
+        present = await _present_on(target, [row["id"] for row in rows])
+        missing = [row for row in rows if row["id"] not in present]
+        if missing:
+            await target.execute(insert(Message.__table__), missing)
+            await target.commit()
+            copied += len(missing)
+    return copied
+
+
+async def _delete_copied_messages(source: AsyncSession, target: AsyncSession, chat_id: int) -> int:
+    """Удаляет из старого шарда сообщения, которые есть в новом; возвращает, сколько осталось"""
+    remaining = 0
+    async for rows in _source_batches(source, chat_id):
+        ids = [row["id"] for row in rows]
+        present = await _present_on(target, ids)
+        if present:
+            await source.execute(delete(Message.__table__).where(Message.id.in_(present)))
+            await source.commit()
+        remaining += len(ids) - len(present)
+    return remaining
+
+
+async def _copy_members(source: AsyncSession, target: AsyncSession, chat_id: int):
+    """Копирует недостающих участников; у уже скопированных подтягивает курсор прочтения"""
+    members = ChatMember.__table__
+    result = await source.execute(select(members).where(members.c.chat_id == chat_id))
+    source_rows = {row["user_id"]: dict(row) for row in result.mappings()}
+
+    result = await target.execute(
+        select(members.c.user_id, members.c.last_read_message_id).where(members.c.chat_id == chat_id)
+    )
+    target_cursors = dict(result.all())
+
+    missing = [row for user_id, row in source_rows.items() if user_id not in target_cursors]
+    if missing:
+        await target.execute(
+            insert(members),
+            [{key: value for key, value in row.items() if key != "id"} for row in missing],
+        )
+
+    # курсор мог сдвинуться в старом шарде уже после первого копирования — берём максимум
+    for user_id, target_cursor in target_cursors.items():
+        source_cursor = source_rows.get(user_id, {}).get("last_read_message_id")
+        if source_cursor is not None and (target_cursor is None or source_cursor > target_cursor):
+            await target.execute(
+                update(members)
+                .where(members.c.chat_id == chat_id)
+                .where(members.c.user_id == user_id)
+                .values(last_read_message_id=source_cursor)
+            )
+    await target.commit()
+
+
+async def drain_chat(chat_id: int, source_shard: int, target_shard: int) -> int:
+    """
+    Докопировать и убрать из source_shard всё, что осталось от чата после переноса.
+    Возвращает, сколько сообщений ещё осталось в старом шарде
+    """
+    async with shard_map.sessionmakers[source_shard]() as source, \
+            shard_map.sessionmakers[target_shard]() as target:
+        remaining = 0
+        for _ in range(MOVE_TAIL_ROUNDS):
+            await asyncio.sleep(MOVE_GRACE_PERIOD)
+            await _copy_members(source, target, chat_id)
+            await _copy_missing_messages(source, target, chat_id)
+            remaining = await _delete_copied_messages(source, target, chat_id)
+            if remaining == 0:
+                break
+
+        if remaining:
+            # в старый шард всё ещё пишут — участников не трогаем, повторить drain позже
+            return remaining
+
+        await source.execute(delete(ChatMember.__table__).where(ChatMember.chat_id == chat_id))
+        await source.commit()
+        # строки outbox не переносим: диспетчер дочистит их в старом шарде
+        return 0
+
+
+async def move_chat(chat_id: int, target_shard: int) -> int:
+    async with AsyncSessionLocal() as db:
+        chat = await db.get(Chat, chat_id)
+        if chat is None:
+            raise ValueError(f"Chat {chat_id} not found")
+        source_shard = chat.shard
+        if source_shard == target_shard:
+            return 0
+
+        async with shard_map.sessionmakers[source_shard]() as source, \
+                shard_map.sessionmakers[target_shard]() as target:
+            await _copy_members(source, target, chat_id)
+            await _copy_missing_messages(source, target, chat_id)
+
+        await db.execute(update(Chat).where(Chat.id == chat_id).values(shard=target_shard))
+        await db.commit()
+
+    return await drain_chat(chat_id, source_shard, target_shard)
+
+
+async def backfill_chat_pairs() -> int:
+    """
+    Заполняет user_low_id/user_high_id у чатов, созданных до справочника
+    (по участникам из шарда, где лежит чат)
+    """
+    updated = 0
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(Chat.id, Chat.shard).where(Chat.user_low_id.is_(None)))
+        for chat_id, shard in result.all():
+            async with shard_map.session(db, shard) as shard_db:
+                members = await shard_db.execute(
+                    select(ChatMember.user_id).where(ChatMember.chat_id == chat_id).order_by(ChatMember.user_id)
+                )
+                user_ids = members.scalars().all()
+            if len(user_ids) != 2:
+                continue
+            await db.execute(
+                update(Chat).where(Chat.id == chat_id)
+                .values(user_low_id=user_ids[0], user_high_id=user_ids[1])
+            )
+            updated += 1
+        await db.commit()
+    return updated
+
+
+async def shard_sizes() -> list[int]:
+    sizes = []
+    async with AsyncSessionLocal() as db:
+        for shard in range(len(shard_map)):
+            result = await db.execute(select(func.count(Chat.id)).where(Chat.shard == shard))
+            sizes.append(result.scalar_one())
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat shards maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    move = commands.add_parser("move", help="move a chat to another shard online")
+    move.add_argument("chat_id", type=int)
+    move.add_argument("target_shard", type=int)
+
+    drain = commands.add_parser("drain", help="finish a move: copy and delete what is left in the old shard")
+    drain.add_argument("chat_id", type=int)
+    drain.add_argument("source_shard", type=int)
+    drain.add_argument("target_shard", type=int)
+
+    commands.add_parser(
+        "init",
+        help="create or upgrade tables: global DB and shards (new columns, BIGINT message ids, indexes); "
+             "run before backfill-pairs on an existing database",
+    )
+    commands.add_parser("backfill-pairs", help="fill chat user pairs for old chats")
+    commands.add_parser("sizes", help="number of chats per shard")
+
+    args = parser.parse_args()
+
+    async def run():
+        try:
+            if args.command == "move":
+                remaining = await move_chat(args.chat_id, args.target_shard)
+                print(f"Chat {args.chat_id} moved to shard {args.target_shard}")
+                if remaining:
+                    print(f"{remaining} messages are still being written to the old shard, "
+                          f"re-run: drain {args.chat_id} <old shard> {args.target_shard}")
+            elif args.command == "drain":
+                remaining = await drain_chat(args.chat_id, args.source_shard, args.target_shard)
+                print(f"{remaining} messages left in shard {args.source_shard}")
+            elif args.command == "init":
+                await init_db()
+                for change in await shard_map.create_tables():
+                    print(f"Schema upgrade: {change}")
+                print("Shard tables checked/created successfully!")
+            elif args.command == "backfill-pairs":
+                print(f"Updated {await backfill_chat_pairs()} chats")
+            elif args.command == "sizes":
+                for shard, size in enumerate(await shard_sizes()):
+                    print(f"shard {shard}: {size} chats")
+        finally:
+            for shard_engine in shard_map.engines:
+                await shard_engine.dispose()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
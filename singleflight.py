@@ -0,0 +1,105 @@
+import asyncio
+import functools
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+
+MAX_CACHE_ENTRIES = 10_000
+
+# все группы по имени функции — для метрик
+groups: dict[str, "SingleFlight"] = {}
+
+
+class SingleFlight:
+    """
+    Одновременные одинаковые запросы ждут один общий вызов.
+    Опционально результат кэшируется на ttl секунд, а None ("не найдено") — на negative_ttl.
+    """
+
+    def __init__(self, ttl: float = 0.0, negative_ttl: float = 0.0):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+        self._cache: dict[Hashable, tuple[float, Any]] = {}
+        self.stats = {"calls": 0, "executed": 0, "coalesced": 0, "cache_hits": 0, "negative_hits": 0}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        self.stats["calls"] += 1
+
+        cached = self._cache.get(key)
+        if cached is not None:
+            expires, value = cached
+            if expires > time.monotonic():
+                self.stats["cache_hits" if value is not None else "negative_hits"] += 1
+                return value
+            del self._cache[key]
+
+        while key in self._inflight:
+            future = self._inflight[key]
+            self.stats["coalesced"] += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # отменили ведущего — пробуем сами; отменили нас — пробрасываем
+                if not future.cancelled():
+                    raise
+                self.stats["coalesced"] -= 1
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        self.stats["executed"] += 1
+        try:
+            value = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as exc:
+            future.set_exception(exc)
+            future.exception()  # чтобы asyncio не ругался, если ждущих не было
+            raise
+        finally:
+            # invalidate() мог убрать ключ, пока шёл запрос — тогда не трогаем
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+                fresh = True
+            else:
+                fresh = False
+
+        future.set_result(value)
+        if fresh:
+            self._store(key, value)
+        return value
+
+    def _store(self, key: Hashable, value: Any):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        if ttl <= 0:
+            return
+        if len(self._cache) >= MAX_CACHE_ENTRIES:
+            # выкидываем самую старую запись
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[key] = (time.monotonic() + ttl, value)
+
+    def invalidate(self, key: Hashable):
+        self._cache.pop(key, None)
+        self._inflight.pop(key, None)
+
+
+def single_flight(ttl: float = 0.0, negative_ttl: float = 0.0):
+    """
+    Декоратор для read-функций из crud вида f(db, *args).
+    Ключ — аргументы без сессии, поэтому функция должна возвращать
+    не ORM-объекты, а обычные данные: результат делится между запросами.
+    """
+    def decorator(func):
+        group = SingleFlight(ttl=ttl, negative_ttl=negative_ttl)
+        groups[func.__name__] = group
+
+        @functools.wraps(func)
+        async def wrapper(db, *args):
+            return await group.do(args, lambda: func(db, *args))
+
+        wrapper.invalidate = lambda *args: group.invalidate(args)
+        wrapper.group = group
+        return wrapper
+
+    return decorator
@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import time
+from collections import Counter
+from datetime import date, datetime, timezone
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from crud import (
+    fetch_messages_for_rollup, lock_stats_watermark, set_stats_watermark,
+    add_stats_counters, reset_stats,
+)
+from db_conf import AsyncSessionLocal
+from db_models import first_message_id_at
+from sharding import shard_map
+
+
+# Инкрементальные счётчики для /admin/stats. По каждому шарду помним id
+# последнего учтённого сообщения и добираем следующие пачкой; счётчики и
+# водяной знак пишутся одной транзакцией, поэтому сообщение учитывается ровно раз.
+#
+# Свежие сообщения не трогаем: id выдаются в приложении по времени, и вставка
+# с меньшим id может закоммититься чуть позже — ждём ROLLUP_LAG секунд.
+ROLLUP_LAG = 5
+BACKFILL_BATCH = 5000
+BACKFILL_PAUSE = 0.5  # секунд между пачками, чтобы не нагружать базу
+
+
+def _day(created_at: datetime) -> date:
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc)
+    return created_at.date()
+
+
+async def rollup_batch(db: AsyncSession, shard: int, limit: int) -> int:
+    """Учесть следующую пачку сообщений шарда; коммитит вызывающий"""
+    after_id = await lock_stats_watermark(db, shard)
+    before_id = first_message_id_at(time.time() - ROLLUP_LAG)
+    async with shard_map.session(db, shard) as shard_db:
+        rows = await fetch_messages_for_rollup(shard_db, after_id, before_id, limit)
+    if not rows:
+        return 0
+
+    daily: Counter = Counter()
+    user_daily: Counter = Counter()
+    chats: dict[int, tuple[int, datetime]] = {}
+    for row in rows:
+        day = _day(row.created_at)
+        daily[day] += 1
+        user_daily[(day, row.sender_id)] += 1
+        count, last_at = chats.get(row.chat_id, (0, row.created_at))
+        chats[row.chat_id] = (count + 1, max(last_at, row.created_at))
+
+    await add_stats_counters(db, daily, user_daily, chats)
+    await set_stats_watermark(db, shard, rows[-1].id)
+    return len(rows)
+
+
+async def backfill(reset: bool = False, batch_size: int = BACKFILL_BATCH) -> int:
+    """Догнать счётчики по всей истории — пачками, каждая в своей транзакции"""
+    if reset:
+        async with AsyncSessionLocal() as db:
+            await reset_stats(db)
+            await db.commit()
+
+    total = 0
+    for shard in range(len(shard_map)):
+        while True:
+            async with AsyncSessionLocal() as db:
+                count = await rollup_batch(db, shard, batch_size)
+                await db.commit()
+            total += count
+            if count:
+                print(f"shard {shard}: +{count} messages ({total} total)")
+            if count < batch_size:
+                break
+            await asyncio.sleep(BACKFILL_PAUSE)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Admin stats rollups")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    backfill_cmd = commands.add_parser("backfill", help="build rollups from existing messages")
+    backfill_cmd.add_argument("--reset", action="store_true", help="drop rollups and rebuild from scratch")
+    backfill_cmd.add_argument("--batch-size", type=int, default=BACKFILL_BATCH)
+
+    args = parser.parse_args()
+
+    async def run():
+        try:
+            if args.command == "backfill":
+                total = await backfill(args.reset, args.batch_size)
+                print(f"Rolled up {total} messages")
+        finally:
+            for shard_engine in shard_map.engines:
+                await shard_engine.dispose()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
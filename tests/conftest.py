@@ -0,0 +1,121 @@
+import asyncio
+import os
+import sys
+import tempfile
+import types
+from pathlib import Path
+
+import fakeredis
+import pytest
+from sqlalchemy import update
+
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# Тесты гоняем на SQLite во временной папке, Redis — fakeredis.
+# config.py в репозитории нет (настройки окружения), подставляем тестовые.
+TMP_DIR = Path(tempfile.mkdtemp(prefix="web-chat-tests-"))
+os.environ["ATTACHMENTS_DIR"] = str(TMP_DIR / "attachments")
+os.environ["EXPORT_DIR"] = str(TMP_DIR / "exports")
+os.environ["NOTIFICATIONS_FILE"] = str(TMP_DIR / "notifications.ndjson")
+
+
+class TestSettings:
+    DATABASE_URL = f"sqlite+aiosqlite:///{TMP_DIR / 'test.db'}"
+    SECRET_KEY = "test-secret"
+    ALGORITHM = "HS256"
+    ACCESS_TOKEN_EXPIRE_MINUTES = 30
+    REFRESH_TOKEN_EXPIRE_DAYS = 7
+
+
+config = types.ModuleType("config")
+config.settings = TestSettings()
+sys.modules["config"] = config
+
+import auth  # noqa: E402
+import crud  # noqa: E402
+import db_conf  # noqa: E402
+from db_models import User  # noqa: E402
+import export  # noqa: E402
+import main  # noqa: E402
+import maintenance  # noqa: E402
+import presence  # noqa: E402
+import profiling  # noqa: E402
+import singleflight  # noqa: E402
+import user_search  # noqa: E402
+
+db_conf.engine.echo = False
+
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+    """Пустая база, свой Redis и сброшенные кэши на каждый тест"""
+    async def reset():
+        async with db_conf.engine.begin() as conn:
+            await conn.run_sync(db_conf.Base.metadata.drop_all)
+            await conn.run_sync(db_conf.Base.metadata.create_all)
+        await db_conf.engine.dispose()
+
+    asyncio.run(reset())
+
+    redis_client = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+    auth.redis_client = redis_client
+    auth.revocation_list.redis = redis_client
+    maintenance.scheduler.redis = redis_client
+    export.export_jobs.redis = redis_client
+    profiling.profiles.redis = redis_client
+    for group in singleflight.groups.values():
+        group._cache.clear()
+    presence.activity._pending.clear()
+    user_search.username_index.__init__()
+
+    yield redis_client
+
+    asyncio.run(db_conf.engine.dispose())
+
+
+@pytest.fixture
+def run():
+    """Запустить корутину в своём event loop и отпустить соединения движка"""
+    def runner(coro):
+        async def wrapped():
+            try:
+                return await coro
+            finally:
+                await db_conf.engine.dispose()
+        return asyncio.run(wrapped())
+    return runner
+
+
+@pytest.fixture
+def client():
+    from fastapi.testclient import TestClient
+
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+def register(client, username: str, password: str = "pw") -> dict:
+    """Регистрирует и логинит пользователя, возвращает заголовки с токеном"""
+    client.post("/auth/register", json={"username": username, "password": password})
+    tokens = client.post("/auth/login", data={"username": username, "password": password}).json()
+    return {"Authorization": "Bearer " + tokens["access_token"]}
+
+
+def make_admin(client, username: str):
+    async def promote():
+        async with db_conf.AsyncSessionLocal() as db:
+            await db.execute(update(User).where(User.username == username).values(is_admin=True))
+            await db.commit()
+    client.portal.call(promote)
+
+
+def send_message(client, sender: str, recipient: str, content: str):
+    """Сообщение в обход REST — без лимитов и сокетов; возвращает Message"""
+    async def send():
+        async with db_conf.AsyncSessionLocal() as db:
+            sender_user = await crud.get_user_by_username(db, sender)
+            recipient_user = await crud.get_user_by_username(db, recipient)
+            return await crud.create_message(db, sender_user, recipient_user, content)
+    return client.portal.call(send)
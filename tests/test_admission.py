@@ -0,0 +1,84 @@
+import main
+from admission import RETRY_AFTER, limiters
+from conftest import register
+
+
+def test_file_transfers_do_not_hold_admission_slot(client, monkeypatch):
+    headers = register(client, "alice")
+    limiter = limiters["attachments"]
+    uploads = limiters["uploads"]
+    seen = []
+
+    store_stream = main.store_stream
+    create_attachment = main.create_attachment
+
+    async def recording_store_stream(stream):
+        seen.append(("upload", limiter.active, uploads.active))
+        return await store_stream(stream)
+
+    async def recording_create_attachment(*args):
+        seen.append(("insert", limiter.active, uploads.active))
+        return await create_attachment(*args)
+
+    class RecordingFileResponse(main.FileResponse):
+        async def __call__(self, scope, receive, send):
+            seen.append(("download", limiter.active, uploads.active))
+            await super().__call__(scope, receive, send)
+
+    monkeypatch.setattr(main, "store_stream", recording_store_stream)
+    monkeypatch.setattr(main, "create_attachment", recording_create_attachment)
+    monkeypatch.setattr(main, "FileResponse", RecordingFileResponse)
+
+    response = client.post("/attachments?filename=a.txt", content=b"hello", headers=headers)
+    assert response.status_code == 201
+    response = client.get(f"/attachments/{response.json()['public_id']}", headers=headers)
+    assert response.status_code == 200
+    assert response.content == b"hello"
+
+    # тело загрузки — только под лимитом загрузок, вставка — снова под лимитером базы
+    assert seen == [("upload", 0, 1), ("insert", 1, 0), ("download", 0, 0)]
+    assert limiter.active == 0 and uploads.active == 0
+
+
+def hold_all_slots(client, limiter):
+    for _ in range(limiter.max_concurrent):
+        client.portal.call(limiter.acquire)
+
+
+def release_all_slots(client, limiter):
+    for _ in range(limiter.max_concurrent):
+        client.portal.call(limiter.release)
+
+
+def test_full_queue_is_rejected_with_retry_after(client, monkeypatch):
+    limiter = limiters["user"]
+    monkeypatch.setattr(limiter, "max_queue", 0)
+    rejected = limiter.stats["rejected"]
+
+    hold_all_slots(client, limiter)
+    try:
+        response = client.get("/user/profile/me")
+    finally:
+        release_all_slots(client, limiter)
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(RETRY_AFTER)
+    assert limiter.stats["rejected"] == rejected + 1
+    assert limiter.active == 0 and limiter.waiting == 0
+
+
+def test_queue_timeout_is_rejected(client, monkeypatch):
+    limiter = limiters["user"]
+    monkeypatch.setattr(limiter, "queue_timeout", 0.05)
+    timed_out = limiter.stats["timed_out"]
+
+    hold_all_slots(client, limiter)
+    try:
+        response = client.get("/user/profile/me")
+    finally:
+        release_all_slots(client, limiter)
+
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+    assert limiter.stats["timed_out"] == timed_out + 1
+    assert limiter.waiting == 0
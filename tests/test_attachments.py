@@ -0,0 +1,104 @@
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, update
+
+import db_conf
+import maintenance
+from attachments import blob_path
+from conftest import register
+from db_models import Attachment
+
+
+def upload(client, headers, content: bytes) -> dict:
+    response = client.post("/attachments?filename=a.txt", content=content, headers=headers)
+    assert response.status_code == 201
+    return response.json()
+
+
+def test_send_message_links_attachments(client):
+    alice = register(client, "alice")
+    bob = register(client, "bob")
+    bob_public_id = client.get("/user/profile/me", headers=bob).json()["public_id"]
+    client.get(f"/chat/{bob_public_id}/history", headers=alice)
+    chat_id = client.get("/chat/list", headers=alice).json()[0]["chat_id"]
+    attachment = upload(client, alice, b"report")
+
+    token = bob["Authorization"].split()[1]
+    with client.websocket_connect(f"/ws/chat/{chat_id}?token={token}") as ws:
+        response = client.post(
+            f"/chat/{bob_public_id}/messages",
+            json={"content": "see file", "attachment_ids": [attachment["public_id"]]},
+            headers=alice,
+        )
+        assert response.status_code == 201
+        event = ws.receive_json()
+
+    assert event["type"] == "message"
+    assert event["message"]["id"] == response.json()["id"]
+    assert [a["public_id"] for a in event["message"]["attachments"]] == [attachment["public_id"]]
+
+    history = client.get(f"/chat/{bob_public_id}/history", headers=alice).json()
+    assert [a["public_id"] for a in history[-1]["attachments"]] == [attachment["public_id"]]
+    assert client.get(f"/attachments/{attachment['public_id']}", headers=bob).content == b"report"
+
+    # вложение уже использовано
+    response = client.post(
+        f"/chat/{bob_public_id}/messages",
+        json={"content": "again", "attachment_ids": [attachment["public_id"]]},
+        headers=alice,
+    )
+    assert response.status_code == 400
+    assert client.post(f"/chat/{bob_public_id}/messages", json={"content": ""}, headers=alice).status_code == 400
+
+
+def test_sweep_removes_stale_unattached_uploads(client):
+    alice = register(client, "alice")
+    bob = register(client, "bob")
+    bob_public_id = client.get("/user/profile/me", headers=bob).json()["public_id"]
+    stale = upload(client, alice, b"forgotten")
+    shared = upload(client, alice, b"shared")
+    linked = upload(client, alice, b"shared")
+    client.post(
+        f"/chat/{bob_public_id}/messages",
+        json={"content": "", "attachment_ids": [linked["public_id"]]},
+        headers=alice,
+    )
+
+    async def age_uploads():
+        async with db_conf.AsyncSessionLocal() as db:
+            await db.execute(update(Attachment).values(
+                created_at=datetime.now(timezone.utc) - maintenance.UNATTACHED_TTL * 2
+            ))
+            await db.commit()
+    client.portal.call(age_uploads)
+    expired = time.time() - maintenance.UNATTACHED_TTL.total_seconds() * 2
+    for attachment in (stale, shared):
+        os.utime(blob_path(attachment["sha256"]), (expired, expired))
+
+    assert client.portal.call(maintenance.sweep_unattached_attachments) == 2
+
+    async def remaining():
+        async with db_conf.AsyncSessionLocal() as db:
+            return set((await db.execute(select(Attachment.public_id))).scalars())
+    assert client.portal.call(remaining) == {linked["public_id"]}
+    assert not blob_path(stale["sha256"]).exists()
+    # тот же файл нужен прикреплённому вложению
+    assert blob_path(linked["sha256"]).exists()
+
+
+def test_download_supports_range_requests(client):
+    alice = register(client, "alice")
+    attachment = upload(client, alice, b"0123456789")
+
+    response = client.get(f"/attachments/{attachment['public_id']}", headers={"Range": "bytes=2-4", **alice})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 2-4/10"
+    assert response.content == b"234"
+
+    # без Range — файл целиком
+    response = client.get(f"/attachments/{attachment['public_id']}", headers=alice)
+    assert response.status_code == 200
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.content == b"0123456789"
@@ -0,0 +1,67 @@
+import io
+import json
+import os
+import time
+import zipfile
+
+import db_conf
+import export
+import main
+from admission import limiters
+from conftest import register
+
+
+def test_export_job_state_is_shared_and_capped(client):
+    alice = register(client, "alice")
+    bob = register(client, "bob")
+    bob_public_id = client.get("/user/profile/me", headers=bob).json()["public_id"]
+    client.get(f"/chat/{bob_public_id}/history", headers=alice)
+
+    response = client.post("/export/jobs", headers=alice)
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+
+    # состояние в Redis — его увидит любой воркер
+    job = client.portal.call(export.export_jobs.get, job_id)
+    assert job["status"] == "done"
+    assert client.get(f"/export/jobs/{job_id}", headers=bob).status_code == 404
+
+    download = client.get(f"/export/jobs/{job_id}/download", headers=alice)
+    assert download.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(download.content)) as archive:
+        lines = archive.read("messages.ndjson").decode().splitlines()
+    assert [json.loads(line)["type"] for line in lines] == ["chat"]
+
+    # пока идёт выгрузка, вторую не запускаем
+    assert client.portal.call(export.export_jobs.create, job["user_id"]) is not None
+    assert client.post("/export/jobs", headers=alice).status_code == 429
+    assert client.post("/export/jobs", headers=bob).status_code == 202
+
+
+def test_sweep_removes_expired_archives(client):
+    export.EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+    old = export.export_path("old")
+    fresh = export.export_path("fresh")
+    for path in (old, fresh):
+        path.write_bytes(b"zip")
+    expired = time.time() - export.EXPORT_TTL - 1
+    os.utime(old, (expired, expired))
+
+    assert client.portal.call(export.sweep_export_files) == 1
+    assert not old.exists() and fresh.exists()
+    fresh.unlink()
+
+
+def test_export_job_does_not_hold_request_resources(client, monkeypatch):
+    alice = register(client, "alice")
+    seen = []
+    run_export_job = main.run_export_job
+
+    async def recording_run_export_job(job_id, user_id):
+        seen.append((limiters["export"].active, db_conf.engine.pool.checkedout()))
+        await run_export_job(job_id, user_id)
+
+    monkeypatch.setattr(main, "run_export_job", recording_run_export_job)
+
+    assert client.post("/export/jobs", headers=alice).status_code == 202
+    assert seen == [(0, 0)]
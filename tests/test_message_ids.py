@@ -0,0 +1,16 @@
+import time
+
+from db_models import first_message_id_at, generate_message_id
+
+
+def test_message_ids_fit_in_json_number_and_grow():
+    ids = [generate_message_id() for _ in range(5000)]  # больше, чем влезает в одну секунду
+    assert len(set(ids)) == len(ids)
+    assert ids == sorted(ids)
+    assert max(ids) < 2 ** 53
+
+
+def test_first_message_id_at_bounds_generated_ids():
+    before = first_message_id_at(time.time() - 1)
+    message_id = generate_message_id()
+    assert before <= message_id < first_message_id_at(time.time() + 3600)
@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import select, update
+
+import notifications
+from conftest import register, send_message
+from db_models import NotificationOutbox
+from notifications import InMemorySink, NotificationSink, OutboxDispatcher
+from sharding import shard_map
+
+
+class FailingSink(NotificationSink):
+    def __init__(self):
+        self.calls = 0
+
+    async def send(self, recipient_id: int, notification: dict):
+        self.calls += 1
+        raise ConnectionError("push service is down")
+
+
+def outbox(client) -> list:
+    async def load():
+        async with shard_map.sessionmakers[0]() as db:
+            result = await db.execute(select(NotificationOutbox).order_by(NotificationOutbox.id))
+            return result.scalars().all()
+    return client.portal.call(load)
+
+
+def make_due(client):
+    async def reset():
+        async with shard_map.sessionmakers[0]() as db:
+            await db.execute(update(NotificationOutbox).values(next_attempt_at=datetime.now(timezone.utc)))
+            await db.commit()
+    client.portal.call(reset)
+
+
+def test_sink_is_abstract():
+    with pytest.raises(TypeError):
+        NotificationSink()
+
+
+def test_socket_in_one_chat_does_not_mute_others(client):
+    for name in ("alice", "bob", "carol"):
+        register(client, name)
+    first = send_message(client, "alice", "bob", "hi from alice")
+    open_chat, bob_id = first.chat_id, first.recipient_id
+    other_chat = send_message(client, "carol", "bob", "hi from carol").chat_id
+
+    # у bob открыт только чат с alice
+    sink = InMemorySink()
+    dispatcher = OutboxDispatcher(
+        sink, is_connected=lambda user_id, chat_id: (user_id, chat_id) == (bob_id, open_chat)
+    )
+    assert client.portal.call(dispatcher.dispatch_batch, 0) == 2
+
+    assert len(sink.sent) == 1
+    recipient_id, notification = sink.sent[0]
+    assert recipient_id == bob_id
+    assert notification["messages"] == 1
+    assert [chat["chat_id"] for chat in notification["chats"]] == [other_chat]
+    assert dispatcher.stats["skipped_online"] == 1
+
+    # обработанные строки удалены из outbox
+    assert client.portal.call(dispatcher.dispatch_batch, 0) == 0
+
+
+def test_rows_for_one_recipient_become_one_notification(client):
+    for name in ("alice", "bob", "carol"):
+        register(client, name)
+    alice_messages = [send_message(client, "alice", "bob", f"hi {i}") for i in range(3)]
+    carol_message = send_message(client, "carol", "bob", "hi from carol")
+    send_message(client, "bob", "alice", "hi back")
+
+    sink = InMemorySink()
+    dispatcher = OutboxDispatcher(sink)
+    assert client.portal.call(dispatcher.dispatch_batch, 0) == 5
+
+    notifications_by_recipient = dict(sink.sent)
+    assert len(sink.sent) == 2 and dispatcher.stats["notifications"] == 2
+
+    bob_id = carol_message.recipient_id
+    notification = notifications_by_recipient[bob_id]
+    assert notification["messages"] == 4
+    chats = {chat["chat_id"]: chat for chat in notification["chats"]}
+    alice_chat = chats[alice_messages[0].chat_id]
+    assert alice_chat["messages"] == 3
+    assert alice_chat["last_message_id"] == alice_messages[-1].id
+    assert alice_chat["sender_ids"] == [alice_messages[0].sender_id]
+    assert chats[carol_message.chat_id]["messages"] == 1
+    assert outbox(client) == []
+
+
+def test_failing_sink_backs_off_then_drops(client, monkeypatch):
+    monkeypatch.setattr(notifications, "MAX_ATTEMPTS", 3)
+    register(client, "alice")
+    register(client, "bob")
+    send_message(client, "alice", "bob", "one")
+    send_message(client, "alice", "bob", "two")
+
+    sink = FailingSink()
+    dispatcher = OutboxDispatcher(sink)
+    for attempts in (1, 2):
+        before = datetime.now(timezone.utc)
+        assert client.portal.call(dispatcher.dispatch_batch, 0) == 2
+        rows = outbox(client)
+        assert [row.attempts for row in rows] == [attempts, attempts]
+        delay = timedelta(seconds=notifications.RETRY_BASE_DELAY * 2 ** (attempts - 1))
+        for row in rows:
+            next_attempt_at = row.next_attempt_at.replace(tzinfo=timezone.utc)
+            assert before + delay <= next_attempt_at <= datetime.now(timezone.utc) + delay
+        # до срока повтора строки не берутся
+        assert client.portal.call(dispatcher.dispatch_batch, 0) == 0
+        make_due(client)
+
+    # третья неудача — MAX_ATTEMPTS исчерпан, строки удаляются
+    assert client.portal.call(dispatcher.dispatch_batch, 0) == 2
+    assert outbox(client) == []
+    assert sink.calls == 3
+    assert dispatcher.stats["failed"] == 3 and dispatcher.stats["dropped"] == 2
@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+
+import db_conf
+import maintenance
+from conftest import register
+from db_models import User
+from presence import activity
+
+
+def set_last_active(client, when: datetime):
+    async def store():
+        async with db_conf.AsyncSessionLocal() as db:
+            await db.execute(update(User).values(last_active=when))
+            await db.commit()
+    client.portal.call(store)
+
+
+def online(client) -> dict:
+    async def load():
+        async with db_conf.AsyncSessionLocal() as db:
+            rows = await db.execute(select(User.username, User.is_online))
+            return dict(rows.all())
+    return client.portal.call(load)
+
+
+def test_active_user_survives_presence_sweep(client):
+    alice = register(client, "alice")
+    register(client, "bob")
+    client.portal.call(activity.flush)
+    set_last_active(client, datetime.utcnow() - maintenance.PRESENCE_TIMEOUT * 2)
+
+    # alice продолжает пользоваться API, bob молчит
+    assert client.get("/user/profile/me", headers=alice).status_code == 200
+    client.portal.call(activity.flush)
+    client.portal.call(maintenance.sweep_presence)
+
+    assert online(client) == {"alice": True, "bob": False}
+
+
+def test_logout_drops_pending_activity(client):
+    alice = register(client, "alice")
+    assert client.post("/auth/logout", headers=alice).status_code == 200
+    client.portal.call(activity.flush)
+
+    assert online(client) == {"alice": False}
@@ -0,0 +1,53 @@
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import profiling
+from conftest import TMP_DIR, make_admin, register
+from sharding import shard_map
+
+
+def test_profile_flag_is_ignored_for_non_admins(client):
+    alice = register(client, "alice")
+
+    for headers in ({}, alice, {"Authorization": "Bearer garbage"}):
+        response = client.get("/?profile=1", headers=headers)
+        assert response.status_code == 200
+        assert "X-Profile-Id" not in response.headers
+
+
+def test_admin_gets_profile(client):
+    alice = register(client, "alice")
+    make_admin(client, "alice")
+
+    response = client.get("/?profile=1", headers=alice)
+    assert response.status_code == 200
+    profile_id = response.headers["X-Profile-Id"]
+    assert client.get(f"/admin/profiles/{profile_id}", headers=alice).json()["path"] == "/"
+    assert [profile["id"] for profile in client.get("/admin/profiles", headers=alice).json()] == [profile_id]
+    stacks = client.get(f"/admin/profiles/{profile_id}/stacks", headers=alice)
+    assert stacks.status_code == 200
+
+    # отчёт в Redis — его отдаст любой воркер
+    stored = client.portal.call(profiling.profiles.get, profile_id)
+    assert stored["id"] == profile_id
+
+
+def test_shard_engines_are_traced(run):
+    shard_engine = create_async_engine(f"sqlite+aiosqlite:///{TMP_DIR / 'traced.db'}")
+    profiling.trace_engine(shard_engine)
+    profiling.trace_engine(shard_engine)
+
+    async def query() -> profiling.SqlTrace:
+        trace = profiling.SqlTrace()
+        token = profiling._current_trace.set(trace)
+        try:
+            async with shard_engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+        finally:
+            profiling._current_trace.reset(token)
+            await shard_engine.dispose()
+        return trace
+
+    assert run(query()).summary()["count"] == 1
+    for engine in shard_map.engines:
+        assert event.contains(engine.sync_engine, "before_cursor_execute", profiling._before_cursor_execute)
@@ -0,0 +1,82 @@
+import pytest
+from sqlalchemy import func, select, text
+
+import crud
+import db_conf
+from conftest import register, send_message
+from db_models import Message
+from receipts import read_receipts
+from websocket_router import chat_events
+
+
+@pytest.fixture
+def users(client):
+    alice = register(client, "alice")
+    bob = register(client, "bob")
+    profiles = {
+        name: client.get("/user/profile/me", headers=headers).json()
+        for name, headers in (("alice", alice), ("bob", bob))
+    }
+    return alice, bob, profiles
+
+
+def user_id(client, username: str) -> int:
+    async def load():
+        async with db_conf.AsyncSessionLocal() as db:
+            return (await crud.get_user_by_username(db, username)).id
+    return client.portal.call(load)
+
+
+def flush(client):
+    async def flush_all():
+        await chat_events.flush()
+        await read_receipts.flush()
+    client.portal.call(flush_all)
+
+
+def test_read_cursor_is_clamped_to_last_message(client, users):
+    alice, bob, profiles = users
+    send_message(client, "bob", "alice", "first")
+    last_id = send_message(client, "bob", "alice", "second").id
+    chat_id = client.get("/chat/list", headers=alice).json()[0]["chat_id"]
+    token = alice["Authorization"].removeprefix("Bearer ")
+
+    with client.websocket_connect(f"/ws/chat/{chat_id}?token={token}") as ws:
+        ws.send_json({"type": "read", "message_id": 2 ** 52})
+        ws.send_json({"type": "ping"})
+        assert ws.receive_json() == {"type": "pong"}
+
+        flush(client)
+        event = ws.receive_json()
+        assert event["type"] == "receipts"
+        assert event["read"] == [{"user_id": user_id(client, "alice"), "message_id": last_id}]
+
+    cursors = client.get(f"/chat/{profiles['bob']['public_id']}/read", headers=alice).json()
+    assert cursors["last_read_message_id"] == last_id
+
+    # курсор не застрял: следующее сообщение снова можно отметить прочитанным
+    newer_id = send_message(client, "bob", "alice", "third").id
+    client.post(f"/chat/{profiles['bob']['public_id']}/read", headers=alice, json={"message_id": newer_id})
+    flush(client)
+    cursors = client.get(f"/chat/{profiles['bob']['public_id']}/read", headers=alice).json()
+    assert cursors["last_read_message_id"] == newer_id
+
+
+def test_read_in_chat_without_messages_is_ignored(client, users):
+    alice, bob, profiles = users
+    client.get(f"/chat/{profiles['bob']['public_id']}/history", headers=alice)
+    client.post(f"/chat/{profiles['bob']['public_id']}/read", headers=alice, json={"message_id": 100})
+    flush(client)
+    cursors = client.get(f"/chat/{profiles['bob']['public_id']}/read", headers=alice).json()
+    assert cursors["last_read_message_id"] is None
+
+
+def test_last_message_ids_use_chat_index(client):
+    async def plan():
+        query = select(Message.chat_id, func.max(Message.id)).where(Message.chat_id.in_([1, 2])).group_by(Message.chat_id)
+        async with db_conf.engine.connect() as conn:
+            compiled = query.compile(conn.sync_connection, compile_kwargs={"literal_binds": True})
+            rows = await conn.execute(text(f"EXPLAIN QUERY PLAN {compiled}"))
+            return " ".join(row[-1] for row in rows)
+
+    assert "ix_messages_chat_id_id" in client.portal.call(plan)
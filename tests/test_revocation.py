@@ -0,0 +1,106 @@
+import asyncio
+import time
+
+import fakeredis
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+from conftest import register
+from revocation import REVOKED_KEY_PREFIX, BloomFilter, RevocationList
+
+
+def fake_redis(server=None):
+    return fakeredis.aioredis.FakeRedis(server=server or fakeredis.FakeServer(), decode_responses=True)
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    added = [f"jti-{i}" for i in range(1000)]
+    for item in added:
+        bloom.add(item)
+
+    assert all(item in bloom for item in added)
+    false_positives = sum(f"other-{i}" in bloom for i in range(10_000))
+    assert false_positives < 300  # ~1% при заданной ошибке, с запасом
+
+
+def test_revoke_and_check(run):
+    revocation = RevocationList(fake_redis())
+
+    async def scenario():
+        await revocation.revoke("alive", int(time.time()) + 60)
+        await revocation.revoke("expired", int(time.time()) - 1)
+        # ложное попадание в фильтр подтверждаем в Redis
+        revocation.bloom.add("false-positive")
+        return (
+            await revocation.is_revoked("alive"),
+            await revocation.is_revoked("expired"),
+            await revocation.is_revoked("false-positive"),
+            await revocation.is_revoked("unknown"),
+            await revocation.redis.ttl(REVOKED_KEY_PREFIX + "alive"),
+        )
+
+    alive, expired, false_positive, unknown, ttl = run(scenario())
+    assert (alive, expired, false_positive, unknown) == (True, False, False, False)
+    assert 0 < ttl <= 60
+
+
+def test_redis_failure_rejects_tokens_in_filter(run):
+    class BrokenRedis:
+        async def exists(self, key):
+            raise ConnectionError("redis is down")
+
+    revocation = RevocationList(BrokenRedis())
+    revocation.bloom.add("maybe")
+
+    assert run(revocation.is_revoked("maybe")) is True
+    assert run(revocation.is_revoked("never")) is False
+
+
+def test_workers_sync_through_pubsub_and_rebuild(run):
+    server = fakeredis.FakeServer()
+    first, second = RevocationList(fake_redis(server)), RevocationList(fake_redis(server))
+
+    async def scenario():
+        await first.revoke("before-start", int(time.time()) + 60)
+        await second.start()
+        try:
+            # при старте второй воркер пересобирает фильтр из Redis
+            for _ in range(50):
+                if "before-start" in second.bloom:
+                    break
+                await asyncio.sleep(0.02)
+            rebuilt = "before-start" in second.bloom
+
+            await first.revoke("live", int(time.time()) + 60)
+            for _ in range(100):
+                if "live" in second.bloom:
+                    break
+                await asyncio.sleep(0.02)
+            return rebuilt, await second.is_revoked("live")
+        finally:
+            await second.stop()
+
+    assert run(scenario()) == (True, True)
+
+
+def test_logout_revokes_access_token_for_rest_and_websocket(client):
+    alice = register(client, "alice")
+    bob = register(client, "bob")
+    bob_public_id = client.get("/user/profile/me", headers=bob).json()["public_id"]
+    client.get(f"/chat/{bob_public_id}/history", headers=alice)
+    chat_id = client.get("/chat/list", headers=alice).json()[0]["chat_id"]
+    token = alice["Authorization"].split()[1]
+    with client.websocket_connect(f"/ws/chat/{chat_id}?token={token}") as ws:
+        ws.send_json({"type": "ping"})
+        assert ws.receive_json() == {"type": "pong"}
+
+    assert client.post("/auth/logout", headers=alice).status_code == 200
+
+    response = client.get("/user/profile/me", headers=alice)
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Access token has been revoked"
+
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect(f"/ws/chat/{chat_id}?token={token}") as ws:
+            ws.receive_json()
@@ -0,0 +1,97 @@
+import asyncio
+
+import fakeredis
+
+import maintenance
+from conftest import make_admin, register
+from scheduler import LOCK_PREFIX, Scheduler
+
+
+def make_workers(*jobs):
+    redis_client = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+    workers = [Scheduler(redis_client), Scheduler(redis_client)]
+    for worker in workers:
+        for name, func, interval in jobs:
+            worker.add_job(name, func, interval)
+    return redis_client, workers
+
+
+def test_lock_is_held_while_a_long_job_runs(run):
+    async def slow() -> int:
+        await asyncio.sleep(0.35)
+        return 1
+
+    redis_client, (first, second) = make_workers(("slow", slow, 0.1))
+    job = first.jobs[0]
+
+    async def scenario():
+        assert await first._acquire(job)
+        running = asyncio.create_task(first.run_job(job))
+        attempts = []
+        for _ in range(3):
+            await asyncio.sleep(0.1)
+            attempts.append(await second._acquire(second.jobs[0]))
+        await running
+        # задача шла дольше интервала — лок снят сразу после неё
+        released = await redis_client.exists(LOCK_PREFIX + "slow") == 0
+        return attempts, released
+
+    attempts, released = run(scenario())
+    assert attempts == [False, False, False]
+    assert released
+
+
+def test_short_job_keeps_lock_until_interval_ends(run):
+    async def quick() -> int:
+        return 0
+
+    redis_client, (first, second) = make_workers(("quick", quick, 0.2))
+
+    async def scenario():
+        assert await first._acquire(first.jobs[0])
+        await first.run_job(first.jobs[0])
+        during = await second._acquire(second.jobs[0])
+        await asyncio.sleep(0.25)
+        after = await second._acquire(second.jobs[0])
+        return during, after
+
+    assert run(scenario()) == (False, True)
+
+
+def test_stats_are_shared_between_workers(run):
+    async def rows() -> int:
+        return 7
+
+    async def broken() -> int:
+        raise RuntimeError("boom")
+
+    _, (first, second) = make_workers(("rows", rows, 60), ("broken", broken, 60))
+
+    async def scenario():
+        for job in first.jobs:
+            assert await first._acquire(job)
+            await first.run_job(job)
+        return await second.read_stats()
+
+    stats = run(scenario())
+    assert stats["rows"]["runs"] == 1 and stats["rows"]["last_rows"] == 7
+    assert stats["rows"]["last_worker"] == first._worker_id
+    assert stats["broken"] == {
+        "runs": 0, "errors": 1, "last_run": None, "last_duration": None, "last_rows": None, "last_worker": None,
+    }
+
+
+def test_maintenance_endpoint_reads_shared_stats(client):
+    alice = register(client, "alice")
+    make_admin(client, "alice")
+
+    # задачу выполнил "другой воркер" — в этом процессе её не запускали
+    other = Scheduler(maintenance.scheduler.redis)
+    other.add_job("presence", maintenance.sweep_presence, 60)
+    assert client.portal.call(other._acquire, other.jobs[0])
+    client.portal.call(other.run_job, other.jobs[0])
+
+    stats = client.get("/admin/maintenance", headers=alice).json()
+    assert stats["presence"]["runs"] == 1
+    assert stats["presence"]["last_worker"] == other._worker_id
+    assert stats["refresh_tokens"]["runs"] == 0
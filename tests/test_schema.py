@@ -0,0 +1,74 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from conftest import TMP_DIR
+from db_conf import Base
+from schema import upgrade_schema
+
+
+# схема до шардирования, курсоров и expires_at — как на уже развёрнутой базе
+LEGACY_TABLES = [
+    """CREATE TABLE users (
+        id INTEGER PRIMARY KEY, public_id VARCHAR UNIQUE, username VARCHAR NOT NULL UNIQUE,
+        description VARCHAR, password VARCHAR NOT NULL, is_admin BOOLEAN, is_online BOOLEAN, last_active DATETIME
+    )""",
+    """CREATE TABLE refresh_tokens (
+        id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users (id),
+        token_hash VARCHAR NOT NULL, created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )""",
+    "CREATE TABLE chats (id INTEGER PRIMARY KEY, created_at DATETIME DEFAULT CURRENT_TIMESTAMP)",
+    """CREATE TABLE chat_members (
+        id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL REFERENCES chats (id),
+        user_id INTEGER NOT NULL REFERENCES users (id)
+    )""",
+    """CREATE TABLE messages (
+        id INTEGER PRIMARY KEY, sender_id INTEGER NOT NULL, recipient_id INTEGER NOT NULL,
+        content TEXT NOT NULL, created_at DATETIME DEFAULT CURRENT_TIMESTAMP, chat_id INTEGER NOT NULL
+    )""",
+    "INSERT INTO chats (id) VALUES (1)",
+]
+
+
+def test_upgrade_brings_existing_tables_to_models(run):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{TMP_DIR}/legacy.db")
+
+    def describe(conn):
+        inspector = inspect(conn)
+        return {
+            table: (
+                {column["name"] for column in inspector.get_columns(table)},
+                {index["name"] for index in inspector.get_indexes(table)},
+            )
+            for table in ("refresh_tokens", "chats", "chat_members", "messages")
+        }
+
+    async def upgrade():
+        try:
+            async with engine.begin() as conn:
+                for table in ("messages", "chat_members", "chats", "refresh_tokens", "users"):
+                    await conn.execute(text(f"DROP TABLE IF EXISTS {table}"))
+                for statement in LEGACY_TABLES:
+                    await conn.execute(text(statement))
+
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                changes = await conn.run_sync(upgrade_schema, Base.metadata)
+            async with engine.begin() as conn:
+                again = await conn.run_sync(upgrade_schema, Base.metadata)
+                schema = await conn.run_sync(describe)
+                chat = (await conn.execute(text("SELECT shard, user_low_id FROM chats"))).one()
+            return changes, again, schema, chat
+        finally:
+            await engine.dispose()
+
+    changes, again, schema, chat = run(upgrade())
+
+    assert changes and again == []
+    assert "expires_at" in schema["refresh_tokens"][0]
+    assert {"shard", "user_low_id", "user_high_id"} <= schema["chats"][0]
+    assert "uq_chats_user_pair" in schema["chats"][1]
+    assert "last_read_message_id" in schema["chat_members"][0]
+    assert "ix_chat_members_chat_id" in schema["chat_members"][1]
+    assert "ix_messages_chat_id_id" in schema["messages"][1]
+    # старые чаты получают шард по умолчанию, пару заполнит backfill-pairs
+    assert tuple(chat) == (0, None)
@@ -0,0 +1,152 @@
+import pytest
+from sqlalchemy import func, insert, select, update
+
+import crud
+import db_conf
+import sharding
+from conftest import TMP_DIR, TestSettings
+from db_models import Attachment, Chat, ChatMember, Message, NotificationOutbox, User
+
+
+@pytest.fixture
+def two_shards(monkeypatch, run):
+    shard_url = f"sqlite+aiosqlite:///{TMP_DIR / 'shard1.db'}"
+    shards = sharding.ShardMap([TestSettings.DATABASE_URL, shard_url])
+
+    async def create():
+        async with shards.engines[1].begin() as conn:
+            await conn.run_sync(sharding._shard_metadata().drop_all)
+        await shards.create_tables()
+
+    run(create())
+    monkeypatch.setattr(sharding, "shard_map", shards)
+    monkeypatch.setattr(sharding, "MOVE_GRACE_PERIOD", 0)
+    yield shards
+    run(shards.engines[1].dispose())
+
+
+async def create_chat(shards, message_ids) -> int:
+    async with db_conf.AsyncSessionLocal() as db:
+        db.add_all([User(username="alice", password="x"), User(username="bob", password="x")])
+        chat = await db.scalar(insert(Chat).values(shard=0, user_low_id=1, user_high_id=2).returning(Chat))
+        await db.execute(insert(ChatMember), [{"chat_id": chat.id, "user_id": 1}, {"chat_id": chat.id, "user_id": 2}])
+        await db.execute(insert(Message), [
+            {"id": message_id, "chat_id": chat.id, "sender_id": 1, "recipient_id": 2, "content": str(message_id)}
+            for message_id in message_ids
+        ])
+        await db.commit()
+        return chat.id
+
+
+async def message_ids(shards, shard: int) -> list[int]:
+    async with shards.sessionmakers[shard]() as session:
+        return list(await session.scalars(select(Message.id).order_by(Message.id)))
+
+
+async def member_count(shards, shard: int) -> int:
+    async with shards.sessionmakers[shard]() as session:
+        return await session.scalar(select(func.count()).select_from(ChatMember))
+
+
+def test_move_copies_late_commits_with_lower_ids(two_shards, monkeypatch, run):
+    chat_id = run(create_chat(two_shards, [10, 20, 30]))
+
+    # сообщение с меньшим id закоммитилось в старый шард уже после первого копирования
+    copy_members = sharding._copy_members
+    calls = []
+
+    async def copy_members_with_late_write(source, target, chat_id):
+        calls.append(1)
+        if len(calls) == 2:
+            await source.execute(insert(Message.__table__).values(
+                id=15, chat_id=chat_id, sender_id=2, recipient_id=1, content="late"
+            ))
+            await source.commit()
+        await copy_members(source, target, chat_id)
+
+    monkeypatch.setattr(sharding, "_copy_members", copy_members_with_late_write)
+
+    assert run(sharding.move_chat(chat_id, 1)) == 0
+    assert run(message_ids(two_shards, 1)) == [10, 15, 20, 30]
+    assert run(message_ids(two_shards, 0)) == []
+    assert run(member_count(two_shards, 1)) == 2
+    assert run(member_count(two_shards, 0)) == 0
+
+
+def test_drain_deletes_only_messages_present_on_target(two_shards, run):
+    chat_id = run(create_chat(two_shards, [10, 20]))
+
+    async def only_copy():
+        async with two_shards.sessionmakers[0]() as source, two_shards.sessionmakers[1]() as target:
+            await sharding._copy_missing_messages(source, target, chat_id)
+            await source.execute(insert(Message.__table__).values(
+                id=25, chat_id=chat_id, sender_id=1, recipient_id=2, content="after copy"
+            ))
+            await source.commit()
+            return await sharding._delete_copied_messages(source, target, chat_id)
+
+    assert run(only_copy()) == 1
+    assert run(message_ids(two_shards, 0)) == [25]
+    assert run(message_ids(two_shards, 1)) == [10, 20]
+
+
+def test_move_keeps_the_latest_read_cursor(two_shards, monkeypatch, run):
+    chat_id = run(create_chat(two_shards, [10, 20, 30]))
+
+    # участник дочитал чат в старом шарде между первым копированием и переключением
+    copy_members = sharding._copy_members
+    calls = []
+
+    async def copy_members_then_read(source, target, chat_id):
+        await copy_members(source, target, chat_id)
+        calls.append(1)
+        if len(calls) == 1:
+            await source.execute(
+                update(ChatMember.__table__)
+                .where(ChatMember.chat_id == chat_id)
+                .where(ChatMember.user_id == 2)
+                .values(last_read_message_id=30)
+            )
+            await source.commit()
+
+    monkeypatch.setattr(sharding, "_copy_members", copy_members_then_read)
+    run(sharding.move_chat(chat_id, 1))
+
+    async def cursors():
+        async with two_shards.sessionmakers[1]() as session:
+            result = await session.execute(select(ChatMember.user_id, ChatMember.last_read_message_id))
+            return dict(result.all())
+
+    assert run(cursors()) == {1: None, 2: 30}
+
+
+def test_failed_shard_write_leaves_no_dangling_rows(two_shards, monkeypatch, run):
+    monkeypatch.setattr(crud, "shard_map", two_shards)
+
+    async def scenario():
+        async with db_conf.AsyncSessionLocal() as db:
+            db.add_all([User(username="alice", password="x"), User(username="bob", password="x")])
+            await db.commit()
+            alice = await crud.get_user_by_username(db, "alice")
+            bob = await crud.get_user_by_username(db, "bob")
+            attachment = await crud.create_attachment(db, alice.id, "0" * 64, 1, "text/plain", None)
+        assert two_shards.shard_for_new_chat(alice.id, bob.id) == 1
+
+        # outbox в шарде сломан — транзакция шарда откатится
+        async with two_shards.engines[1].begin() as conn:
+            await conn.run_sync(NotificationOutbox.__table__.drop)
+        async with db_conf.AsyncSessionLocal() as db:
+            with pytest.raises(Exception):
+                await crud.create_message(db, alice, bob, "hi", [attachment.public_id])
+
+        async with db_conf.AsyncSessionLocal() as db:
+            chat = await crud.get_private_chat(db, alice.id, bob.id)
+            linked = await db.scalar(select(Attachment.message_id).where(Attachment.id == attachment.id))
+        return chat, linked
+
+    chat, linked = run(scenario())
+    # чат закоммичен раньше шарда, его участники на месте; ссылка на вложение снята
+    assert chat is not None and chat.shard == 1
+    assert run(member_count(two_shards, 1)) == 2
+    assert run(message_ids(two_shards, 1)) == []
+    assert linked is None
@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+from conftest import make_admin, register
+from singleflight import SingleFlight
+
+
+def counting(value, delay: float = 0.05, error: Exception | None = None):
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return value
+
+    return fn, calls
+
+
+def test_concurrent_calls_share_one_execution(run):
+    group = SingleFlight()
+    fn, calls = counting("value")
+
+    async def scenario():
+        return await asyncio.gather(*(group.do("key", fn) for _ in range(10)))
+
+    assert run(scenario()) == ["value"] * 10
+    assert len(calls) == 1
+    assert group.stats["executed"] == 1 and group.stats["coalesced"] == 9
+
+
+def test_cancelled_leader_hands_off_to_waiter(run):
+    group = SingleFlight()
+    fn, calls = counting("value")
+
+    async def scenario():
+        leader = asyncio.create_task(group.do("key", fn))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(group.do("key", fn))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await waiter
+
+    assert run(scenario()) == "value"
+    # ожидающий не получил отмену ведущего, а выполнил запрос сам
+    assert len(calls) == 2
+    assert group.stats["coalesced"] == 0
+
+
+def test_errors_reach_all_waiters(run):
+    group = SingleFlight()
+    fn, calls = counting(None, error=ValueError("boom"))
+
+    async def scenario():
+        return await asyncio.gather(*(group.do("key", fn) for _ in range(3)), return_exceptions=True)
+
+    results = run(scenario())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len(calls) == 1
+    # ошибки не кэшируются
+    assert group._cache == {} and group._inflight == {}
+
+
+def test_negative_caching(run):
+    group = SingleFlight(ttl=0, negative_ttl=60)
+    missing, missing_calls = counting(None, delay=0)
+    found, found_calls = counting("value", delay=0)
+
+    async def scenario():
+        for _ in range(3):
+            await group.do("missing", missing)
+            await group.do("found", found)
+
+    run(scenario())
+    assert len(missing_calls) == 1 and group.stats["negative_hits"] == 2
+    # ttl=0 — найденное не кэшируется
+    assert len(found_calls) == 3 and group.stats["cache_hits"] == 0
+
+
+def test_invalidate_during_inflight_call(run):
+    group = SingleFlight(ttl=60)
+    old, _ = counting("old")
+    new, new_calls = counting("new", delay=0)
+
+    async def scenario():
+        stale = asyncio.create_task(group.do("key", old))
+        await asyncio.sleep(0.01)
+        group.invalidate("key")
+        # после invalidate новый вызов не ждёт устаревший запрос
+        fresh = await group.do("key", new)
+        stale_value = await stale
+        # устаревший результат не попал в кэш
+        cached = await group.do("key", new)
+        return stale_value, fresh, cached
+
+    assert run(scenario()) == ("old", "new", "new")
+    assert len(new_calls) == 1
+
+
+def test_admin_coalescing_counters(client):
+    alice = register(client, "alice")
+    make_admin(client, "alice")
+    public_id = client.get("/user/profile/me", headers=alice).json()["public_id"]
+
+    for _ in range(3):
+        assert client.get(f"/user/public/{public_id}", headers=alice).status_code == 200
+    assert client.get("/user/public/missing", headers=alice).status_code == 404
+    assert client.get("/user/public/missing", headers=alice).status_code == 404
+
+    stats = client.get("/admin/coalescing", headers=alice).json()["get_public_user"]
+    assert stats["executed"] == 2
+    assert stats["cache_hits"] == 2 and stats["negative_hits"] == 1
@@ -0,0 +1,60 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import event
+
+import crud
+import db_conf
+from models import UserCreate
+
+
+@contextmanager
+def count_statements():
+    """Считает SQL, ушедшие в курсор; BEGIN/COMMIT драйвер шлёт мимо курсора"""
+    statements: list[str] = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db_conf.engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db_conf.engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+
+
+async def scenario() -> dict[str, list[str]]:
+    counts = {}
+    async with db_conf.AsyncSessionLocal() as db:
+        with count_statements() as counts["create_user"]:
+            alice = await crud.create_user(db, UserCreate(username="alice", password="x"))
+        bob = await crud.create_user(db, UserCreate(username="bob", password="x"))
+
+        with count_statements() as counts["login"]:
+            alice = await crud.login_user(db, alice, "hash", datetime.now(timezone.utc) + timedelta(days=1))
+
+        with count_statements() as counts["update"]:
+            alice = await crud.update_user(db, alice, {"description": "hi"})
+
+        with count_statements() as counts["first_message"]:
+            await crud.create_message(db, alice, bob, "hello")
+
+        with count_statements() as counts["message"]:
+            await crud.create_message(db, alice, bob, "again")
+
+        with count_statements() as counts["logout"]:
+            await crud.logout_user(db, alice)
+    return counts
+
+
+def test_statements_per_operation(run):
+    counts = run(scenario())
+
+    assert len(counts["create_user"]) == 1     # INSERT ... RETURNING
+    assert len(counts["login"]) == 2           # UPDATE users ... RETURNING, INSERT refresh_tokens
+    assert len(counts["update"]) == 1          # UPDATE ... RETURNING
+    assert len(counts["logout"]) == 2          # UPDATE users ... RETURNING, DELETE refresh_tokens
+    # поиск чата, SAVEPOINT, INSERT чата, RELEASE, участники одним executemany, сообщение, outbox
+    assert len(counts["first_message"]) == 7
+    # чат уже есть: поиск по паре, сообщение, outbox
+    assert len(counts["message"]) == 3
@@ -0,0 +1,160 @@
+import types
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+import crud
+import db_conf
+import stats
+from conftest import make_admin, register, send_message
+from db_models import ChatStats, DailyStats, StatsWatermark, UserDailyStats
+
+
+TODAY = date(2024, 5, 1)
+
+
+@pytest.fixture
+def no_lag(monkeypatch):
+    # только что отправленные сообщения сразу попадают в пачку
+    monkeypatch.setattr(stats, "ROLLUP_LAG", -60)
+
+
+def rollup(client, limit: int = 100) -> int:
+    async def batch():
+        async with db_conf.AsyncSessionLocal() as db:
+            count = await stats.rollup_batch(db, 0, limit)
+            await db.commit()
+            return count
+    return client.portal.call(batch)
+
+
+def load(client, model) -> list:
+    async def rows():
+        async with db_conf.AsyncSessionLocal() as db:
+            return (await db.execute(select(model))).scalars().all()
+    return client.portal.call(rows)
+
+
+def total_messages(client) -> int:
+    return sum(row.messages for row in load(client, DailyStats))
+
+
+def test_counters_are_added_on_conflict(run):
+    earlier = datetime(2024, 5, 1, 10, 0)
+    later = earlier + timedelta(hours=1)
+
+    async def scenario():
+        async with db_conf.AsyncSessionLocal() as db:
+            await crud.add_stats_counters(db, {TODAY: 2}, {(TODAY, 1): 2}, {7: (2, later)})
+            await crud.add_stats_counters(db, {TODAY: 3}, {(TODAY, 1): 1, (TODAY, 2): 2}, {7: (3, earlier)})
+            await db.commit()
+            daily = (await db.execute(select(DailyStats))).scalars().all()
+            users = (await db.execute(select(UserDailyStats).order_by(UserDailyStats.user_id))).scalars().all()
+            chat = (await db.execute(select(ChatStats))).scalar_one()
+            return daily, users, chat
+
+    daily, users, chat = run(scenario())
+    assert [(row.day, row.messages) for row in daily] == [(TODAY, 5)]
+    assert [(row.user_id, row.messages) for row in users] == [(1, 3), (2, 2)]
+    assert chat.messages == 5
+    # время последнего сообщения не откатывается назад
+    assert chat.last_message_at.replace(tzinfo=None) == later
+
+
+def test_postgres_upsert_adds_to_existing_counters(run):
+    executed = []
+
+    async def execute(statement, params=None):
+        executed.append(statement)
+
+    db = types.SimpleNamespace(bind=types.SimpleNamespace(dialect=postgresql.dialect()), execute=execute)
+    run(crud.add_stats_counters(db, {TODAY: 1}, {(TODAY, 1): 1}, {7: (1, datetime(2024, 5, 1))}))
+
+    daily, user_daily, chats = (str(statement.compile(dialect=postgresql.dialect())) for statement in executed)
+    assert "ON CONFLICT (day) DO UPDATE SET messages = (stats_daily.messages + excluded.messages)" in daily
+    assert "ON CONFLICT (day, user_id) DO UPDATE SET messages = (stats_user_daily.messages + excluded.messages)" \
+        in user_daily
+    assert "ON CONFLICT (chat_id) DO UPDATE SET messages = (stats_chats.messages + excluded.messages)" in chats
+    assert "excluded.last_message_at > stats_chats.last_message_at" in chats
+
+
+def test_fresh_messages_wait_for_rollup_lag(client, monkeypatch):
+    register(client, "alice")
+    register(client, "bob")
+    send_message(client, "alice", "bob", "hi")
+
+    # сообщение моложе ROLLUP_LAG — меньший id ещё может закоммититься
+    assert rollup(client) == 0
+    assert load(client, StatsWatermark)[0].last_message_id == 0
+
+    monkeypatch.setattr(stats, "ROLLUP_LAG", -60)
+    assert rollup(client) == 1
+
+
+def test_rerun_does_not_double_count(client, no_lag):
+    register(client, "alice")
+    register(client, "bob")
+    messages = [send_message(client, "alice", "bob", f"hi {i}") for i in range(3)]
+
+    assert rollup(client, limit=2) == 2
+    assert load(client, StatsWatermark)[0].last_message_id == messages[1].id
+    assert rollup(client, limit=2) == 1
+    assert rollup(client, limit=2) == 0
+    assert total_messages(client) == 3
+
+    latest = send_message(client, "bob", "alice", "hi back")
+    assert rollup(client) == 1
+    assert total_messages(client) == 4
+    assert load(client, StatsWatermark)[0].last_message_id == latest.id
+    assert {(row.user_id, row.messages) for row in load(client, UserDailyStats)} == {
+        (messages[0].sender_id, 3), (latest.sender_id, 1),
+    }
+    assert [row.messages for row in load(client, ChatStats)] == [4]
+
+
+def test_backfill_rebuilds_from_scratch(client, no_lag):
+    register(client, "alice")
+    register(client, "bob")
+    for i in range(5):
+        send_message(client, "alice", "bob", f"hi {i}")
+
+    assert client.portal.call(stats.backfill, False, 2) == 5
+    assert client.portal.call(stats.backfill) == 0
+    assert total_messages(client) == 5
+
+    # --reset: счётчики с нуля, без удвоения
+    assert client.portal.call(stats.backfill, True, 2) == 5
+    assert total_messages(client) == 5
+
+
+def test_admin_stats_endpoints(client, no_lag):
+    alice = register(client, "alice")
+    bob = register(client, "bob")
+    register(client, "carol")
+    for i in range(3):
+        send_message(client, "alice", "bob", f"hi {i}")
+    last = send_message(client, "bob", "alice", "hi back")
+    newest = send_message(client, "carol", "alice", "hi")
+    rollup(client)
+
+    assert client.get("/admin/stats/daily", headers=bob).status_code == 403
+    make_admin(client, "alice")
+
+    today = datetime.now(timezone.utc).date().isoformat()
+    assert client.get("/admin/stats/daily", headers=alice).json() == [
+        {"day": today, "messages": 5, "active_users": 3},
+    ]
+
+    chats = client.get("/admin/stats/chats", params={"limit": 1}, headers=alice).json()
+    assert [(chat["chat_id"], chat["messages"]) for chat in chats] == [(last.chat_id, 4)]
+
+    users = client.get("/admin/stats/users", headers=alice).json()
+    assert users[0]["username"] == "alice" and users[0]["messages"] == 3
+    assert sorted((user["username"], user["messages"]) for user in users[1:]) == [("bob", 1), ("carol", 1)]
+
+    watermarks = client.get("/admin/stats/watermarks", headers=alice).json()
+    assert [(row["shard"], row["last_message_id"]) for row in watermarks] == [(0, newest.id)]
+
+    assert client.get("/admin/stats/users", params={"days": 10_000}, headers=alice).status_code == 422
@@ -0,0 +1,43 @@
+from sqlalchemy.dialects import postgresql
+
+import main
+from conftest import register
+from crud import _postgres_search_query
+
+
+def search(client, headers, q: str, **params) -> list[str]:
+    response = client.get("/user/search", params={"q": q, **params}, headers=headers)
+    assert response.status_code == 200
+    return [user["username"] for user in response.json()]
+
+
+def test_search_prefix_fuzzy_and_exact_first(client):
+    headers = register(client, "viewer")
+    for name in ("annabel", "anna", "annette", "bob", "Anya"):
+        register(client, name)
+
+    # точное совпадение первым, дальше префикс по алфавиту, потом похожие
+    assert search(client, headers, "anna") == ["anna", "annabel", "annette"]
+    assert search(client, headers, "an") == ["anna", "annabel", "annette", "Anya"]
+    # опечатка — находим по триграммам
+    assert "annette" in search(client, headers, "anette")
+    assert search(client, headers, "zzz") == []
+
+
+def test_search_result_cap(client):
+    headers = register(client, "viewer")
+    for i in range(5):
+        register(client, f"user{i}")
+
+    assert search(client, headers, "user", limit=2) == ["user0", "user1"]
+    too_many = client.get("/user/search", params={"q": "u", "limit": main.SEARCH_MAX_RESULTS + 1}, headers=headers)
+    assert too_many.status_code == 422
+
+
+def test_short_postgres_query_keeps_index_order():
+    def sql(q: str) -> str:
+        return str(_postgres_search_query(q, 10).compile(dialect=postgresql.dialect()))
+
+    short = sql("an")
+    assert "USING ~<~" in short and "similarity" not in short
+    assert "similarity" in sql("ann")
@@ -0,0 +1,111 @@
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+import websocket_router
+from conftest import make_admin, register
+
+
+@pytest.fixture
+def chat(client):
+    alice = register(client, "alice")
+    bob = register(client, "bob")
+    register(client, "eve")
+    bob_public_id = client.get("/user/profile/me", headers=bob).json()["public_id"]
+    client.get(f"/chat/{bob_public_id}/history", headers=alice)
+    chat_id = client.get("/chat/list", headers=alice).json()[0]["chat_id"]
+    return chat_id, alice, bob
+
+
+def token(headers: dict) -> str:
+    return headers["Authorization"].removeprefix("Bearer ")
+
+
+def test_broadcast_and_cleanup(client, chat):
+    chat_id, alice, bob = chat
+    make_admin(client, "alice")
+
+    with client.websocket_connect(f"/ws/chat/{chat_id}?token={token(alice)}") as a, \
+            client.websocket_connect(f"/ws/chat/{chat_id}?token={token(bob)}") as b:
+        a.send_json({"type": "ping"})
+        assert a.receive_json() == {"type": "pong"}
+
+        a.send_json({"text": "hi"})
+        relay = b.receive_json()
+        assert relay["type"] == "relay"
+        assert relay["data"] == {"text": "hi"}
+        assert a.receive_json() == relay
+
+        stats = client.get("/admin/connections", headers=alice).json()
+        assert stats["connections"] == 2
+        assert stats["users"] == 2
+        assert stats["chats"] == 1
+
+        a.send_text("{broken")
+        assert a.receive_json()["type"] == "error"
+
+    assert len(websocket_router.registry) == 0
+    assert client.get("/admin/connections", headers=alice).json()["connections"] == 0
+
+
+def test_not_a_member_is_rejected(client, chat):
+    chat_id, _, _ = chat
+    eve = client.post("/auth/login", data={"username": "eve", "password": "pw"}).json()["access_token"]
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect(f"/ws/chat/{chat_id}?token={eve}") as ws:
+            ws.receive_json()
+    assert len(websocket_router.registry) == 0
+
+
+def test_idle_connection_is_reaped(client, chat, monkeypatch):
+    chat_id, alice, _ = chat
+    with client.websocket_connect(f"/ws/chat/{chat_id}?token={token(alice)}") as ws:
+        async def reap():
+            return websocket_router.reaper.reap()
+
+        assert client.portal.call(reap) == 0
+        assert ws.receive_json() == {"type": "ping"}
+
+        monkeypatch.setattr(websocket_router, "IDLE_TIMEOUT", -1)
+        assert client.portal.call(reap) == 1
+        with pytest.raises(WebSocketDisconnect) as closed:
+            ws.receive_json()
+        assert closed.value.code == websocket_router.CLOSE_GOING_AWAY
+
+    assert len(websocket_router.registry) == 0
+
+
+def test_oversized_frame_closes_connection(client, chat):
+    chat_id, alice, _ = chat
+    with client.websocket_connect(f"/ws/chat/{chat_id}?token={token(alice)}") as ws:
+        ws.send_text("x" * (websocket_router.MAX_MESSAGE_SIZE + 1))
+        with pytest.raises(WebSocketDisconnect) as closed:
+            ws.receive_json()
+        assert closed.value.code == websocket_router.CLOSE_MESSAGE_TOO_BIG
+
+    assert len(websocket_router.registry) == 0
+
+
+def test_binary_frame_closes_connection(client, chat):
+    chat_id, alice, _ = chat
+    with client.websocket_connect(f"/ws/chat/{chat_id}?token={token(alice)}") as ws:
+        ws.send_bytes(b"\x00\x01")
+        with pytest.raises(WebSocketDisconnect) as closed:
+            ws.receive_json()
+        assert closed.value.code == websocket_router.CLOSE_UNSUPPORTED_DATA
+
+    assert len(websocket_router.registry) == 0
+    assert websocket_router.stats["unsupported"] >= 1
+
+
+def test_client_cannot_forge_server_events(client, chat):
+    chat_id, alice, bob = chat
+    with client.websocket_connect(f"/ws/chat/{chat_id}?token={token(alice)}") as a, \
+            client.websocket_connect(f"/ws/chat/{chat_id}?token={token(bob)}") as b:
+        a.send_json({"type": "receipts", "chat_id": chat_id, "read": [{"user_id": 2, "message_id": 1}]})
+        assert a.receive_json() == {"type": "error", "detail": "Reserved event type"}
+
+        # что бы клиент ни прислал, наружу это уходит как relay с его sender_id
+        a.send_json({"type": "custom", "sender_id": 2})
+        relay = b.receive_json()
+        assert relay["type"] == "relay"
+        assert relay["sender_id"] != relay["data"]["sender_id"]
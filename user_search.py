@@ -0,0 +1,88 @@
+import bisect
+
+
+# In-memory индекс username для баз без pg_trgm (SQLite в тестах и локально).
+# Префиксы ищем бисекцией по отсортированному списку, опечатки — по триграммам,
+# так же как это делает pg_trgm.
+
+SIMILARITY_THRESHOLD = 0.3  # как pg_trgm.similarity_threshold по умолчанию
+
+
+def trigrams(value: str) -> set[str]:
+    padded = "  " + value.lower() + " "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class UsernameIndex:
+    def __init__(self):
+        self.loaded = False
+        self._sorted: list[tuple[str, str]] = []  # (username.lower(), public_id)
+        self._names: dict[str, str] = {}  # public_id → username
+        self._postings: dict[str, set[str]] = {}  # триграмма → public_id
+
+    def add(self, public_id: str, username: str):
+        if public_id in self._names:
+            self.remove(public_id)
+        self._names[public_id] = username
+        bisect.insort(self._sorted, (username.lower(), public_id))
+        for gram in trigrams(username):
+            self._postings.setdefault(gram, set()).add(public_id)
+
+    def remove(self, public_id: str):
+        username = self._names.pop(public_id, None)
+        if username is None:
+            return
+        i = bisect.bisect_left(self._sorted, (username.lower(), public_id))
+        del self._sorted[i]
+        for gram in trigrams(username):
+            ids = self._postings.get(gram)
+            if ids:
+                ids.discard(public_id)
+                if not ids:
+                    del self._postings[gram]
+
+    def _prefix(self, prefix: str, limit: int) -> list[str]:
+        found = []
+        i = bisect.bisect_left(self._sorted, (prefix,))
+        while i < len(self._sorted) and len(found) < limit:
+            name, public_id = self._sorted[i]
+            if not name.startswith(prefix):
+                break
+            found.append(public_id)
+            i += 1
+        return found
+
+    def _fuzzy(self, q: str) -> list[tuple[float, str]]:
+        query_grams = trigrams(q)
+        shared: dict[str, int] = {}
+        for gram in query_grams:
+            for public_id in self._postings.get(gram, ()):
+                shared[public_id] = shared.get(public_id, 0) + 1
+
+        scored = []
+        for public_id, common in shared.items():
+            total = len(query_grams) + len(trigrams(self._names[public_id])) - common
+            similarity = common / total
+            if similarity >= SIMILARITY_THRESHOLD:
+                scored.append((similarity, public_id))
+        return scored
+
+    def search(self, q: str, limit: int) -> list[str]:
+        """public_id в порядке: точное совпадение, префикс, похожие"""
+        prefix = q.lower()
+        ranked = self._prefix(prefix, limit)
+        # точное совпадение всегда первым
+        ranked.sort(key=lambda public_id: self._names[public_id].lower() != prefix)
+
+        if len(ranked) < limit and len(q) >= 3:
+            seen = set(ranked)
+            fuzzy = sorted(
+                (item for item in self._fuzzy(q) if item[1] not in seen),
+                key=lambda item: (-item[0], self._names[item[1]].lower()),
+            )
+            ranked.extend(public_id for _, public_id in fuzzy[:limit - len(ranked)])
+
+        return ranked
+
+
+username_index = UsernameIndex()
@@ -1,52 +1,341 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
-from typing import Dict, Set
+import asyncio
+import heapq
+import json
+import logging
+import time
+from collections import deque
+
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 
 from jose import jwt, JWTError
-from sqlalchemy import select
 
 from config import settings
-from db_conf import get_db
-from db_models import Chat, User
-from crud import get_user_by_username
+from db_conf import AsyncSessionLocal
+from crud import get_user_by_username, is_chat_member, get_chat_shards, get_last_message_ids
+from auth import revocation_list
+from receipts import read_receipts
+from presence import activity
+from sharding import shard_map
+from connection_registry import ConnectionRegistry
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-# словарь: chat_id → set(websockets)
-active_connections: Dict[str, Set[WebSocket]] = {}
+# Сервер сам шлёт {"type": "ping"} раз в HEARTBEAT_INTERVAL, клиент отвечает
+# любым кадром (обычно {"type": "pong"}). Сокет, от которого ничего не было
+# IDLE_TIMEOUT секунд, считаем мёртвым (в том числе полуоткрытым) и закрываем.
+# Пинги на уровне протокола ASGI приложению не видны, поэтому пинги — сообщениями.
+HEARTBEAT_INTERVAL = 20
+IDLE_TIMEOUT = 3 * HEARTBEAT_INTERVAL
 
+SEND_QUEUE_SIZE = 100  # сообщений в очереди на отправку; переполнилась — клиент не успевает читать
+SEND_TIMEOUT = 10  # секунд на одну отправку
+MAX_MESSAGE_SIZE = 64 * 1024  # символов во входящем кадре
 
-async def connect(chat_id: int, websocket: WebSocket):
-    chat_id = str(chat_id)
-    await websocket.accept()
+# Эфемерные события (typing, delivered, read) в messages не пишутся:
+# копятся и раз в EVENTS_FLUSH_INTERVAL уходят одним событием на чат
+EVENTS_FLUSH_INTERVAL = 1
+TYPING_THROTTLE = 3  # секунд: чаще одного typing от участника не принимаем
+RECEIPT_TYPES = ("delivered", "read")
 
-    if chat_id not in active_connections:
-        active_connections[chat_id] = set()
+# Типы событий, которые шлёт только сервер. Остальные кадры клиента уходят
+# в чат обёрнутыми в relay с sender_id от сервера — подделать чужое событие нельзя
+SERVER_EVENT_TYPES = ("typing", "receipts", "error", "relay", "message")
 
-    active_connections[chat_id].add(websocket)
+# грубая оценка памяти сокета без очереди: буферы протокола сервера и таск
+# обработчика. Запись Connection с индексами реестра — сотни байт
+# (benchmarks/connection_memory.py)
+CONNECTION_BASE_MEMORY = 40 * 1024
 
+CLOSE_GOING_AWAY = 1001
+CLOSE_UNSUPPORTED_DATA = 1003
+CLOSE_INTERNAL_ERROR = 1011
+CLOSE_MESSAGE_TOO_BIG = 1009
+CLOSE_TRY_AGAIN_LATER = 1013
 
-def disconnect(chat_id: int, websocket: WebSocket):
-    chat_id = str(chat_id)
+PING = json.dumps({"type": "ping"})
+PONG = json.dumps({"type": "pong"})
+
+stats = {"reaped_idle": 0, "dropped_slow": 0, "send_failed": 0, "too_big": 0, "unsupported": 0}
+
+
+class Connection:
+    """
+    Один сокет: своя очередь на отправку, которую разбирает отдельный таск,
+    чтобы медленный клиент не тормозил broadcast для остальных.
+    Таск живёт, только пока в очереди что-то есть: у простаивающего сокета
+    его нет. __slots__ — записей сотни тысяч, __dict__ на каждую дорог
+    """
+
+    __slots__ = (
+        "websocket", "chat_id", "user_id", "queue", "queued_bytes",
+        "connected_at", "last_seen", "close_code", "task", "sender",
+    )
+
+    def __init__(self, websocket: WebSocket, chat_id: int, user_id: int):
+        self.websocket = websocket
+        self.chat_id = chat_id
+        self.user_id = user_id
+        # очередь создаём на первое сообщение и отпускаем, когда разобрана:
+        # пустой deque весит больше самой записи
+        self.queue: deque[str] | None = None
+        self.queued_bytes = 0
+        self.connected_at = self.last_seen = time.monotonic()
+        self.close_code: int | None = None
+        # таск обработчика — его отменяем, чтобы закрыть сокет снаружи
+        self.task = asyncio.current_task()
+        self.sender: asyncio.Task | None = None
+
+    def send(self, text: str) -> bool:
+        if self.close_code is not None:
+            return False
+        if self.queue is None:
+            self.queue = deque()
+        elif len(self.queue) >= SEND_QUEUE_SIZE:
+            stats["dropped_slow"] += 1
+            self.close(CLOSE_TRY_AGAIN_LATER)
+            return False
+        self.queue.append(text)
+        self.queued_bytes += len(text)
+        if self.sender is None:
+            self.sender = asyncio.create_task(self._drain())
+        return True
+
+    def close(self, code: int):
+        if self.close_code is None:
+            self.close_code = code
+            self.task.cancel()
+
+    async def _drain(self):
+        try:
+            while self.queue:
+                text = self.queue.popleft()
+                self.queued_bytes -= len(text)
+                await asyncio.wait_for(self.websocket.send_text(text), SEND_TIMEOUT)
+        except Exception:
+            stats["send_failed"] += 1
+            self.close(CLOSE_INTERNAL_ERROR)
+        finally:
+            self.sender = None
+            if not self.queue:
+                self.queue = None
+
+    def pending(self) -> int:
+        return len(self.queue) if self.queue else 0
+
+    def estimated_memory(self) -> int:
+        # строки broadcast общие для всех получателей, так что это оценка сверху
+        return CONNECTION_BASE_MEMORY + self.queued_bytes
+
+    def snapshot(self, now: float) -> dict:
+        return {
+            "chat_id": self.chat_id,
+            "user_id": self.user_id,
+            "queue": self.pending(),
+            "queued_bytes": self.queued_bytes,
+            "idle": round(now - self.last_seen, 1),
+            "age": round(now - self.connected_at, 1),
+        }
 
-    if chat_id not in active_connections:
-        return
 
-    active_connections[chat_id].remove(websocket)
+# открытые сокеты воркера, по chat_id и по user_id
+registry = ConnectionRegistry()
 
-    if len(active_connections[chat_id]) == 0:
-        del active_connections[chat_id]
+
+def is_user_in_chat(user_id: int, chat_id: int) -> bool:
+    return registry.is_user_in_chat(user_id, chat_id)
+
+
+def all_connections() -> list[Connection]:
+    return list(registry)
+
+
+async def connect(chat_id: int, websocket: WebSocket, user_id: int) -> Connection:
+    await websocket.accept()
+    conn = Connection(websocket, chat_id, user_id)
+    registry.add(conn)
+    return conn
+
+
+def disconnect(conn: Connection):
+    if conn.sender is not None:
+        conn.sender.cancel()
+    registry.remove(conn)
 
 
 async def broadcast(chat_id: int, message: dict):
-    chat_id = str(chat_id)
+    conns = registry.for_chat(chat_id)
+
+    if conns:
+        # сериализуем один раз на всех, отправку делают таски соединений
+        text = json.dumps(message, ensure_ascii=False)
+        for conn in list(conns):
+            conn.send(text)
+
+
+def connection_stats(limit: int = 50) -> dict:
+    now = time.monotonic()
+    conns = all_connections()
+    busiest = heapq.nlargest(limit, conns, key=Connection.pending)
+    return {
+        "connections": len(registry),
+        "users": len(registry.by_user),
+        "chats": len(registry.by_chat),
+        "queued_messages": sum(conn.pending() for conn in conns),
+        "estimated_memory": sum(conn.estimated_memory() for conn in conns),
+        "closed": stats,
+        "busiest": [conn.snapshot(now) for conn in busiest],
+    }
+
+
+class ChatEvents:
+    """
+    Коалесцирует эфемерные события: сколько бы раз участник ни печатал
+    или ни отмечал прочтение за интервал, чат получит одно событие.
+    read ещё и двигает курсор в chat_members (пачками, через read_receipts).
+    id в отметках клиенту не верим: перед рассылкой и записью курсора
+    обрезаем до последнего сообщения чата — одним запросом на шард за интервал
+    """
+
+    def __init__(self):
+        self._typing: dict[int, set[int]] = {}
+        self._typing_at: dict[tuple[int, int], float] = {}
+        self._receipts: dict[int, dict[str, dict[int, int]]] = {}
+        self.stats = {"typing": 0, "typing_throttled": 0, "receipts": 0, "events_sent": 0}
+        self._task: asyncio.Task | None = None
+
+    def typing(self, chat_id: int, user_id: int):
+        now = time.monotonic()
+        key = (chat_id, user_id)
+        if now - self._typing_at.get(key, -TYPING_THROTTLE) < TYPING_THROTTLE:
+            self.stats["typing_throttled"] += 1
+            return
+        self._typing_at[key] = now
+        self._typing.setdefault(chat_id, set()).add(user_id)
+        self.stats["typing"] += 1
 
-    if chat_id in active_connections:
-        for ws in list(active_connections[chat_id]):
-            await ws.send_json(message)
+    def receipt(self, kind: str, chat_id: int, user_id: int, message_id: int):
+        cursors = self._receipts.setdefault(chat_id, {}).setdefault(kind, {})
+        if message_id > cursors.get(user_id, 0):
+            cursors[user_id] = message_id
+        self.stats["receipts"] += 1
+
+    async def _last_message_ids(self, chat_ids) -> dict[int, int]:
+        last_ids: dict[int, int] = {}
+        async with AsyncSessionLocal() as db:
+            by_shard: dict[int, list[int]] = {}
+            for chat_id, shard in (await get_chat_shards(db, chat_ids)).items():
+                by_shard.setdefault(shard, []).append(chat_id)
+            for shard, shard_chat_ids in by_shard.items():
+                async with shard_map.session(db, shard) as shard_db:
+                    last_ids.update(await get_last_message_ids(shard_db, shard_chat_ids))
+        return last_ids
+
+    async def flush(self):
+        typing, self._typing = self._typing, {}
+        receipts, self._receipts = self._receipts, {}
+
+        for chat_id, user_ids in typing.items():
+            await broadcast(chat_id, {"type": "typing", "chat_id": chat_id, "user_ids": sorted(user_ids)})
+        self.stats["events_sent"] += len(typing)
+
+        last_ids = await self._last_message_ids(list(receipts)) if receipts else {}
+        for chat_id, kinds in receipts.items():
+            last_id = last_ids.get(chat_id)
+            if last_id is None:
+                continue  # в чате нет сообщений — отмечать нечего
+            event = {"type": "receipts", "chat_id": chat_id}
+            for kind, cursors in kinds.items():
+                cursors = {user_id: min(message_id, last_id) for user_id, message_id in cursors.items()}
+                if kind == "read":
+                    for user_id, message_id in cursors.items():
+                        read_receipts.mark(chat_id, user_id, message_id)
+                event[kind] = [{"user_id": user_id, "message_id": message_id} for user_id, message_id in cursors.items()]
+            await broadcast(chat_id, event)
+            self.stats["events_sent"] += 1
+
+        # старые отметки троттлинга больше не нужны
+        expired = time.monotonic() - TYPING_THROTTLE
+        self._typing_at = {key: at for key, at in self._typing_at.items() if at > expired}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(EVENTS_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Chat events flush failed")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # накопленные отметки прочтения должны успеть попасть в read_receipts
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Chat events flush failed on shutdown")
+
+
+chat_events = ChatEvents()
+
+
+class ConnectionReaper:
+    """Шлёт пинги и закрывает сокеты, которые давно молчат"""
+
+    def __init__(self):
+        self._task: asyncio.Task | None = None
+
+    def reap(self) -> int:
+        now = time.monotonic()
+        reaped = 0
+        for conn in all_connections():
+            if now - conn.last_seen > IDLE_TIMEOUT:
+                stats["reaped_idle"] += 1
+                conn.close(CLOSE_GOING_AWAY)
+                reaped += 1
+            else:
+                # живой сокет — тоже активность, даже если пользователь молчит
+                activity.touch(conn.user_id)
+                conn.send(PING)
+        return reaped
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                self.reap()
+            except Exception:
+                logger.exception("Connection reaper failed")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+reaper = ConnectionReaper()
 
 
 @router.websocket("/ws/chat/{chat_id}")
-async def websocket_chat(websocket: WebSocket, chat_id: int, db=Depends(get_db)):
+async def websocket_chat(websocket: WebSocket, chat_id: int):
     # 1. Получаем token
     token = websocket.query_params.get("token")
     if not token:
@@ -61,35 +350,85 @@ async def websocket_chat(websocket: WebSocket, chat_id: int, db=Depends(get_db))
         await websocket.close()
         return
 
-    # 3. Находим пользователя по username
-    user = await get_user_by_username(db, username)
-    if not user:
+    jti = payload.get("jti")
+    if jti and await revocation_list.is_revoked(jti):
         await websocket.close()
         return
 
-    # 4. Проверяем, имеет ли право находиться в чате
-    result = await db.execute(select(Chat).where(Chat.id == chat_id))
-    chat = result.scalar_one_or_none()
+    # 3-4. Пользователь и право находиться в чате. Сессию берём только на эти
+    # запросы, а не на всё время жизни сокета — иначе каждый сокет держит соединение из пула
+    async with AsyncSessionLocal() as db:
+        user = await get_user_by_username(db, username)
+        allowed = user is not None and await is_chat_member(db, chat_id, user.id)
 
-    if not chat:
-        await websocket.close()
-        return
-
-    if user.id not in [chat.user1_id, chat.user2_id]:
+    if not allowed:
         await websocket.close()
         return
 
     # 5. Подключаем
-    await connect(chat_id, websocket)
+    conn = await connect(chat_id, websocket, user.id)
 
-    # 6. Цикл получения сообщений
+    # 6. Цикл получения сообщений. Из реестра убираем при любом выходе:
+    # отключение клиента, ошибка, закрытие по таймауту или переполнению очереди
     try:
         while True:
-            data = await websocket.receive_json()
+            # receive_text() падает с KeyError на бинарном кадре — разбираем сами
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            conn.last_seen = time.monotonic()
+
+            text = message.get("text")
+            if text is None:
+                stats["unsupported"] += 1
+                conn.close_code = CLOSE_UNSUPPORTED_DATA
+                break
+
+            if len(text) > MAX_MESSAGE_SIZE:
+                stats["too_big"] += 1
+                conn.close_code = CLOSE_MESSAGE_TOO_BIG
+                break
+
+            try:
+                data = json.loads(text)
+            except ValueError:
+                conn.send(json.dumps({"type": "error", "detail": "Invalid JSON"}))
+                continue
+
+            event_type = data.get("type") if isinstance(data, dict) else None
+            if event_type in ("ping", "pong"):
+                if event_type == "ping":
+                    conn.send(PONG)
+                continue
+
+            if event_type == "typing":
+                chat_events.typing(chat_id, user.id)
+                continue
+
+            if event_type in RECEIPT_TYPES:
+                message_id = data.get("message_id")
+                if type(message_id) is not int or message_id <= 0:
+                    conn.send(json.dumps({"type": "error", "detail": "Invalid message_id"}))
+                    continue
+                chat_events.receipt(event_type, chat_id, user.id, message_id)
+                continue
 
-            # можно тут сохранять в БД
+            if event_type in SERVER_EVENT_TYPES:
+                conn.send(json.dumps({"type": "error", "detail": "Reserved event type"}))
+                continue
 
-            await broadcast(chat_id, data)
+            await broadcast(chat_id, {"type": "relay", "chat_id": chat_id, "sender_id": user.id, "data": data})
 
     except WebSocketDisconnect:
-        disconnect(chat_id, websocket)
+        pass
+    except asyncio.CancelledError:
+        # закрыли сами (conn.close) — это не отмена обработчика
+        if conn.close_code is None:
+            raise
+    finally:
+        disconnect(conn)
+        if conn.close_code is not None:
+            try:
+                await websocket.close(conn.close_code)
+            except Exception:
+                pass